@@ -6,6 +6,8 @@
 ###########################################################
 
 import os
+import sys
+import importlib
 import psutil
 import click
 from jinja2 import Environment, PackageLoader
@@ -15,6 +17,7 @@ from . import wsgi
 from urllib.parse import urlparse
 
 PID_FILE = os.path.abspath(os.path.join(os.path.curdir, "pywps.pid"))
+CLIMATE_STATS_DIR = os.path.join(os.path.dirname(__file__), "processes", "GetClimateStats")
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
@@ -72,6 +75,15 @@ def run_process_action(action=None):
     click.echo(msg)
 
 
+def climate_stats_module(name):
+    """Import and return a module from the GetClimateStats process directory.
+    Those modules use script-style imports of their siblings, so the directory
+    must be on the python path."""
+    if CLIMATE_STATS_DIR not in sys.path:
+        sys.path.insert(0, CLIMATE_STATS_DIR)
+    return importlib.import_module(name)
+
+
 def _run(application, bind_host=None, daemon=False):
     from werkzeug.serving import run_simple
 
@@ -231,3 +243,497 @@ def start(
     else:
         # no daemon
         _run(app, bind_host=bind_host)
+
+
+@cli.command("build-grid-lookup")
+@click.option(
+    "--resolution",
+    "-r",
+    default=0.01,
+    type=float,
+    show_default=True,
+    help="resolution (in degrees) of the quantized coordinates.",
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    metavar="PATH",
+    help="directory to write the lookup tables to [default: the grid reference directory].",
+)
+def build_grid_lookup(resolution, output_dir):
+    """Build the lookup table from coordinates to climate stats grid boxes"""
+    Location = climate_stats_module("lib").Location
+    grid_index = climate_stats_module("grid_index")
+    grid_lookup = climate_stats_module("grid_lookup")
+
+    index = grid_index.getGridIndex(Location.getReferenceFiles(), Location.REF_VARIABLE)
+    output_dir = output_dir or Location.GRID_REFERENCE_DIR
+
+    for fpath in grid_lookup.buildGridLookup(index, output_dir, resolution=resolution):
+        click.echo("wrote: {}".format(fpath))
+
+
+@cli.command("build-data-cube")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--output-dir",
+    "-o",
+    metavar="PATH",
+    help="directory to write the data cubes to [default: the data_cube_dir option].",
+)
+@click.option(
+    "--domain",
+    "-d",
+    "domains",
+    multiple=True,
+    metavar="DOMAIN",
+    help="domain to build (Global or a CORDEX domain such as EUR-44) [default: all domains].",
+)
+def build_data_cube(config, output_dir, domains):
+    """Build the consolidated data cubes of climate stats"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    ClimateStatsExtractor = climate_stats_module("lib").ClimateStatsExtractor
+    settings = climate_stats_module("settings")
+    data_cube = climate_stats_module("data_cube")
+
+    output_dir = output_dir or settings.getSetting("data_cube_dir", "")
+    if not output_dir:
+        raise click.UsageError("no output directory given and the data_cube_dir option is not set.")
+
+    extractor = ClimateStatsExtractor()
+
+    for domain in domains or data_cube.getDomains():
+        fpath = data_cube.buildDataCube(domain, output_dir, extractor._getStatsFilePath)
+        click.echo("wrote: {}".format(fpath))
+
+
+@cli.command("build-offset-index")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--output",
+    "-o",
+    metavar="PATH",
+    help="index file to write [default: the offset_index option].",
+)
+@click.option(
+    "--data-dir",
+    "-d",
+    metavar="PATH",
+    help="directory containing the stats files [default: the climate stats data directory].",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="index all files instead of only those modified since the last build.",
+)
+def build_offset_index(config, output, data_dir, full):
+    """Build the index of byte offsets of the data in the climate stats files"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    ClimateStatsExtractor = climate_stats_module("lib").ClimateStatsExtractor
+    settings = climate_stats_module("settings")
+    file_catalog = climate_stats_module("file_catalog")
+    offset_index = climate_stats_module("offset_index")
+
+    output = output or settings.getSetting("offset_index", "")
+    if not output:
+        raise click.UsageError("no index file given and the offset_index option is not set.")
+
+    previous = None
+    if not full and os.path.isfile(output):
+        previous = offset_index.OffsetIndex.load(output)
+
+    patterns = {"Global": ClimateStatsExtractor.GLOBAL_FILE_PATTERN,
+                "Regional": ClimateStatsExtractor.REGIONAL_FILE_PATTERN}
+    data_dir = data_dir or ClimateStatsExtractor.DATA_DIR
+    stats_catalog = file_catalog.buildFileCatalog(data_dir, patterns)
+
+    # The catalog is keyed by (domain_type, var_id, ...)
+    files = [(os.path.join(data_dir, rel_path), key[1]) for (key, rel_path) in sorted(stats_catalog.files.items())]
+    index = offset_index.buildOffsetIndex(files, previous=previous)
+    index.save(output)
+
+    click.echo(
+        "indexed {} of {} files (read {}, re-used {})".format(
+            len(index), len(files), index.indexed_files, index.reused_files
+        )
+    )
+    click.echo("wrote: {}".format(output))
+
+
+@cli.group()
+def catalog():
+    """Manage the catalog of climate stats files"""
+    pass
+
+
+@catalog.command("rebuild")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--output",
+    "-o",
+    metavar="PATH",
+    help="catalog file to write [default: the file_catalog option].",
+)
+@click.option(
+    "--data-dir",
+    "-d",
+    metavar="PATH",
+    help="directory containing the stats files [default: the climate stats data directory].",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    help="list all directories instead of only those modified since the last build.",
+)
+def catalog_rebuild(config, output, data_dir, full):
+    """Rebuild the catalog of climate stats files"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    ClimateStatsExtractor = climate_stats_module("lib").ClimateStatsExtractor
+    settings = climate_stats_module("settings")
+    file_catalog = climate_stats_module("file_catalog")
+
+    output = output or settings.getSetting("file_catalog", "")
+    if not output:
+        raise click.UsageError("no catalog file given and the file_catalog option is not set.")
+
+    previous = None
+    if not full and os.path.isfile(output):
+        previous = file_catalog.FileCatalog.load(output)
+
+    patterns = {"Global": ClimateStatsExtractor.GLOBAL_FILE_PATTERN,
+                "Regional": ClimateStatsExtractor.REGIONAL_FILE_PATTERN}
+    stats_catalog = file_catalog.buildFileCatalog(
+        data_dir or ClimateStatsExtractor.DATA_DIR, patterns, previous=previous
+    )
+    stats_catalog.save(output)
+
+    click.echo(
+        "catalogued {} files (listed {} directories, re-used {})".format(
+            len(stats_catalog), stats_catalog.scanned_dirs, stats_catalog.reused_dirs
+        )
+    )
+    click.echo("wrote: {}".format(output))
+
+
+@catalog.command("diff")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--old",
+    metavar="PATH",
+    help="catalog of the stats files before the change [default: the file_catalog option].",
+)
+@click.option(
+    "--new",
+    metavar="PATH",
+    required=True,
+    help="catalog of the stats files after the change (e.g. written by 'catalog rebuild -o').",
+)
+@click.option(
+    "--delete",
+    is_flag=True,
+    help="delete the invalidated entries from the caches.",
+)
+def catalog_diff(config, old, new, delete):
+    """List the cache entries invalidated by changes to the stats files"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+    settings = climate_stats_module("settings")
+    file_catalog = climate_stats_module("file_catalog")
+
+    old = old or settings.getSetting("file_catalog", "")
+    if not old:
+        raise click.UsageError("no old catalog given and the file_catalog option is not set.")
+
+    (added, removed, modified) = file_catalog.diffCatalogs(
+        file_catalog.FileCatalog.load(old), file_catalog.FileCatalog.load(new)
+    )
+    click.echo("{} files added, {} removed and {} modified".format(len(added), len(removed), len(modified)))
+
+    for cache_class in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        stats_cache = cache_class()
+        stale = stats_cache.findStaleEntries(added | removed | modified)
+
+        for key in stale:
+            click.echo("{}: {}".format(cache_class.NAME, "/".join(key)))
+
+        if delete:
+            stats_cache.backend.deleteMany(stale)
+
+        click.echo(
+            "{} {} entries of {}".format("deleted" if delete else "invalidated", len(stale), cache_class.CACHE_DIR)
+        )
+
+
+@cli.group()
+def cache():
+    """Manage the climate stats caches"""
+    pass
+
+
+@cache.command("migrate")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--source",
+    "-s",
+    default="filesystem",
+    show_default=True,
+    type=click.Choice(["filesystem", "sqlite", "redis"]),
+    help="cache backend to copy the entries from.",
+)
+@click.option(
+    "--target",
+    "-t",
+    default="sqlite",
+    show_default=True,
+    type=click.Choice(["filesystem", "sqlite", "redis"]),
+    help="cache backend to copy the entries to.",
+)
+def cache_migrate(config, source, target):
+    """Copy the entries of the climate stats caches to another backend"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+    cache_backends = climate_stats_module("cache_backends")
+
+    if source == target:
+        raise click.UsageError("the source and target backends must be different.")
+
+    for cache_class in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        count = cache_backends.migrateCache(cache_class.createBackend(source), cache_class.createBackend(target))
+        click.echo("copied {} entries of {} from {} to {}".format(count, cache_class.CACHE_DIR, source, target))
+
+
+@cache.command("snapshot")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--source",
+    "-s",
+    default="filesystem",
+    show_default=True,
+    type=click.Choice(["filesystem", "sqlite", "redis"]),
+    help="cache backend to pack the entries of.",
+)
+@click.option(
+    "--keep",
+    default=2,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="number of snapshots to keep in each cache, including the new one.",
+)
+def cache_snapshot(config, source, keep):
+    """Pack the climate stats caches into read-only snapshot files"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+    cache_backends = climate_stats_module("cache_backends")
+
+    for cache_class in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        snapshot_dir = os.path.join(cache_class.CACHE_DIR, cache_backends.SNAPSHOT_DIR_NAME)
+        path = cache_backends.writeSnapshot(cache_class.createBackend(source), snapshot_dir, keep=keep)
+        click.echo("wrote snapshot of {} to {}".format(cache_class.CACHE_DIR, path))
+
+
+@cache.command("gc")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--batch-size",
+    default=100,
+    show_default=True,
+    type=int,
+    help="number of entries evicted in each transaction.",
+)
+@click.option(
+    "--pause",
+    default=0.1,
+    show_default=True,
+    type=float,
+    help="seconds to wait between batches.",
+)
+@click.option(
+    "--reindex",
+    is_flag=True,
+    help="first add entries that are missing from the access index (e.g. written by older versions).",
+)
+def cache_gc(config, batch_size, pause, reindex):
+    """Evict entries until the climate stats caches are within their budgets"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+
+    for cache_class in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        stats_cache = cache_class()
+
+        if reindex:
+            click.echo("indexed {} entries of {}".format(stats_cache.backend.reindexAccess(), cache_class.CACHE_DIR))
+
+        (evicted, freed) = stats_cache.collectGarbage(batch_size=batch_size, pause=pause)
+        click.echo("evicted {} entries ({} bytes) from {}".format(evicted, freed, cache_class.CACHE_DIR))
+
+
+@cache.command("stats")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+def cache_stats(config):
+    """Show the size and occupancy of the climate stats caches"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+
+    for cache_class in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        stats = cache_class().getStats()
+        click.echo("{}:".format(cache_class.CACHE_DIR))
+
+        for (used, limit) in (("entries", "max_entries"), ("bytes", "max_bytes")):
+            occupancy = stats[used + "_occupancy"]
+            click.echo(
+                "  {}: {} of {} ({})".format(
+                    used, stats[used], stats[limit] or "unlimited",
+                    "-" if occupancy is None else "{:.1%}".format(occupancy),
+                )
+            )
+
+
+@cli.command("warm-cache")
+@click.option(
+    "--config", "-c", metavar="PATH", help="path to pywps configuration file."
+)
+@click.option(
+    "--assets",
+    "-a",
+    metavar="PATH",
+    default=os.path.join(CLIMATE_STATS_DIR, "asset_locations.txt"),
+    show_default=True,
+    help="file of the asset locations (LAT LON lines) to warm the caches for.",
+)
+@click.option(
+    "--processes",
+    "-p",
+    default=4,
+    show_default=True,
+    type=int,
+    help="number of worker processes (0 warms the caches in this process).",
+)
+@click.option(
+    "--experiment",
+    "-e",
+    "experiments",
+    multiple=True,
+    type=click.Choice(["rcp45", "rcp85"]),
+    help="experiment to warm the summary cache for [default: all].",
+)
+@click.option(
+    "--time-period",
+    "-t",
+    "time_periods",
+    multiple=True,
+    type=click.Choice(["2035", "2055"]),
+    help="time period to warm the summary cache for [default: all].",
+)
+@click.option(
+    "--cache",
+    "kinds",
+    multiple=True,
+    type=click.Choice(["summary", "full"]),
+    help="cache to warm [default: both].",
+)
+@click.option(
+    "--batch-size",
+    default=50,
+    show_default=True,
+    type=int,
+    help="number of grid boxes extracted together for the summary cache.",
+)
+@click.option(
+    "--checkpoint",
+    metavar="PATH",
+    default="warm-cache.checkpoint",
+    show_default=True,
+    help="file recording the grid boxes that have been warmed, to resume from.",
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    help="discard the checkpoint and warm all grid boxes again.",
+)
+def warm_cache(config, assets, processes, experiments, time_periods, kinds, batch_size, checkpoint, restart):
+    """Populate the climate stats caches for a list of assets"""
+    if config:
+        # load the configuration, as for the start command
+        wsgi.create_app(cfgfiles=[config])
+
+    lib = climate_stats_module("lib")
+    cache_warmup = climate_stats_module("cache_warmup")
+
+    scenarios = [
+        (time_period, experiment) for (time_period, experiment) in lib.FULL_SUMMARY_SCENARIOS
+        if time_period in (time_periods or [time_period]) and experiment in (experiments or [experiment])
+    ]
+
+    done = cache_warmup.Checkpoint(checkpoint)
+    if restart:
+        done.clear()
+
+    locations = lib.Location.fromMany(cache_warmup.readAssets(assets))
+    units = cache_warmup.planWarmup(
+        locations, scenarios=scenarios, kinds=kinds or cache_warmup.KINDS, batch_size=batch_size, done=done.done
+    )
+
+    click.echo(
+        "warming {} units for {} assets ({} grid boxes already warmed)".format(len(units), len(locations), len(done))
+    )
+
+    def progress(stats, unit, read_errors):
+        finished = stats.completed_units + stats.failed_units
+        remaining = stats.remaining
+
+        click.echo(
+            "[{}/{}] {} {}{}: {} grid boxes{} ({:.1f} grid boxes/s, {} remaining)".format(
+                finished, stats.total_units, unit.kind, unit.domain_type,
+                " {1} {0}".format(*unit.scenario) if unit.scenario else "", len(unit.entries),
+                ", {} read errors".format(read_errors) if read_errors else "", stats.rate,
+                "-" if remaining is None else "{:.0f}s".format(remaining),
+            )
+        )
+
+    stats = cache_warmup.runWarmup(units, done, processes=processes, progress=progress)
+
+    click.echo(
+        "warmed {} grid boxes in {:.0f}s ({:.1f} grid boxes/s); {} of {} units failed ({} read errors)".format(
+            stats.grid_boxes, stats.elapsed, stats.rate, stats.failed_units, stats.total_units, stats.read_errors
+        )
+    )
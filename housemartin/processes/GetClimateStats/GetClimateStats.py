@@ -67,7 +67,7 @@ class GetClimateStats(processes.internal.ProcessBase.ProcessBase.ProcessBase):
             context.setStatus(STATUS.STARTED, 'Job is now running', 0)
 
             # Get the data
-            locations = [Location(loc) for loc in a["Locations"]]
+            locations = Location.fromMany(a["Locations"])
             extractor = ClimateStatsExtractor()
             results_dict = extractor.extractData(a["Experiment"], a["TimePeriod"], locations) 
 
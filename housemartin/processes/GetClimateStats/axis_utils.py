@@ -2,16 +2,103 @@
 axis_utils.py
 =============
 
-Utils for wokring with arrays/axes.
+Utils for working with arrays/axes.
+
+Nearest-neighbour searches work on arrays of query values and return both the
+nearest axis values and their indices, so that callers can use ``isel`` rather
+than matching floats with ``sel`` or ``loc``.
 """
 
+import numpy as np
+
+
+def is_periodic(axis, period=360.):
+    """
+    Returns True if the (regularly spaced) ``axis`` covers a whole ``period``, i.e. the
+    last value is one step away from wrapping round to the first value.
+    """
+    axis = np.sort(np.asarray(axis, dtype="float64"))
+    if len(axis) < 2:
+        return False
+
+    step = np.median(np.diff(axis))
+    return bool(axis[-1] - axis[0] + step >= period - 1e-6)
+
+
+def wrap_to_range(values, lower, upper, period=360.):
+    """
+    Shifts each of ``values`` by a multiple of ``period`` so that it falls within
+    [``lower``, ``upper``]. Values that cannot be shifted into the range are returned as NaN.
+    """
+    values = np.asarray(values, dtype="float64")
+    shifted = lower + np.mod(values - lower, period)
+
+    return np.where(shifted <= upper, shifted, np.nan)
+
+
+class SortedAxis(object):
+    """
+    A monotonic (increasing or decreasing) axis prepared for repeated nearest-neighbour searches.
+
+    If ``period`` is set the axis is treated as periodic (e.g. longitude with ``period=360``),
+    so values either side of the wrap point (0/360 or -180/180) find their true nearest neighbour.
+    Ties are resolved towards the value that comes first in the original axis.
+    """
+
+    def __init__(self, axis, period=None):
+        self.values = np.asarray(axis, dtype="float64")
+
+        if self.values.ndim != 1 or len(self.values) == 0:
+            raise Exception("Axis must be a non-empty 1D array.")
+
+        self.period = period
+        self._order = np.argsort(self.values, kind="stable")
+        self._sorted = self.values[self._order]
+
+        self.min = float(self._sorted[0])
+        self.max = float(self._sorted[-1])
+
+        if period:
+            # Pad the sorted axis with its neighbours across the wrap point
+            self._sorted = np.concatenate(([self._sorted[-1] - period], self._sorted, [self._sorted[0] + period]))
+            self._order = np.concatenate(([self._order[-1]], self._order, [self._order[0]]))
+
+    def nearest(self, values):
+        """
+        Returns a tuple of arrays: (nearest_values, indices) for each of ``values``.
+        """
+        values = np.asarray(values, dtype="float64")
+
+        if self.period:
+            values = self.min + np.mod(values - self.min, self.period)
+
+        if len(self._sorted) == 1:
+            indices = np.zeros(values.shape, dtype="int64")
+            return (self.values[indices], indices)
+
+        i = np.clip(np.searchsorted(self._sorted, values), 1, len(self._sorted) - 1)
+        below = values - self._sorted[i - 1]
+        above = self._sorted[i] - values
+
+        use_below = (below < above) | ((below == above) & (self._order[i - 1] < self._order[i]))
+        indices = self._order[np.where(use_below, i - 1, i)]
+
+        return (self.values[indices], indices)
+
+
+def nearest_axis_values(axis, values, period=None):
+    """
+    Returns a tuple of arrays: (nearest_values, indices) of the values in ``axis`` nearest
+    to each of ``values``. See ``SortedAxis`` for the meaning of ``period``.
+    """
+    return SortedAxis(axis, period=period).nearest(values)
+
 
 def find_nearest(array, value):
-    n = [abs(i-value) for i in array]
-    idx = n.index(min(n))
-    return array[idx]
+    "Returns the value in ``array`` that is nearest to ``value``."
+    (nearest_values, indices) = nearest_axis_values(array, [value])
+    return float(nearest_values[0])
 
 
 def nudgeSingleValuesToAxisValues(value, array):
-    return find_nearest(value, array)
-
+    return find_nearest(array, value)
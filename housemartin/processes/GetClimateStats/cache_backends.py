@@ -0,0 +1,1090 @@
+"""
+cache_backends.py
+=================
+
+Storage backends for the climate stats caches (see: ``StatsCacheBase`` in ``lib.py``).
+
+A backend stores the payload (bytes) of a cache entry against a key: a tuple of the (string)
+facet values of the entry, such as ("Global", "rcp45", "2035", "51.5000", "m0.5000").
+Payloads are opaque to the backends (they are never unpickled).
+
+ * ``FileSystemBackend``: a file per entry, in a directory tree of the facet values.
+ * ``SQLiteBackend``: a single SQLite database file (in WAL mode on a local file system) in the
+   cache directory.
+ * ``SnapshotBackend``: a read-only, memory-mapped snapshot file of a warmed cache (see:
+   ``writeSnapshot``), for nodes that only serve pre-warmed grid boxes.
+ * ``RedisBackend``: a networked store of the Redis protocol, shared by all nodes (see:
+   ``network_cache.py``).
+
+Other backends can be plugged in by sub-classing ``CacheBackend`` and registering a factory
+for them under the name used for the ``cache_backend`` option (see: ``registerCacheBackend``).
+
+Either can be fronted by a ``MemoryTier``: a size-bounded in-process LRU of recently used
+entries, which is read before (and written together with) the backend.
+
+Workers that compute entries hold a lock on their keys (see: ``lockKeys``), so that other
+workers wait for the results instead of computing the same entries.
+
+The size and accesses of every entry are recorded in an ``AccessIndex`` (instead of relying
+on file system access times), so that a cache can be kept within a budget by evicting the
+least recently (or least frequently) used entries (see: ``collectGarbage``). Hits are passed
+on to the index in batches (see: ``AccessBuffer``), so that reads do not write to it.
+
+"""
+
+# Standard library imports
+import os
+import mmap
+import atexit
+import time
+import struct
+import fcntl
+import hashlib
+import logging
+import sqlite3
+import weakref
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SQLITE_FILE_NAME = "cache.sqlite"
+
+# Maximum number of keys in a single SQLite query
+SQLITE_BATCH_SIZE = 500
+
+# Directory (in the cache directory) of the lock files, and the number of lock files that
+# keys are spread over
+LOCK_DIR_NAME = ".locks"
+LOCK_STRIPES = 4096
+LOCK_POLL_INTERVAL = 0.05
+
+# File name of the access index of a file system cache
+ACCESS_FILE_NAME = "access.sqlite"
+
+# Hits are passed on to the access index in batches of keys, at least this often (in seconds)
+ACCESS_FLUSH_SIZE = 100
+ACCESS_FLUSH_INTERVAL = 60.
+
+# File system types (from /proc/mounts) on which SQLite databases are not used in WAL mode, as
+# WAL needs shared memory between all the processes using a database, which these do not provide
+NETWORK_FILE_SYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "lustre", "gpfs", "panfs", "ceph", "glusterfs",
+                        "fuse.glusterfs", "fuse.sshfs", "9p")
+
+EVICTION_POLICIES = ("lru", "lfu")
+
+# Directory (in the cache directory) of the snapshot files, and the name of the link to the current snapshot
+SNAPSHOT_DIR_NAME = "snapshots"
+SNAPSHOT_LINK_NAME = "current"
+SNAPSHOT_FILE_TEMPLATE = "snapshot-%06d.dat"
+
+SNAPSHOT_MAGIC = b"HMCS"
+SNAPSHOT_FORMAT = 1
+
+# <magic> <format: uint8> <snapshot version: uint32> <number of entries: uint64> <index offset: uint64>
+SNAPSHOT_HEADER = struct.Struct("<4sBIQQ")
+
+# An index record per entry: <key offset: uint64> <key length: uint32> <data offset: uint64> <data length: uint32>
+SNAPSHOT_RECORD = struct.Struct("<QIQI")
+
+# Minimum number of seconds between checks for a new current snapshot
+SNAPSHOT_CHECK_INTERVAL = 5.
+
+
+def isNetworkFileSystem(path):
+    "Returns True if ``path`` is on a mounted file system of one of the NETWORK_FILE_SYSTEMS types."
+    path = os.path.realpath(path)
+    (mount_point, fs_type) = ("", None)
+
+    try:
+        with open("/proc/mounts") as reader:
+            mounts = [line.split()[1:3] for line in reader if len(line.split()) > 2]
+    except OSError:
+        return False
+
+    # The file system of the path is the one mounted at its longest parent
+    for (mount, kind) in mounts:
+        mount = mount.replace("\\040", " ")
+
+        if (path == mount or path.startswith(mount.rstrip("/") + "/")) and len(mount) >= len(mount_point):
+            (mount_point, fs_type) = (mount, kind)
+
+    return fs_type in NETWORK_FILE_SYSTEMS
+
+
+class SQLiteConnections(object):
+    """
+    Holds a connection to the SQLite database at ``path`` for each thread (and process).
+    On a local file system, the database is used in WAL mode, so that readers are not blocked
+    while it is written. WAL is not safe on a network file system (see: NETWORK_FILE_SYSTEMS),
+    so a rollback journal is used there. ``schema`` is a list of statements that set up the tables.
+    """
+
+    def __init__(self, path, schema, timeout=30.):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        self._local = threading.local()
+        _connection_holders.add(self)
+
+    def connect(self):
+        "Returns the connection of the current thread, opening it if needed."
+        conn = getattr(self._local, "conn", None)
+
+        # Connections must not be shared with forked processes
+        if conn is None or self._local.pid != os.getpid():
+            dr = os.path.dirname(self.path)
+            if dr and not os.path.isdir(dr):
+                os.makedirs(dr, exist_ok=True)
+
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=%s" % ("DELETE" if isNetworkFileSystem(dr or ".") else "WAL"))
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+            with conn:
+                for statement in self.schema:
+                    conn.execute(statement)
+
+            (self._local.conn, self._local.pid) = (conn, os.getpid())
+
+        return conn
+
+
+# All SQLiteConnections. A forked process must not inherit open connections: SQLite shares the
+# lock state of a database between the connections of a process, so the connections that the
+# child opens would see the locks of the parent (and closing an inherited one releases them).
+_connection_holders = weakref.WeakSet()
+
+
+def _closeConnections():
+    "Closes the connections of the current thread before a fork. They are opened again when needed."
+    for holder in list(_connection_holders):
+        conn = getattr(holder._local, "conn", None)
+
+        if conn is not None:
+            conn.close()
+            holder._local.conn = None
+
+
+os.register_at_fork(before=_closeConnections)
+
+
+def _batches(items, size=SQLITE_BATCH_SIZE):
+    "Yields lists of up to ``size`` of ``items``."
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class AccessIndex(object):
+    """
+    Records the size, last access time and number of hits of each entry of a cache, in the
+    ``access`` table of an SQLite database (see: ``SQLiteConnections``).
+    """
+
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS access (key TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+              "accessed REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)",
+              "CREATE INDEX IF NOT EXISTS access_by_time ON access (accessed)"]
+
+    def __init__(self, connections):
+        self.connections = connections
+
+    def recordMany(self, items, conn=None):
+        "Records each of ``items`` (a list of (key, size, access time)) as written."
+        conn = conn or self.connections.connect()
+        rows = [("/".join(key), size, accessed) for (key, size, accessed) in items]
+
+        with conn:
+            conn.executemany("INSERT INTO access (key, size, accessed) VALUES (?, ?, ?) ON CONFLICT (key) "
+                             "DO UPDATE SET size = excluded.size, accessed = excluded.accessed", rows)
+
+    def touchMany(self, keys):
+        "Records a hit (now) for each of ``keys``."
+        conn = self.connections.connect()
+        keys = ["/".join(key) for key in keys]
+
+        with conn:
+            for batch in _batches(keys):
+                conn.execute("UPDATE access SET accessed = ?, hits = hits + 1 WHERE key IN (%s)" %
+                             ",".join(["?"] * len(batch)), [time.time()] + batch)
+
+    def removeMany(self, keys, conn=None):
+        conn = conn or self.connections.connect()
+
+        with conn:
+            conn.executemany("DELETE FROM access WHERE key = ?", [("/".join(key),) for key in keys])
+
+    def keys(self):
+        "Returns a set of all keys in the index."
+        return set([tuple(key.split("/")) for (key,) in self.connections.connect().execute("SELECT key FROM access")])
+
+    def getUsage(self):
+        "Returns a dictionary of the number of entries, their total size and the oldest access time."
+        (entries, nbytes, oldest) = self.connections.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(accessed) FROM access").fetchone()
+        return {"entries": entries, "bytes": nbytes, "oldest_access": oldest}
+
+    def getVictims(self, policy, limit):
+        "Returns a list of (key, size) of up to ``limit`` entries to evict first under the ``policy``."
+        if policy not in EVICTION_POLICIES:
+            raise Exception("Unknown eviction policy: '%s'. Must be one of: %s." %
+                            (policy, ", ".join(EVICTION_POLICIES)))
+
+        order = "accessed" if policy == "lru" else "hits, accessed"
+        rows = self.connections.connect().execute("SELECT key, size FROM access ORDER BY %s LIMIT ?" % order, (limit,))
+        return [(tuple(key.split("/")), size) for (key, size) in rows]
+
+
+class AccessBuffer(object):
+    """
+    Collects the keys of entries that have been hit, and passes them on to ``touch`` (a function
+    of a list of keys, such as ``AccessIndex.touchMany``) in batches of ACCESS_FLUSH_SIZE keys,
+    or when the oldest hit is ACCESS_FLUSH_INTERVAL seconds old, instead of on every hit.
+    """
+
+    def __init__(self, touch):
+        self.touch = touch
+        self._keys = set()
+        self._since = time.time()
+        self._lock = threading.Lock()
+        _access_buffers.add(self)
+
+    def addMany(self, keys):
+        "Records a hit for each of ``keys``, passing on the batch if it is due."
+        now = time.time()
+
+        with self._lock:
+            if not self._keys:
+                self._since = now
+
+            self._keys.update(keys)
+            due = len(self._keys) >= ACCESS_FLUSH_SIZE or \
+                (self._keys and now - self._since > ACCESS_FLUSH_INTERVAL)
+
+        if due:
+            self.flush()
+
+    def discardMany(self, keys):
+        "Forgets the hits of ``keys`` (e.g. of deleted entries)."
+        with self._lock:
+            self._keys.difference_update(keys)
+
+    def flush(self):
+        "Passes on the hits recorded so far."
+        with self._lock:
+            (keys, self._keys) = (list(self._keys), set())
+
+        if keys:
+            self.touch(keys)
+
+
+# All AccessBuffers. Their hits are passed on when the process exits. A forked process starts
+# with empty buffers (the hits are the parent's), and new locks, as a lock may have been held
+# by another thread of the parent when it forked.
+_access_buffers = weakref.WeakSet()
+
+
+def _flushAccessBuffers():
+    for buffer in list(_access_buffers):
+        try:
+            buffer.flush()
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Cannot record cache hits in the access index: %s" % err)
+
+
+def _resetAccessBuffers():
+    for buffer in list(_access_buffers):
+        (buffer._keys, buffer._lock) = (set(), threading.Lock())
+
+
+atexit.register(_flushAccessBuffers)
+os.register_at_fork(after_in_child=_resetAccessBuffers)
+
+
+class CacheBackend(object):
+    """
+    Base class for cache backends. Keys are tuples of strings and data are bytes; entries
+    that are not in the cache are returned as None.
+    """
+
+    def get(self, key):
+        "Returns the data for ``key``, or None."
+        return self.getMany([key])[0]
+
+    def getMany(self, keys):
+        "Returns a list of the data (or None) for each of ``keys``."
+        raise NotImplementedError
+
+    def put(self, key, data):
+        "Writes ``data`` to the cache for ``key``."
+        self.putMany([(key, data)])
+
+    def putMany(self, items):
+        "Writes each of ``items`` (a list of (key, data)) to the cache."
+        raise NotImplementedError
+
+    def delete(self, key):
+        "Removes ``key`` from the cache (if it is there)."
+        self.deleteMany([key])
+
+    def deleteMany(self, keys):
+        "Removes each of ``keys`` from the cache (if they are there)."
+        raise NotImplementedError
+
+    def items(self):
+        "Yields (key, data) for every entry in the cache."
+        raise NotImplementedError
+
+    def touchMany(self, keys):
+        "Records a hit for each of ``keys`` (that were read elsewhere, e.g. from memory)."
+        self.access.touchMany(keys)
+
+    def getUsage(self):
+        "Returns a dictionary of the number of entries, their total size and the oldest access time."
+        return self.access.getUsage()
+
+    def getVictims(self, policy, limit):
+        "Returns a list of (key, size) of up to ``limit`` entries to evict first under the ``policy``."
+        return self.access.getVictims(policy, limit)
+
+    def reindexAccess(self):
+        """
+        Brings the access index up to date with the entries in the cache, e.g. for entries
+        written by older versions. Returns the number of entries added to the index.
+        """
+        raise NotImplementedError
+
+    def lockKeys(self, lock_dir, keys, timeout=600.):
+        "Returns a context manager that holds an exclusive lock on each of ``keys`` (see: ``lockKeys``)."
+        return lockKeys(lock_dir, keys, timeout=timeout)
+
+
+class FileSystemBackend(CacheBackend):
+    """
+    Stores each entry as a file called ``file_name`` in the directory:
+
+        <cache_dir>/<facet 1>/<facet 2>/.../<facet n>
+
+    where ``depth`` is the number of facets in a key.
+
+    Hits are recorded in the access index in batches (see: ``AccessBuffer``), which are passed
+    on before the index is read.
+    """
+
+    def __init__(self, cache_dir, file_name, depth):
+        self.cache_dir = cache_dir
+        self.file_name = file_name
+        self.depth = depth
+        self.access = AccessIndex(SQLiteConnections(os.path.join(cache_dir, ACCESS_FILE_NAME), AccessIndex.SCHEMA))
+        self.touched = AccessBuffer(self.access.touchMany)
+
+    def _getPath(self, key):
+        return os.path.join(self.cache_dir, "/".join(key), self.file_name)
+
+    def getMany(self, keys):
+        results = []
+
+        for key in keys:
+            fpath = self._getPath(key)
+
+            if not os.path.isfile(fpath):
+                results.append(None)
+                continue
+
+            logger.info("Extracting data from cache file: %s" % fpath)
+
+            try:
+                with open(fpath, "rb") as reader:
+                    results.append(reader.read())
+            except OSError as err:
+                # E.g. a file removed by a concurrent clean up of the cache
+                logger.warning("Cannot read cache file: %s (%s)" % (fpath, err))
+                results.append(None)
+
+        self.touched.addMany([key for (key, data) in zip(keys, results) if data is not None])
+        return results
+
+    def putMany(self, items):
+        written = []
+
+        for (key, data) in items:
+            fpath = self._getPath(key)
+            logger.info("Writing cache file: %s" % fpath)
+
+            self._writeFile(fpath, data)
+            written.append((key, len(data), time.time()))
+
+        if written:
+            self.access.recordMany(written)
+
+    def _writeFile(self, fpath, content):
+        "Writes ``content`` to a temporary file and renames it, so that readers never see a partial file."
+        dr = os.path.dirname(fpath)
+        tmp_path = "%s.%d.%d.tmp" % (fpath, os.getpid(), threading.get_ident())
+
+        # The directory can be removed by a concurrent clean up of the cache, so try again once
+        for attempt in range(2):
+            if not os.path.isdir(dr):
+                logger.info("Creating cache directories: %s" % dr)
+                os.makedirs(dr, exist_ok=True)
+
+            try:
+                with open(tmp_path, "wb") as writer:
+                    writer.write(content)
+
+                os.replace(tmp_path, fpath)
+                return
+            except FileNotFoundError:
+                if attempt:
+                    raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def deleteMany(self, keys):
+        for key in keys:
+            fpath = self._getPath(key)
+            logger.warn("Deleting cache file: %s" % fpath)
+
+            if os.path.isfile(fpath):
+                os.remove(fpath)
+
+            self._removeEmptyDirs(os.path.dirname(fpath))
+
+        self.touched.discardMany(keys)
+        self.access.removeMany(keys)
+
+    def _removeEmptyDirs(self, dr):
+        "Removes ``dr`` and its parents (below the cache directory) while they are empty."
+        while os.path.abspath(dr) != os.path.abspath(self.cache_dir):
+            try:
+                os.rmdir(dr)
+            except OSError:
+                return
+
+            dr = os.path.dirname(dr)
+
+    def _walk(self):
+        "Yields (key, path) for every entry in the cache."
+        for (dr, subdirs, files) in os.walk(self.cache_dir):
+            subdirs.sort()
+            key = tuple(os.path.relpath(dr, self.cache_dir).split(os.sep))
+
+            if len(key) == self.depth and self.file_name in files:
+                yield (key, os.path.join(dr, self.file_name))
+
+    def items(self):
+        for (key, fpath) in self._walk():
+            with open(fpath, "rb") as reader:
+                yield (key, reader.read())
+
+    def getUsage(self):
+        self.touched.flush()
+        return self.access.getUsage()
+
+    def getVictims(self, policy, limit):
+        self.touched.flush()
+        return self.access.getVictims(policy, limit)
+
+    def reindexAccess(self):
+        self.touched.flush()
+        indexed = self.access.keys()
+        found = set()
+        missing = []
+
+        for (key, fpath) in self._walk():
+            found.add(key)
+
+            if key not in indexed:
+                stat = os.stat(fpath)
+                missing.append((key, stat.st_size, stat.st_mtime))
+
+        self.access.recordMany(missing)
+        self.access.removeMany(indexed - found)
+        return len(missing)
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Stores all entries in a single SQLite database at ``path``, in a table of
+    (key, data) where the key is the facet values joined with "/". The access index
+    is held in the same database.
+
+    The database is used in WAL mode, so that readers in other processes are not
+    blocked while an entry is written. Each thread (and process) has its own connection.
+    """
+
+    def __init__(self, path, timeout=30.):
+        self.path = path
+        schema = ["CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, data BLOB NOT NULL)"] + AccessIndex.SCHEMA
+        self.connections = SQLiteConnections(path, schema, timeout=timeout)
+        self.access = AccessIndex(self.connections)
+
+    def getMany(self, keys):
+        conn = self.connections.connect()
+        keys = ["/".join(key) for key in keys]
+        found = {}
+
+        for batch in _batches(keys):
+            query = "SELECT key, data FROM cache WHERE key IN (%s)" % ",".join(["?"] * len(batch))
+            found.update(conn.execute(query, batch).fetchall())
+
+        if found:
+            self.access.touchMany([tuple(key.split("/")) for key in found])
+
+        return [found.get(key) for key in keys]
+
+    def putMany(self, items):
+        conn = self.connections.connect()
+        now = time.time()
+
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO cache (key, data) VALUES (?, ?)",
+                             [("/".join(key), data) for (key, data) in items])
+            self.access.recordMany([(key, len(data), now) for (key, data) in items], conn=conn)
+
+    def deleteMany(self, keys):
+        conn = self.connections.connect()
+
+        with conn:
+            for key in keys:
+                logger.warn("Deleting cache entry: %s" % "/".join(key))
+                conn.execute("DELETE FROM cache WHERE key = ?", ("/".join(key),))
+
+            self.access.removeMany(keys, conn=conn)
+
+    def items(self):
+        for (key, data) in self.connections.connect().execute("SELECT key, data FROM cache ORDER BY key"):
+            yield (tuple(key.split("/")), data)
+
+    def reindexAccess(self):
+        conn = self.connections.connect()
+
+        with conn:
+            added = conn.execute("INSERT OR IGNORE INTO access (key, size, accessed) "
+                                 "SELECT key, LENGTH(data), ? FROM cache", (time.time(),)).rowcount
+            conn.execute("DELETE FROM access WHERE key NOT IN (SELECT key FROM cache)")
+
+        return added
+
+
+class MemoryTier(CacheBackend):
+    """
+    An in-process LRU tier in front of another ``backend``. Reads go to memory first and
+    then to the backend; writes go to both.
+
+    Entries are held as the (immutable) bytes stored in the backend. The least recently
+    used entries are evicted when their total size exceeds ``max_bytes``, and entries expire
+    ``ttl`` seconds after they were stored (if ``ttl`` is set).
+
+    Hits in memory are passed on to the access index of the backend in batches.
+    """
+
+    def __init__(self, backend, max_bytes, ttl=0):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # Ordered Dictionary of {key: (expiry time, data)}
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        # Keys hit in memory, passed on to the access index of the backend in batches
+        self.touched = AccessBuffer(self.backend.touchMany)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def _remove(self, key):
+        "Removes ``key`` from memory. Must be called with the lock held."
+        (expiry, data) = self._entries.pop(key)
+        self._nbytes -= len(data)
+
+    def _store(self, items):
+        "Stores each of ``items`` (a list of (key, data)) in memory, evicting old entries as needed."
+        expiry = time.time() + self.ttl if self.ttl else float("inf")
+
+        with self._lock:
+            for (key, data) in items:
+                if key in self._entries:
+                    self._remove(key)
+
+                if len(data) > self.max_bytes:
+                    continue
+
+                self._entries[key] = (expiry, data)
+                self._nbytes += len(data)
+
+            while self._nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def getMany(self, keys):
+        results = [None] * len(keys)
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            for (i, key) in enumerate(keys):
+                entry = self._entries.get(key)
+
+                if entry and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    found[i] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry:
+                        self._remove(key)
+                    self.misses += 1
+
+        self.touched.addMany([keys[i] for i in found])
+
+        for (i, data) in found.items():
+            results[i] = data
+
+        missing = [i for i in range(len(keys)) if i not in found]
+
+        if missing:
+            loaded = []
+
+            for (i, data) in zip(missing, self.backend.getMany([keys[i] for i in missing])):
+                results[i] = data
+                if data is not None:
+                    loaded.append((keys[i], data))
+
+            self._store(loaded)
+
+        return results
+
+    def putMany(self, items):
+        self.backend.putMany(items)
+        self._store(items)
+
+    def deleteMany(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+        self.touched.discardMany(keys)
+        self.backend.deleteMany(keys)
+
+    def items(self):
+        return self.backend.items()
+
+    def touchMany(self, keys):
+        self.backend.touchMany(keys)
+
+    def getUsage(self):
+        return self.backend.getUsage()
+
+    def getVictims(self, policy, limit):
+        return self.backend.getVictims(policy, limit)
+
+    def reindexAccess(self):
+        return self.backend.reindexAccess()
+
+    def lockKeys(self, lock_dir, keys, timeout=600.):
+        return self.backend.lockKeys(lock_dir, keys, timeout=timeout)
+
+
+class Snapshot(object):
+    """
+    An open snapshot file (see: ``writeSnapshot``), memory-mapped for reading. The file is laid out as:
+
+        <header> <data of each entry> <key of each entry> <index record of each entry>
+
+    where the keys (the facet values joined with "/", in UTF-8) and the index are sorted by key.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as reader:
+            self.map = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < SNAPSHOT_HEADER.size:
+            raise Exception("Not a cache snapshot: %s" % path)
+
+        (magic, snapshot_format, self.version, self.count, self.index_offset) = SNAPSHOT_HEADER.unpack_from(self.map)
+
+        if magic != SNAPSHOT_MAGIC or snapshot_format != SNAPSHOT_FORMAT:
+            raise Exception("Not a cache snapshot of format %d: %s" % (SNAPSHOT_FORMAT, path))
+
+        self.view = memoryview(self.map)
+
+        # The keys follow the data, and the first key in the index is the first one written
+        keys_offset = self._getRecord(0)[0] if self.count else self.index_offset
+        self.nbytes = keys_offset - SNAPSHOT_HEADER.size
+
+    def _getRecord(self, i):
+        "Returns the index record (key offset, key length, data offset, data length) of the ``i``th entry."
+        return SNAPSHOT_RECORD.unpack_from(self.map, self.index_offset + i * SNAPSHOT_RECORD.size)
+
+    def find(self, key):
+        "Returns a (zero-copy) memoryview of the data of ``key`` (the encoded key), or None."
+        (low, high) = (0, self.count)
+
+        while low < high:
+            middle = (low + high) // 2
+            (key_offset, key_size, data_offset, data_size) = self._getRecord(middle)
+
+            if self.map[key_offset:key_offset + key_size] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.count:
+            (key_offset, key_size, data_offset, data_size) = self._getRecord(low)
+
+            if self.map[key_offset:key_offset + key_size] == key:
+                return self.view[data_offset:data_offset + data_size]
+
+        return None
+
+    def items(self):
+        "Yields (key, data) for every entry, in the order of the keys."
+        for i in range(self.count):
+            (key_offset, key_size, data_offset, data_size) = self._getRecord(i)
+            yield (tuple(self.map[key_offset:key_offset + key_size].decode("utf-8").split("/")),
+                   self.view[data_offset:data_offset + data_size])
+
+
+class SnapshotBackend(CacheBackend):
+    """
+    A read-only backend of the entries of a snapshot file (see: ``writeSnapshot``). ``path`` is
+    usually the "current" link of a snapshot directory: it is checked at most every
+    SNAPSHOT_CHECK_INTERVAL seconds, and a new snapshot is opened as soon as the link is replaced.
+    Data already returned from the previous snapshot stays valid.
+
+    Entries are found with a binary search of the index, and their data are returned as zero-copy
+    memoryviews of the map. Writes are ignored, and no locks are taken: entries missing from
+    the snapshot are extracted for every request.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._snapshot = None
+        self._checked = 0.
+        self._lock = threading.Lock()
+
+    def getSnapshot(self):
+        "Returns the current Snapshot, opening it if it has been replaced since it was last checked."
+        with self._lock:
+            now = time.time()
+
+            if self._snapshot is None or now - self._checked >= SNAPSHOT_CHECK_INTERVAL:
+                self._checked = now
+                path = os.path.realpath(self.path)
+
+                if not os.path.isfile(path):
+                    raise Exception("No cache snapshot found at: %s" % self.path)
+
+                if self._snapshot is None or self._snapshot.path != path:
+                    logger.info("Opening cache snapshot: %s" % path)
+                    self._snapshot = Snapshot(path)
+
+            return self._snapshot
+
+    def getMany(self, keys):
+        snapshot = self.getSnapshot()
+        return [snapshot.find("/".join(key).encode("utf-8")) for key in keys]
+
+    def putMany(self, items):
+        pass
+
+    def deleteMany(self, keys):
+        raise Exception("Cannot delete entries from a cache snapshot: %s" % self.path)
+
+    def items(self):
+        return self.getSnapshot().items()
+
+    def touchMany(self, keys):
+        pass
+
+    def getUsage(self):
+        snapshot = self.getSnapshot()
+        return {"entries": snapshot.count, "bytes": snapshot.nbytes, "oldest_access": None}
+
+    def getVictims(self, policy, limit):
+        return []
+
+    def reindexAccess(self):
+        return 0
+
+    @contextmanager
+    def lockKeys(self, lock_dir, keys, timeout=600.):
+        # Nothing is written to a snapshot, so there is nothing to lock (and the lock directory may be read-only)
+        yield
+
+
+def _getSnapshotVersions(snapshot_dir):
+    "Returns a sorted list of the versions of the snapshot files in ``snapshot_dir``."
+    (prefix, suffix) = SNAPSHOT_FILE_TEMPLATE.split("%06d")
+    versions = []
+
+    for file_name in os.listdir(snapshot_dir):
+        version = file_name[len(prefix):-len(suffix)]
+
+        if file_name.startswith(prefix) and file_name.endswith(suffix) and version.isdigit():
+            versions.append(int(version))
+
+    return sorted(versions)
+
+
+def writeSnapshot(source, snapshot_dir, keep=2):
+    """
+    Writes every entry of the ``source`` backend to a new snapshot file in ``snapshot_dir``
+    and makes it the current snapshot. Returns the path of the snapshot file.
+
+    Snapshots are never modified: each one is a new version, written to a temporary file and
+    renamed. The "current" link is then replaced, so that readers switch to it atomically.
+    All but the ``keep`` latest versions are removed (readers that have an older version open
+    keep reading it until they switch).
+    """
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+
+    version = (_getSnapshotVersions(snapshot_dir) or [0])[-1] + 1
+    path = os.path.join(snapshot_dir, SNAPSHOT_FILE_TEMPLATE % version)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+
+    # The data are written as they are read; only the keys and offsets are held, to be sorted
+    index = []
+
+    with open(tmp_path, "wb") as writer:
+        writer.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, version, 0, 0))
+        offset = SNAPSHOT_HEADER.size
+
+        for (key, data) in source.items():
+            writer.write(data)
+            index.append(("/".join(key).encode("utf-8"), offset, len(data)))
+            offset += len(data)
+
+        index.sort()
+        records = []
+
+        for (key, data_offset, data_size) in index:
+            writer.write(key)
+            records.append(SNAPSHOT_RECORD.pack(offset, len(key), data_offset, data_size))
+            offset += len(key)
+
+        writer.write(b"".join(records))
+        writer.seek(0)
+        writer.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, version, len(index), offset))
+        writer.flush()
+        os.fsync(writer.fileno())
+
+    os.rename(tmp_path, path)
+
+    link = os.path.join(snapshot_dir, SNAPSHOT_LINK_NAME)
+    tmp_link = "%s.%d.tmp" % (link, os.getpid())
+    os.symlink(os.path.basename(path), tmp_link)
+    os.replace(tmp_link, link)
+
+    for old_version in _getSnapshotVersions(snapshot_dir):
+        if old_version <= version - keep:
+            os.remove(os.path.join(snapshot_dir, SNAPSHOT_FILE_TEMPLATE % old_version))
+
+    return path
+
+
+def _lockFile(fd, deadline):
+    "Takes an exclusive lock on the open file ``fd``, waiting until the ``deadline``. Returns True if it is locked."
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.time() > deadline:
+                return False
+
+            time.sleep(LOCK_POLL_INTERVAL)
+
+
+@contextmanager
+def lockKeys(lock_dir, keys, timeout=600.):
+    """
+    Context manager that holds an exclusive ``fcntl`` lock for each of ``keys`` in ``lock_dir``.
+
+    Keys are hashed to one of ``LOCK_STRIPES`` lock files, which are locked in order so that
+    workers locking overlapping keys can not deadlock. Locks are held on an open file, so they
+    exclude threads of the same process too, and are released if a worker dies. If the locks
+    are not acquired within ``timeout`` seconds, a warning is logged and the body runs without
+    the remaining locks.
+    """
+    stripes = sorted(set([int(hashlib.sha1("/".join(key).encode()).hexdigest(), 16) % LOCK_STRIPES for key in keys]))
+
+    if stripes and not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+
+    deadline = time.time() + timeout
+    fds = []
+
+    try:
+        for stripe in stripes:
+            fd = os.open(os.path.join(lock_dir, "%04d.lock" % stripe), os.O_RDWR | os.O_CREAT, 0o666)
+
+            if not _lockFile(fd, deadline):
+                os.close(fd)
+                logger.warning("Timed out waiting for cache locks in: %s" % lock_dir)
+                break
+
+            fds.append(fd)
+
+        yield
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _createRedisBackend(cache_dir, file_name, depth):
+    "Returns a RedisBackend for the cache, on the server at the ``cache_url`` option."
+    # Imported here, as the network backend is built on this module
+    from network_cache import RedisBackend
+    from settings import getSetting
+
+    return RedisBackend(getSetting("cache_url", "redis://localhost:6379/0"),
+                        "housemartin:%s" % os.path.basename(cache_dir.rstrip("/")))
+
+
+# Ordered Dictionary of {kind: factory} of the cache backends, where each factory is called with
+# (cache_dir, file_name, depth)
+_backend_factories = OrderedDict([
+    ("filesystem", FileSystemBackend),
+    ("sqlite", lambda cache_dir, file_name, depth: SQLiteBackend(os.path.join(cache_dir, SQLITE_FILE_NAME))),
+    ("snapshot", lambda cache_dir, file_name, depth:
+        SnapshotBackend(os.path.join(cache_dir, SNAPSHOT_DIR_NAME, SNAPSHOT_LINK_NAME))),
+    ("redis", _createRedisBackend)])
+
+
+def registerCacheBackend(kind, factory):
+    """
+    Registers a ``factory`` that returns a new backend (a CacheBackend) when called with the
+    (cache_dir, file_name, depth) of a cache, so that it can be selected as the ``kind`` of backend.
+    """
+    _backend_factories[kind] = factory
+
+
+def createCacheBackend(kind, cache_dir, file_name, depth):
+    """
+    Returns a new backend of the given ``kind`` (such as "filesystem", "sqlite", "snapshot" or "redis")
+    for the cache in ``cache_dir``. See ``FileSystemBackend`` for ``file_name`` and ``depth``.
+    """
+    if kind not in _backend_factories:
+        raise Exception("Unknown cache backend: '%s'. Must be one of: %s." % (kind, ", ".join(_backend_factories)))
+
+    return _backend_factories[kind](cache_dir, file_name, depth)
+
+
+# Process-wide backends, keyed by (kind, cache directory)
+_cache_backends = {}
+_cache_backends_lock = threading.Lock()
+
+
+def getCacheBackend(kind, cache_dir, file_name, depth, memory_size=0, memory_ttl=0):
+    """
+    Returns the process-wide backend of the given ``kind`` for the cache in ``cache_dir``.
+    If ``memory_size`` (in bytes) is set, the backend is fronted by a MemoryTier of that
+    size, whose entries expire after ``memory_ttl`` seconds (if set).
+    """
+    with _cache_backends_lock:
+        key = (kind, cache_dir, memory_size, memory_ttl)
+
+        if key not in _cache_backends:
+            backend = createCacheBackend(kind, cache_dir, file_name, depth)
+
+            if memory_size:
+                backend = MemoryTier(backend, memory_size, ttl=memory_ttl)
+
+            _cache_backends[key] = backend
+
+        return _cache_backends[key]
+
+
+def resetAfterFork():
+    """
+    Replaces the locks of the process-wide backends (and their memory tiers) inherited from the
+    parent process. The entries held in memory are kept. Must be called at the start of a forked
+    worker process.
+    """
+    global _cache_backends_lock
+    _cache_backends_lock = threading.Lock()
+
+    for backend in _cache_backends.values():
+        while isinstance(backend, (MemoryTier, SnapshotBackend)):
+            backend._lock = threading.Lock()
+            backend = getattr(backend, "backend", None)
+
+
+def collectGarbage(backend, lock_dir, max_bytes=0, max_entries=0, policy="lru", batch_size=100, pause=0.,
+                   lock_timeout=600.):
+    """
+    Evicts entries from the ``backend`` under the eviction ``policy`` ("lru" or "lfu") until
+    it is within the budget of ``max_bytes`` and ``max_entries`` (0 for no limit).
+
+    Entries are evicted in batches of ``batch_size``, each in a short transaction, with a
+    ``pause`` (in seconds) between batches, so that live requests are not blocked. The locks
+    of the keys of a batch (in ``lock_dir``, see: ``lockKeys``) are held while it is deleted,
+    so that entries are not deleted while a worker that holds them is writing them.
+    Returns a tuple of (number of entries evicted, bytes freed).
+    """
+    usage = backend.getUsage()
+    (entries, nbytes) = (usage["entries"], usage["bytes"])
+    (evicted, freed) = (0, 0)
+
+    def overBudget():
+        return (max_bytes and nbytes > max_bytes) or (max_entries and entries > max_entries)
+
+    while overBudget():
+        victims = []
+
+        for (key, size) in backend.getVictims(policy, batch_size):
+            if not overBudget():
+                break
+
+            victims.append(key)
+            (entries, nbytes) = (entries - 1, nbytes - size)
+            freed += size
+
+        if not victims:
+            break
+
+        with backend.lockKeys(lock_dir, sorted(victims), timeout=lock_timeout):
+            backend.deleteMany(victims)
+
+        evicted += len(victims)
+
+        if pause:
+            time.sleep(pause)
+
+    return (evicted, freed)
+
+
+def migrateCache(source, target, batch_size=SQLITE_BATCH_SIZE):
+    "Copies every entry of the ``source`` backend to the ``target`` backend. Returns the number of entries copied."
+    count = 0
+    batch = []
+
+    for item in source.items():
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            target.putMany(batch)
+            count += len(batch)
+            batch = []
+
+    if batch:
+        target.putMany(batch)
+        count += len(batch)
+
+    return count
@@ -0,0 +1,275 @@
+"""
+cache_warmup.py
+===============
+
+Populates the climate stats caches for a list of assets ahead of any requests (see:
+``housemartin warm-cache``).
+
+The assets are first deduplicated by grid box (as they are keyed in the caches), so
+each grid box is extracted once however many assets share it. The work is then split
+into units, which are run across a process pool:
+
+ * "summary" units: a batch of grid boxes for one (time_period, experiment), extracted
+   together as for a GetClimateStats request, so each stats file is read once per batch.
+ * "full" units: the full summary record of one grid box, as for GetFullClimateStats.
+
+Each grid box of a completed unit is appended to a checkpoint file as an entry such as
+"summary/Global/rcp45/2035/51.5/0.5", so an interrupted warm-up resumes where it stopped.
+Units that could not read a stats file are not checkpointed, so they are retried by the
+next warm-up.
+
+"""
+
+# Standard library imports
+import os
+import time
+import logging
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Local imports
+import lib
+from lib import ClimateStatsExtractor, FULL_SUMMARY_SCENARIOS, _initSummaryWorker
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("summary", "full")
+DOMAIN_TYPES = ("Global", "Regional")
+
+# A unit of work: ``scenario`` is the (time_period, experiment) of a "summary" unit (None for "full"),
+# ``entries`` the checkpoint entries of its grid boxes and ``locations`` a location in each grid box
+WarmupUnit = namedtuple("WarmupUnit", ["kind", "domain_type", "scenario", "entries", "locations"])
+
+
+def readAssets(path):
+    """
+    Returns a list of location strings ("<asset_id>,<lat>,<lon>") for the assets in ``path``,
+    a whitespace-separated file of "LAT LON" lines (with a header line). Assets are numbered
+    in the order of the file.
+    """
+    locations = []
+
+    with open(path) as reader:
+        for line in reader:
+            items = line.split()
+            if not items or items[0].upper() == "LAT":
+                continue
+
+            (lat, lon) = items
+            locations.append("%03d,%s,%s" % (len(locations) + 1, lat, lon))
+
+    return locations
+
+
+def _getEntry(kind, domain_type, scenario, grid_box):
+    "Returns the checkpoint entry of a grid box."
+    facets = [kind, domain_type] + ([scenario[1], scenario[0]] if scenario else []) + \
+        ["%s" % value for value in grid_box]
+    return "/".join(facets)
+
+
+def getGridBoxes(locations, domain_type):
+    """
+    Returns an Ordered Dictionary of {(lat, lon): location} of the distinct grid boxes of
+    ``locations`` for the domain type, as they are keyed in the caches. Locations that are not
+    in any regional domain are left out of the "Regional" grid boxes.
+    """
+    grid_boxes = OrderedDict()
+
+    for location in locations:
+        grid_box = location.global_gb if domain_type == "Global" else location.regional_gb
+
+        if grid_box == (None, None):
+            continue
+        grid_boxes.setdefault(tuple(grid_box), location)
+
+    return grid_boxes
+
+
+def planWarmup(locations, scenarios=FULL_SUMMARY_SCENARIOS, kinds=KINDS, batch_size=50, done=()):
+    """
+    Returns a list of the WarmupUnits needed to warm the caches for ``locations``, for each of
+    ``scenarios`` (a list of (time_period, experiment)) and ``kinds`` of cache. Grid boxes that
+    have an entry in ``done`` (see: ``Checkpoint``) are skipped.
+
+    The "summary" units come first: a grid box whose full summary is cached serves GetClimateStats
+    from that record, so it would not be extracted (and cached) for the summary cache afterwards.
+    """
+    done = set(done)
+    units = []
+
+    for kind in [kind for kind in KINDS if kind in kinds]:
+        for domain_type in DOMAIN_TYPES:
+            grid_boxes = getGridBoxes(locations, domain_type)
+
+            if kind == "full":
+                for (grid_box, location) in grid_boxes.items():
+                    entry = _getEntry(kind, domain_type, None, grid_box)
+
+                    if entry not in done:
+                        units.append(WarmupUnit(kind, domain_type, None, [entry], [location]))
+
+                continue
+
+            for scenario in scenarios:
+                pending = [(_getEntry(kind, domain_type, scenario, grid_box), location)
+                           for (grid_box, location) in grid_boxes.items()]
+                pending = [(entry, location) for (entry, location) in pending if entry not in done]
+
+                for start in range(0, len(pending), batch_size):
+                    batch = pending[start:start + batch_size]
+                    units.append(WarmupUnit(kind, domain_type, tuple(scenario), [entry for (entry, location) in batch],
+                                            [location for (entry, location) in batch]))
+
+    return units
+
+
+class Checkpoint(object):
+    """
+    The entries of the grid boxes that have been warmed, in a file of one entry per line.
+    Entries are appended (and flushed) as units complete, so the file survives an interruption.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+        if os.path.isfile(path):
+            with open(path) as reader:
+                self.done = set([line.strip() for line in reader if line.strip()])
+
+    def __len__(self):
+        return len(self.done)
+
+    def record(self, entries):
+        "Appends ``entries`` to the checkpoint file."
+        with open(self.path, "a") as writer:
+            writer.write("".join([entry + "\n" for entry in entries]))
+            writer.flush()
+            os.fsync(writer.fileno())
+
+        self.done.update(entries)
+
+    def clear(self):
+        "Removes the checkpoint file, so that all grid boxes are warmed again."
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+        self.done = set()
+
+
+class WarmupStats(object):
+    "Progress and throughput of a warm-up."
+
+    def __init__(self, total_units):
+        self.total_units = total_units
+        self.completed_units = 0
+        self.failed_units = 0
+        self.grid_boxes = 0
+        self.read_errors = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        "Grid boxes warmed per second."
+        return self.grid_boxes / self.elapsed if self.elapsed > 0 else 0.
+
+    @property
+    def remaining(self):
+        "Estimated seconds until all units are complete (None until a unit has completed)."
+        finished = self.completed_units + self.failed_units
+        if not finished:
+            return None
+
+        return self.elapsed / finished * (self.total_units - finished)
+
+
+def _warmUnit(unit):
+    """
+    Populates the cache for the grid boxes of ``unit``. Returns a tuple of (read_errors, seconds)
+    where ``read_errors`` is the number of stats files that could not be read.
+    """
+    extractor = _getWarmupExtractor()
+    (read_errors, start) = (extractor.read_errors, time.time())
+
+    if unit.kind == "summary":
+        (time_period, experiment) = unit.scenario
+        extractor.getSummaryRecords(unit.domain_type, experiment, time_period, unit.locations)
+    else:
+        extractor.getFullRecord(unit.domain_type, unit.locations[0])
+
+    return (extractor.read_errors - read_errors, time.time() - start)
+
+
+def _getWarmupExtractor():
+    """
+    Returns the extractor used to warm the caches in this process: the one created by
+    ``_initSummaryWorker`` in a worker process, or else one created on first use.
+    """
+    if lib._summary_extractor is None:
+        lib._summary_extractor = ClimateStatsExtractor()
+
+    # Stale entries are re-extracted, not served
+    lib._summary_extractor.serve_stale = False
+    return lib._summary_extractor
+
+
+def runWarmup(units, checkpoint, processes=0, progress=None):
+    """
+    Runs each of ``units`` across ``processes`` worker processes (or in this process if 0),
+    recording the grid boxes of each completed unit in the ``checkpoint``. Calls
+    ``progress(stats, unit, read_errors)`` as each unit completes. Returns the WarmupStats.
+    """
+    stats = WarmupStats(len(units))
+
+    def complete(unit, read_errors, failed=False):
+        stats.read_errors += read_errors
+
+        # Units that are missing values were not cached, so are retried by the next warm-up
+        if read_errors or failed:
+            stats.failed_units += 1
+        else:
+            stats.completed_units += 1
+            stats.grid_boxes += len(unit.entries)
+            checkpoint.record(unit.entries)
+
+        if progress:
+            progress(stats, unit, read_errors)
+
+    if processes == 0:
+        for unit in units:
+            try:
+                (read_errors, seconds) = _warmUnit(unit)
+            except Exception as err:
+                logger.error("Cannot warm the cache for: %s (%s)" % (", ".join(unit.entries), err))
+                complete(unit, 0, failed=True)
+                continue
+
+            complete(unit, read_errors)
+
+        return stats
+
+    # Fork so that workers inherit the configuration (and any overridden class settings)
+    context = multiprocessing.get_context("fork")
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_initSummaryWorker) as executor:
+        futures = dict((executor.submit(_warmUnit, unit), unit) for unit in units)
+
+        for future in as_completed(futures):
+            unit = futures[future]
+
+            try:
+                (read_errors, seconds) = future.result()
+            except Exception as err:
+                logger.error("Cannot warm the cache for: %s (%s)" % (", ".join(unit.entries), err))
+                complete(unit, 0, failed=True)
+                continue
+
+            complete(unit, read_errors)
+
+    return stats
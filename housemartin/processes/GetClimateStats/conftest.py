@@ -0,0 +1,181 @@
+import os
+import threading
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import netCDF4
+import xarray as xr
+import pytest
+
+import lib
+import grid_index
+import grid_lookup
+import point_reader
+import cache_backends
+from stale_refresh import getStaleRefresher
+
+
+# The axes of the stats files written to the test archive
+LATS = np.arange(-85., 90, 10)
+LONS = np.arange(5., 360, 10)
+
+FILE_TEMPLATE = "%(var_id)s_%(model)s_%(experiment)s_r1i1p1_%(meaning_period)s_%(statistic)s_change.nc"
+
+
+def writeStatsFile(fpath, var_id, data, **var_kwargs):
+    "Writes ``data`` (of shape (time, lat, lon)) to a stats file as variable ``var_id``."
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    ds = netCDF4.Dataset(fpath, "w")
+
+    for (dim, values) in (("time", np.arange(float(data.shape[0]))), ("lat", LATS), ("lon", LONS)):
+        ds.createDimension(dim, len(values))
+        ds.createVariable(dim, "f8", (dim,))[:] = values
+
+    ds["lat"].standard_name = "latitude"
+    ds["lon"].standard_name = "longitude"
+
+    var = ds.createVariable(var_id, data.dtype, ("time", "lat", "lon"), **var_kwargs)
+    var.set_auto_maskandscale(False)
+    var[:] = data
+    ds.close()
+
+
+def writeRefFile(fpath, lats, lons):
+    "Writes a grid reference file (of variable ``tas``) with the ``lats`` and ``lons`` axes."
+    ds = xr.Dataset({"tas": (("lat", "lon"), np.zeros((len(lats), len(lons)), dtype="f4"))},
+                    coords={"lat": ("lat", lats, {"standard_name": "latitude"}),
+                            "lon": ("lon", lons, {"standard_name": "longitude"})})
+    ds.to_netcdf(fpath)
+
+
+def makeLocation(global_gb, regional_gbs=None):
+    "Returns a ``lib.Location`` requested at the global grid box, with the given grid boxes."
+    location = lib.Location.__new__(lib.Location)
+    (location.asset_id, location.requested) = ("%s,%s" % global_gb, list(global_gb))
+    location._setGridBoxes(global_gb, OrderedDict(regional_gbs or []))
+    return location
+
+
+@contextmanager
+def holdProcessLocks(extractor):
+    """
+    Context manager that holds the process-wide locks (and those of the caches of ``extractor``)
+    in another thread, as a thread of the server would while a worker process is forked.
+    """
+    locks = [lib._absent_files_lock, grid_index._grid_indexes_lock, grid_lookup._grid_lookups_lock,
+             point_reader._point_reader_lock, cache_backends._cache_backends_lock, getStaleRefresher().condition,
+             extractor.cache_stats.backend._lock, extractor.cache_full.backend._lock]
+    (held, done) = (threading.Event(), threading.Event())
+
+    def hold():
+        for lock in locks:
+            lock.acquire()
+
+        held.set()
+        done.wait()
+
+        for lock in locks:
+            lock.release()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+
+def runWithTimeout(func, timeout=60.):
+    """
+    Returns the result of ``func()``, failing the test if it takes longer than ``timeout`` seconds
+    (after terminating any worker processes, so that ``func`` does not wait for them forever).
+    """
+    results = []
+    thread = threading.Thread(target=lambda: results.append(func()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+
+    if thread.is_alive():
+        for child in multiprocessing.active_children():
+            child.terminate()
+
+        thread.join()
+
+    assert results, "Timed out (a worker process may be waiting for a lock inherited from this one)"
+    return results[0]
+
+
+class StatsArchive(object):
+    """
+    An archive of stats files (laid out as ``ClimateStatsExtractor.DIR_TEMPLATE``) in a temporary
+    directory. The value of each file at (time, lat, lon) is unique to the file and position.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = []
+
+    def getPath(self, domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period):
+        res = "1_deg" if domain_type == "Global" else "0.5_deg"
+        dr = os.path.join(self.root, domain_type.lower(), var_id, experiment, inst_model, time_period, res)
+        return os.path.join(dr, FILE_TEMPLATE % dict(locals(), model=inst_model.split("/")[-1]))
+
+    def write(self, domain_type, inst_model, experiment, time_period, var_id, statistic):
+        "Writes the monthly and annual stats files for the facets. Returns their paths."
+        paths = []
+
+        for (meaning_period, n_times) in (("mon", 12), ("ann", 1)):
+            fpath = self.getPath(domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period)
+            base = 1e6 * len(self.files)
+            data = base + np.arange(n_times)[:, None, None] + 100 * np.arange(len(LATS))[:, None] + \
+                10000 * np.arange(len(LONS))
+
+            writeStatsFile(fpath, var_id, data)
+            self.files.append(fpath)
+            paths.append(fpath)
+
+        return paths
+
+    def getValues(self, fpaths, gb):
+        "Returns the values at grid box ``gb`` (on the file axes) of the files at ``fpaths``."
+        (ilat, ilon) = (LATS.tolist().index(gb[0]), LONS.tolist().index(gb[1]))
+        values = []
+
+        for fpath in fpaths:
+            with netCDF4.Dataset(fpath) as ds:
+                var_id = [name for name in ds.variables if name not in ("time", "lat", "lon")][0]
+                values.extend(ds[var_id][:, ilat, ilon].tolist())
+
+        return values
+
+    def getExtractor(self, **settings):
+        "Returns a new ClimateStatsExtractor reading from the archive, with any of its ``settings`` overridden."
+        extractor = lib.ClimateStatsExtractor()
+
+        for (name, value) in settings.items():
+            setattr(extractor, name, value)
+
+        return extractor
+
+
+@pytest.fixture
+def stats_archive(tmp_path, monkeypatch):
+    """
+    Returns a StatsArchive in ``tmp_path``. The extractor and caches in ``lib`` are pointed at
+    it (and at caches in ``tmp_path``) for the duration of the test.
+    """
+    root = str(tmp_path / "data")
+    template = os.path.join(root, "%(dt)s/%(var_id)s/%(experiment)s/%(inst_model)s/%(time_period)s/%(res)s")
+
+    monkeypatch.setattr(lib.ClimateStatsExtractor, "DATA_DIR", root)
+    monkeypatch.setattr(lib.ClimateStatsExtractor, "DIR_TEMPLATE", template)
+    monkeypatch.setattr(lib.ClimateStatsCache, "CACHE_DIR", str(tmp_path / "summary"))
+    monkeypatch.setattr(lib.FullClimateStatsCache, "CACHE_DIR", str(tmp_path / "full"))
+    monkeypatch.setattr(lib, "_absent_files", {})
+
+    return StatsArchive(root)
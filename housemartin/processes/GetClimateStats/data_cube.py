@@ -0,0 +1,305 @@
+"""
+data_cube.py
+============
+
+A consolidated, chunked store of the climate stats for each domain ("Global" and
+each CORDEX domain), so that the full record of a grid box can be read in a handful
+of chunk reads instead of opening hundreds of ``*_change.nc`` files.
+
+Each domain is stored as a NetCDF4 file holding one variable with dimensions:
+
+    (experiment, time_period, model, variable, statistic, meaning_period, lat, lon)
+
+It is chunked with a single grid box per chunk for each experiment and time period,
+so a grid box's record for one experiment and time period is one contiguous chunk.
+Values are NaN where a stats file is missing or masked.
+
+"""
+
+# Standard library imports
+import os
+import shutil
+import logging
+import tempfile
+import threading
+
+# Third-party imports
+import numpy as np
+import netCDF4
+
+# Local imports
+import axis_utils
+from vocabs import vocabs
+import dataset_pool
+from dataset_pool import getDatasetPool, openXarrayDataset
+from file_catalog import StatsFileNotFound
+from roocs_utils.xarray_utils.xarray_utils import get_coord_by_type
+
+logger = logging.getLogger(__name__)
+
+CUBE_FILE_TEMPLATE = "stats_cube_%s.nc"
+CUBE_VARIABLE = "stats"
+
+EXPERIMENTS = ("rcp45", "rcp85")
+TIME_PERIODS = ("2035", "2055")
+
+# Approximate size (in bytes) of the blocks of latitude rows written to the cube
+WRITE_BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def getDomains():
+    "Returns a list of all domains: Global followed by the CORDEX domains."
+    domains = ["Global"]
+
+    for inst_model in vocabs.getAllModels("Regional"):
+        domain = inst_model.split("/")[1]
+        if domain not in domains:
+            domains.append(domain)
+
+    return domains
+
+
+def getCubeDimensions(domain):
+    "Returns a tuple of (domain_type, models, variables, statistics) for the cube of ``domain``."
+    if domain == "Global":
+        return ("Global", list(vocabs.getAllModels("Global")), list(vocabs.var_keys), list(vocabs.stats))
+
+    models = [inst_model for inst_model in vocabs.getAllModels("Regional") if inst_model.split("/")[1] == domain]
+    return ("Regional", models, list(vocabs.regional_variables), list(vocabs.stats))
+
+
+def _readStatsFile(fpath, var_id):
+    "Returns (lats, lons, values) from a stats file, where ``values`` has shape (time, lat, lon)."
+    ds = openXarrayDataset(fpath)
+
+    try:
+        with dataset_pool.NETCDF_LOCK:
+            da = ds[var_id]
+            lat_coord = get_coord_by_type(da, "latitude")
+            lon_coord = get_coord_by_type(da, "longitude")
+
+            dims = [dim for dim in da.dims if dim not in (lat_coord.name, lon_coord.name)]
+            da = da.transpose(*(dims + [lat_coord.name, lon_coord.name]))
+            values = da.values.reshape((-1, lat_coord.size, lon_coord.size))
+
+            return (lat_coord.values, lon_coord.values, values)
+    finally:
+        with dataset_pool.NETCDF_LOCK:
+            ds.close()
+
+
+def buildDataCube(domain, output_dir, getStatsFilePath):
+    """
+    Builds the data cube for ``domain`` in ``output_dir`` and returns its path.
+
+    ``getStatsFilePath`` returns the path of a stats file given the arguments
+    (domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period)
+    and raises StatsFileNotFound if there is no such file (see: ``ClimateStatsExtractor``).
+    Values from missing files are NaN; any other error stops the build.
+
+    Each stats file is read whole into a temporary array laid out like the stats files,
+    which is then written to the cube in blocks of latitude rows, so that every chunk
+    of the cube is written once.
+    """
+    (domain_type, models, variables, statistics) = getCubeDimensions(domain)
+    n_periods = len(vocabs.meaning_periods)
+    shape = (len(models), len(variables), len(statistics), n_periods)
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    path = os.path.join(output_dir, CUBE_FILE_TEMPLATE % domain)
+    tmp_path = path + ".tmp"
+    work_dir = tempfile.mkdtemp(dir=output_dir)
+
+    cube = axes = None
+    n_files = n_missing = 0
+
+    try:
+        for (ie, experiment) in enumerate(EXPERIMENTS):
+            for (it, time_period) in enumerate(TIME_PERIODS):
+                block = None
+
+                for (im, inst_model) in enumerate(models):
+                    for var_id in vocabs.getVariableList(domain_type, inst_model):
+                        if var_id not in variables:
+                            continue
+
+                        iv = variables.index(var_id)
+
+                        for statistic in vocabs.getStatsList(var_id):
+                            ist = statistics.index(statistic)
+
+                            for meaning_period in ("mon", "ann"):
+                                try:
+                                    fpath = getStatsFilePath(domain_type, inst_model, experiment, time_period,
+                                                             var_id, statistic, meaning_period)
+                                except StatsFileNotFound as err:
+                                    logger.warning("No stats file for cube: %s" % err)
+                                    n_missing += 1
+                                    continue
+
+                                (lats, lons, values) = _readStatsFile(fpath, var_id)
+                                n_files += 1
+
+                                if cube is None:
+                                    cube = _createCube(tmp_path, domain, models, variables, statistics, lats, lons)
+                                    axes = (lats, lons)
+                                elif not (np.array_equal(lats, axes[0]) and np.array_equal(lons, axes[1])):
+                                    raise Exception("Grid of '%s' does not match the other stats files in domain: %s" %
+                                                    (fpath, domain))
+
+                                if block is None:
+                                    block_path = os.path.join(work_dir, "block.npy")
+                                    block = np.lib.format.open_memmap(block_path, mode="w+", dtype="float32",
+                                                                      shape=shape + values.shape[1:])
+                                    block[:] = np.nan
+
+                                periods = slice(0, 12) if meaning_period == "mon" else slice(12, 13)
+                                block[im, iv, ist, periods] = values
+
+                if block is not None:
+                    _writeBlock(cube, ie, it, block)
+                    del block
+
+        if cube is None:
+            raise Exception("No stats files found for domain: %s" % domain)
+
+        cube.close()
+        cube = None
+        os.replace(tmp_path, path)
+    finally:
+        if cube is not None:
+            cube.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.info("Wrote data cube for %s from %d files (%d missing): %s" % (domain, n_files, n_missing, path))
+    return path
+
+
+def _createCube(path, domain, models, variables, statistics, lats, lons):
+    "Creates and returns an (open) empty cube file at ``path``."
+    cube = netCDF4.Dataset(path, "w")
+    cube.title = "Climate stats data cube for domain: %s" % domain
+
+    labels = (("experiment", EXPERIMENTS), ("time_period", TIME_PERIODS), ("model", models),
+              ("variable", variables), ("statistic", statistics), ("meaning_period", vocabs.meaning_periods))
+
+    for (dim, values) in labels:
+        cube.createDimension(dim, len(values))
+        var = cube.createVariable(dim, str, (dim,))
+        var[:] = np.array(values, dtype="object")
+
+    for (dim, values, units) in (("lat", lats, "degrees_north"), ("lon", lons, "degrees_east")):
+        cube.createDimension(dim, len(values))
+        var = cube.createVariable(dim, "f8", (dim,))
+        var[:] = values
+        var.units = units
+        var.standard_name = "latitude" if dim == "lat" else "longitude"
+
+    dims = [dim for (dim, values) in labels] + ["lat", "lon"]
+    chunks = [1, 1, len(models), len(variables), len(statistics), len(vocabs.meaning_periods), 1, 1]
+
+    cube.createVariable(CUBE_VARIABLE, "f4", dims, zlib=True, complevel=4, chunksizes=chunks,
+                        fill_value=np.float32(np.nan))
+    return cube
+
+
+def _writeBlock(cube, ie, it, block):
+    "Writes the ``block`` for one experiment and time period to the cube, in blocks of latitude rows."
+    (n_lat, n_lon) = block.shape[-2:]
+    row_size = block[..., 0, :].nbytes
+    n_rows = max(1, WRITE_BLOCK_SIZE // row_size)
+
+    for start in range(0, n_lat, n_rows):
+        rows = slice(start, min(start + n_rows, n_lat))
+        cube[CUBE_VARIABLE][ie, it, :, :, :, :, rows, :] = np.array(block[..., rows, :])
+
+
+class DataCube(object):
+    """
+    Reads grid box records from the data cube of one domain.
+
+    A record is an array of shape (model, variable, statistic, meaning_period) for one
+    experiment and time period.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with getDatasetPool().open(path) as ds:
+            self.index = {}
+
+            for dim in ("experiment", "time_period", "model", "variable", "statistic"):
+                self.index[dim] = dict((str(label), i) for (i, label) in enumerate(ds[dim].values))
+
+            lons = ds["lon"].values
+            self.lats = axis_utils.SortedAxis(ds["lat"].values)
+            self.lons = axis_utils.SortedAxis(lons, period=360. if axis_utils.is_periodic(lons) else None)
+
+    def getRecords(self, experiment, time_period, points):
+        """
+        Returns an array of records, one for each of ``points`` (a list of (lat, lon) grid boxes).
+        The array has shape (len(points), model, variable, statistic, meaning_period).
+        """
+        ie = self.index["experiment"][experiment]
+        it = self.index["time_period"][time_period]
+
+        lat_indices = self.lats.nearest([lat for (lat, lon) in points])[1]
+        lon_indices = self.lons.nearest([lon for (lat, lon) in points])[1]
+
+        with getDatasetPool().open(self.path) as ds:
+            da = ds[CUBE_VARIABLE]
+            records = [da[ie, it, :, :, :, :, ilat, ilon].values for (ilat, ilon) in zip(lat_indices, lon_indices)]
+
+        return np.array(records)
+
+    def getValues(self, records, inst_model, var_id, statistic):
+        """
+        Returns an array of shape (len(records), meaning_period) of the values for the given
+        model, variable and statistic. Values are NaN if they are not in the cube.
+        """
+        try:
+            return records[:, self.index["model"][inst_model], self.index["variable"][var_id],
+                           self.index["statistic"][statistic]]
+        except KeyError:
+            return np.full(records.shape[:1] + records.shape[-1:], np.nan, dtype=records.dtype)
+
+
+# Process-wide store of data cubes, keyed by path
+_data_cubes = {}
+_data_cubes_lock = threading.Lock()
+
+
+def getDataCube(cube_dir, domain):
+    """
+    Returns the DataCube for ``domain`` in ``cube_dir``, or None if ``cube_dir`` is not set
+    or has no cube for the domain. A cube is re-loaded when its file is modified.
+    """
+    if not cube_dir:
+        return None
+
+    path = os.path.join(cube_dir, CUBE_FILE_TEMPLATE % domain)
+    if not os.path.isfile(path):
+        return None
+
+    mtime = os.stat(path).st_mtime_ns
+
+    with _data_cubes_lock:
+        cached = _data_cubes.get(path)
+
+        if not cached or cached[0] != mtime:
+            # The file has been replaced, so its handle in the pool (if any) is out of date
+            if cached:
+                getDatasetPool().discard(path)
+
+            cached = (mtime, DataCube(path))
+            _data_cubes[path] = cached
+
+        return cached[1]
+
+
+def resetAfterFork():
+    "Replaces the lock of the loaded data cubes in a forked worker process (the cubes themselves are kept)."
+    global _data_cubes_lock
+    _data_cubes_lock = threading.Lock()
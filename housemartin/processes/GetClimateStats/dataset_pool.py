@@ -0,0 +1,247 @@
+"""
+dataset_pool.py
+===============
+
+A bounded, thread-safe LRU pool of open dataset handles, keyed by file path and
+modification time.
+
+The pool is shared by all requests in a worker process (see: ``getDatasetPool``),
+so a stats file that is read for one location remains open for the next location
+and the next request. When the pool exceeds its limit on the number of open files,
+the least recently used handles are closed. A file that has been modified since it
+was opened is opened again.
+
+The pool is bounded by the number of handles, not their size: reads only load the
+points that are requested, so the size of the variables in a file says little about
+the memory that its handle holds.
+
+"""
+
+# Standard library imports
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Third-party imports
+import netCDF4
+import xarray as xr
+
+# Local imports
+from settings import getSetting
+
+logger = logging.getLogger(__name__)
+
+# The netCDF library is not thread-safe, so all calls into it (opening, reading and
+# closing files) are serialised. The lock is re-entrant because xarray acquires it
+# for reads made while a file is being opened.
+NETCDF_LOCK = threading.RLock()
+
+
+def openXarrayDataset(fpath):
+    "Default opener for the pool. Reads from the dataset hold the ``NETCDF_LOCK``."
+    with NETCDF_LOCK:
+        return xr.open_dataset(fpath, use_cftime=True, lock=NETCDF_LOCK)
+
+
+def openNetCDF4Dataset(fpath):
+    "Opener for pools of ``netCDF4.Dataset`` handles, which are read without automatic masking and scaling."
+    with NETCDF_LOCK:
+        ds = netCDF4.Dataset(fpath)
+        ds.set_auto_maskandscale(False)
+        return ds
+
+
+# Opener for each kind of pooled handle
+POOL_KINDS = {"xarray": openXarrayDataset,
+              "netcdf4": openNetCDF4Dataset}
+
+
+def _getModificationTime(path):
+    "Returns the modification time (in ns) of ``path``, or None if it cannot be read (the opener then fails)."
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _PooledHandle(object):
+
+    def __init__(self, path, mtime, handle):
+        self.path = path
+        self.mtime = mtime
+        self.handle = handle
+        self.users = 0
+        self.evicted = False
+
+
+class DatasetPool(object):
+    """
+    An LRU pool of open dataset handles.
+
+    Handles are borrowed with:
+
+        with pool.open(fpath) as ds:
+            ...
+
+    A handle that is evicted while it is borrowed is only closed once it is returned. The
+    file is stat'ed each time a handle is borrowed, and a handle of an older version of
+    the file is evicted.
+    """
+
+    def __init__(self, max_open=128, opener=openXarrayDataset, close_lock=None):
+        self.max_open = max_open
+
+        self._opener = opener
+        self._close_lock = close_lock or NETCDF_LOCK
+
+        # Ordered Dictionary of {path: _PooledHandle}, of the version of each file last opened
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @contextmanager
+    def open(self, path):
+        "Context manager that yields an open handle for ``path``."
+        entry = self._acquire(path)
+
+        try:
+            yield entry.handle
+        finally:
+            self._release(entry)
+
+    def _acquire(self, path):
+        mtime = _getModificationTime(path)
+
+        with self._lock:
+            entry = self._entries.get(path)
+
+            if entry and entry.mtime == mtime:
+                self._entries.move_to_end(path)
+                entry.users += 1
+                self.hits += 1
+                return entry
+
+        # Open outside the lock so that slow opens do not block other threads
+        handle = self._opener(path)
+        to_close = []
+
+        with self._lock:
+            entry = self._entries.get(path)
+
+            if entry and entry.mtime == mtime:
+                # Another thread opened the same file in the meantime
+                to_close.append(handle)
+                self._entries.move_to_end(path)
+                self.hits += 1
+            else:
+                if entry:
+                    # The file has been modified since it was opened
+                    to_close.extend(self._remove(path))
+
+                entry = _PooledHandle(path, mtime, handle)
+                self._entries[path] = entry
+                self.misses += 1
+                to_close.extend(self._evict(self.max_open, keep=path))
+
+            entry.users += 1
+
+        self._close(to_close)
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            close_now = entry.evicted and entry.users == 0
+
+        if close_now:
+            self._close([entry.handle])
+
+    def _remove(self, path):
+        """
+        Removes the entry for ``path`` from the pool. Must be called with the lock held.
+        Returns a list of the handles that can be closed now.
+        """
+        entry = self._entries.pop(path)
+        entry.evicted = True
+        return [entry.handle] if entry.users == 0 else []
+
+    def _evict(self, max_open, keep=None):
+        """
+        Removes least recently used entries until there are no more than ``max_open``.
+        Must be called with the lock held. Returns a list of handles that can be closed now.
+        """
+        to_close = []
+
+        for path in list(self._entries.keys()):
+            if len(self._entries) <= max_open:
+                break
+
+            if path == keep:
+                continue
+
+            to_close.extend(self._remove(path))
+            self.evictions += 1
+
+        return to_close
+
+    def _close(self, handles):
+        for handle in handles:
+            try:
+                with self._close_lock:
+                    handle.close()
+            except Exception as err:
+                logger.warning("Could not close dataset handle: %s" % err)
+
+    def discard(self, path):
+        "Removes the handle for ``path`` from the pool, e.g. because the file has been replaced."
+        with self._lock:
+            to_close = self._remove(path) if path in self._entries else []
+
+        self._close(to_close)
+
+    def clear(self):
+        "Removes all handles from the pool. Borrowed handles are closed when they are returned."
+        with self._lock:
+            to_close = self._evict(0)
+
+        self._close(to_close)
+
+
+# Process-wide pools (one for each kind of handle) shared across requests
+_dataset_pools = {}
+_dataset_pool_lock = threading.Lock()
+
+
+def getDatasetPool(kind="xarray"):
+    """
+    Returns the process-wide DatasetPool for the ``kind`` of handle ("xarray" or "netcdf4"),
+    configured from the ``[climatestats]`` settings.
+    """
+    with _dataset_pool_lock:
+        pool = _dataset_pools.get(kind)
+
+        if pool is None:
+            pool = DatasetPool(max_open=getSetting("dataset_pool_max_open", 128), opener=POOL_KINDS[kind])
+            _dataset_pools[kind] = pool
+
+        return pool
+
+
+def resetAfterFork():
+    """
+    Discards the process-wide pools and locks inherited from the parent process.
+    Must be called at the start of a forked worker process, before any files are read.
+    """
+    global _dataset_pools, _dataset_pool_lock, NETCDF_LOCK
+
+    NETCDF_LOCK = threading.RLock()
+    _dataset_pool_lock = threading.Lock()
+    _dataset_pools = {}
@@ -0,0 +1,159 @@
+"""
+extraction_plan.py
+==================
+
+Plans the extraction of climate stats for all the grid boxes in a request, so that
+each stats file is read once for all of the points it is needed for.
+
+"""
+
+# Standard library imports
+from collections import OrderedDict, namedtuple
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from vocabs import vocabs
+from stats_record import StatsRecord, getDomain
+
+
+# A single stats file to read, and the grid boxes to read from it
+FileTask = namedtuple("FileTask", ["inst_model", "var_id", "statistic", "meaning_period", "domain", "points"])
+
+
+def getGridBoxes(domain_type, location):
+    "Returns an Ordered Dictionary of {domain: (lat, lon)} for the location."
+    if domain_type == "Global":
+        return OrderedDict([("Global", location.global_gb)])
+
+    return location.regional_gbs
+
+
+def getCells(domain_type, grid_boxes):
+    """
+    Returns a list of the cells of the summary for ``grid_boxes`` (a dictionary of {domain: (lat, lon)}),
+    as tuples of: (domain, (lat, lon), (inst_model, var_id, statistic)). Each cell holds the 12 monthly
+    and the annual value. Models whose domain is not in ``grid_boxes`` have no cells.
+    """
+    cells = []
+
+    for var_stat in vocabs.getStatisticIds(domain_type):
+        var_id, statistic = var_stat.split(":")
+
+        for inst_model in vocabs.getModelList(domain_type, var_id):
+            domain = getDomain(domain_type, inst_model)
+
+            if domain in grid_boxes:
+                cells.append((domain, tuple(grid_boxes[domain]), (inst_model, var_id, statistic)))
+
+    return cells
+
+
+class ExtractionPlan(object):
+    """
+    Collects the de-duplicated grid boxes needed for a set of locations (for one domain type,
+    experiment and time period) and groups the work by stats file.
+
+    Grid boxes are held per domain: "Global" for the global domain type, or the CORDEX
+    domain code (e.g. "EUR-44") for the regional domain type.
+
+    ``cached`` is a dictionary of {(domain, (lat, lon)): {(inst_model, var_id, statistic): values}}
+    of the cells that are already known (e.g. from the cache). Only the other cells are read.
+    """
+
+    def __init__(self, domain_type, experiment, time_period, locations, cached=None):
+        self.domain_type = domain_type
+        self.experiment = experiment
+        self.time_period = time_period
+        self.locations = locations
+        self.cached = cached or {}
+
+        self.points = OrderedDict()
+
+        for location in locations:
+            for (domain, gb) in self.getGridBoxes(location).items():
+                self.points.setdefault(domain, OrderedDict())[gb] = True
+
+        self.tasks = list(self._generateTasks())
+
+    def getGridBoxes(self, location):
+        "Returns an Ordered Dictionary of {domain: (lat, lon)} for the location."
+        return getGridBoxes(self.domain_type, location)
+
+    def _isCached(self, domain, gb, cell):
+        return cell in self.cached.get((domain, gb), {})
+
+    def getMissingCells(self, locations=None):
+        "Returns a list of the cells (see: ``getCells``) of ``locations`` (default: all) that are not cached."
+        missing = OrderedDict()
+
+        for location in (self.locations if locations is None else locations):
+            for (domain, gb, cell) in getCells(self.domain_type, self.getGridBoxes(location)):
+                if not self._isCached(domain, gb, cell):
+                    missing[(domain, gb, cell)] = True
+
+        return list(missing.keys())
+
+    def _generateTasks(self):
+        """
+        Yields a FileTask for each stats file that is needed, for the points whose cell is not
+        cached. Regional models whose domain covers none of the requested points are skipped.
+        """
+        for var_stat in vocabs.getStatisticIds(self.domain_type):
+            var_id, statistic = var_stat.split(":")
+
+            for inst_model in vocabs.getModelList(self.domain_type, var_id):
+                domain = getDomain(self.domain_type, inst_model)
+                if domain not in self.points:
+                    continue
+
+                cell = (inst_model, var_id, statistic)
+                points = [gb for gb in self.points[domain].keys() if not self._isCached(domain, gb, cell)]
+                if not points:
+                    continue
+
+                for meaning_period in ("mon", "ann"):
+                    yield FileTask(inst_model, var_id, statistic, meaning_period, domain, points)
+
+    def scatter(self, task_values):
+        """
+        Takes a list (in the same order as ``self.tasks``) of the values read for each
+        task, where each item is a masked array of shape (points, time steps).
+
+        Returns a dictionary of {(domain, (lat, lon)): {(inst_model, var_id, statistic): values}}
+        where ``values`` is a masked array of the 12 monthly and the annual value.
+        """
+        parts = {}
+
+        for (task, point_values) in zip(self.tasks, task_values):
+            for (gb, values) in zip(task.points, point_values):
+                parts.setdefault((task.domain, gb), OrderedDict()).setdefault(
+                    (task.inst_model, task.var_id, task.statistic), []).append(values)
+
+        extracted = {}
+
+        for (key, cells) in parts.items():
+            extracted[key] = dict((cell, np.ma.concatenate(values)) for (cell, values) in cells.items())
+
+        return extracted
+
+    def getRecord(self, location, extracted):
+        """
+        Returns a "summary" StatsRecord for ``location`` from the cached and ``extracted`` values.
+        Missing values, and those of models that do not cover the location, are NaN.
+        """
+        gbs = self.getGridBoxes(location)
+        scenario = (self.time_period, self.experiment)
+        record = StatsRecord(self.domain_type, "summary", [scenario], gbs)
+
+        for (domain, gb, cell) in getCells(self.domain_type, gbs):
+            values = self.cached.get((domain, gb), {}).get(cell)
+
+            if values is None:
+                values = extracted[(domain, gb)][cell]
+
+            (inst_model, var_id, statistic) = cell
+            record.setValues(scenario, inst_model, [(var_id, statistic)], values[np.newaxis])
+
+        return record
@@ -0,0 +1,282 @@
+"""
+file_catalog.py
+===============
+
+A persisted catalog of the climate stats files, so that the extractor can resolve
+the path of a stats file with a dictionary lookup instead of a ``glob`` on the
+(parallel) file system for every file it reads.
+
+The catalog is built by a single walk of the data directory (see: ``buildFileCatalog``)
+and saved as a JSON index file. The listing of every directory is saved with its
+modification time, so a rebuild only re-lists the directories that have changed.
+
+The modification time and size of every stats file are saved too, so that cache entries
+can record a fingerprint of the files they were derived from (see: ``getFingerprint``),
+and the files changed by a data drop can be listed (see: ``diffCatalogs``). The stats are
+read for every file on each rebuild, so files that are rewritten in place (which does not
+change their directory) are found too.
+
+"""
+
+# Standard library imports
+import os
+import json
+import fnmatch
+import hashlib
+import threading
+from collections import OrderedDict
+
+CATALOG_VERSION = 2
+
+# Directory name and resolution directory used for each domain type
+DOMAIN_TYPE_DIRS = OrderedDict([("Global", ("global", "1_deg")), ("Regional", ("regional", "0.5_deg"))])
+
+# Number of directory levels between the domain type directory and the files:
+#   <var_id>/<experiment>/<institute>/<model or domain>/<time_period>/<res>
+DIR_DEPTH = 6
+
+FILE_SUFFIX = "_change.nc"
+
+
+class StatsFileNotFound(Exception):
+    "Raised when there is no stats file for the facets (as opposed to a file that can not be read)."
+
+
+class FileCatalog(object):
+    """
+    A catalog of stats files in ``data_dir``, keyed by:
+
+        (domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+
+    ``dir_listings`` holds {relative directory: [mtime_ns, subdirectories, files]} for
+    every directory visited when the catalog was built, and ``file_stats`` holds
+    {key: (mtime_ns, size)} for every file.
+    """
+
+    def __init__(self, data_dir, files=None, dir_listings=None, file_stats=None):
+        self.data_dir = data_dir
+        self.files = files or {}
+        self.dir_listings = dir_listings or {}
+        self.file_stats = file_stats or {}
+
+        # Fingerprints of sets of files, by the ``memo_key`` given for them
+        self._fingerprints = {}
+
+        # Counts of directories listed and re-used during the last build
+        self.scanned_dirs = 0
+        self.reused_dirs = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def getPath(self, domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period):
+        "Returns the path to the stats file for the given facets, or None if it is not in the catalog."
+        key = (domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+        rel_path = self.files.get(key)
+
+        if rel_path is None:
+            return None
+
+        return os.path.join(self.data_dir, rel_path)
+
+    def getFingerprint(self, keys, memo_key=None):
+        """
+        Returns a fingerprint (a short hex string) of the modification times and sizes of the
+        stats files of ``keys``. Files that are not in the catalog are fingerprinted as missing.
+        If a ``memo_key`` is given, the fingerprint is remembered for calls with the same key.
+        """
+        if memo_key is not None and memo_key in self._fingerprints:
+            return self._fingerprints[memo_key]
+
+        content = "|".join(["%d:%d" % self.file_stats[key] if key in self.file_stats else "-" for key in keys])
+        fingerprint = hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+        if memo_key is not None:
+            self._fingerprints[memo_key] = fingerprint
+
+        return fingerprint
+
+    def save(self, path):
+        "Writes the catalog to the JSON index file at ``path`` (via a temporary file and rename)."
+        content = {"version": CATALOG_VERSION,
+                   "data_dir": self.data_dir,
+                   "files": [list(key) + [rel_path] + list(self.file_stats.get(key, (-1, -1)))
+                             for (key, rel_path) in sorted(self.files.items())],
+                   "dirs": self.dir_listings}
+
+        dr = os.path.dirname(path)
+        if dr and not os.path.isdir(dr):
+            os.makedirs(dr)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as writer:
+            json.dump(content, writer)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        "Reads a catalog from the JSON index file at ``path``."
+        with open(path) as reader:
+            content = json.load(reader)
+
+        if content.get("version") not in (1, CATALOG_VERSION):
+            raise Exception("Unsupported file catalog version in: %s" % path)
+
+        # Catalogs of version 1 do not hold the file stats
+        if content["version"] == 1:
+            files = dict((tuple(item[:-1]), item[-1]) for item in content["files"])
+            return cls(content["data_dir"], files=files, dir_listings=content["dirs"])
+
+        files = dict((tuple(item[:-3]), item[-3]) for item in content["files"])
+        file_stats = dict((tuple(item[:-3]), tuple(item[-2:])) for item in content["files"] if item[-1] >= 0)
+        return cls(content["data_dir"], files=files, dir_listings=content["dirs"], file_stats=file_stats)
+
+
+def _listDir(catalog, rel_dir, previous):
+    """
+    Returns (subdirectories, files) of ``rel_dir``, re-using the listing from the
+    ``previous`` catalog if the directory has not been modified since.
+    """
+    dr = os.path.join(catalog.data_dir, rel_dir)
+    mtime = os.stat(dr).st_mtime_ns
+
+    listing = previous.dir_listings.get(rel_dir) if previous else None
+
+    if listing and listing[0] == mtime:
+        catalog.reused_dirs += 1
+    else:
+        subdirs, files = [], []
+
+        for entry in os.scandir(dr):
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+
+        listing = [mtime, sorted(subdirs), sorted(files)]
+        catalog.scanned_dirs += 1
+
+    catalog.dir_listings[rel_dir] = listing
+    return listing[1], listing[2]
+
+
+def _walk(catalog, rel_dir, depth, previous):
+    "Yields (relative directory, files) for every directory ``depth`` levels below ``rel_dir``."
+    subdirs, files = _listDir(catalog, rel_dir, previous)
+
+    if depth == 0:
+        yield rel_dir, files
+        return
+
+    for name in subdirs:
+        for item in _walk(catalog, os.path.join(rel_dir, name), depth - 1, previous):
+            yield item
+
+
+def buildFileCatalog(data_dir, file_patterns, previous=None):
+    """
+    Walks ``data_dir`` and returns a FileCatalog of all stats files found.
+
+    ``file_patterns`` is a dictionary of {domain_type: file name pattern}, as used
+    by ``ClimateStatsExtractor``. If a ``previous`` catalog of the same directory is
+    given, the listings of unmodified directories are taken from it.
+
+    Raises an Exception if more than one file matches the pattern for any key.
+    """
+    if previous and previous.data_dir != data_dir:
+        previous = None
+
+    catalog = FileCatalog(data_dir)
+    matches = {}
+
+    for (domain_type, (dt, res)) in DOMAIN_TYPE_DIRS.items():
+        if not os.path.isdir(os.path.join(data_dir, dt)):
+            continue
+
+        for (rel_dir, files) in _walk(catalog, dt, DIR_DEPTH, previous):
+            (var_id, experiment, institute, model, time_period, dir_res) = rel_dir.split(os.sep)[1:]
+            if dir_res != res:
+                continue
+
+            inst_model = "%s/%s" % (institute, model)
+
+            for fname in files:
+                if not fname.endswith(FILE_SUFFIX):
+                    continue
+
+                parts = fname[:-len(FILE_SUFFIX)].rsplit("_", 2)
+                if len(parts) != 3:
+                    continue
+
+                (meaning_period, statistic) = parts[1:]
+                fpattern = file_patterns[domain_type] % vars()
+
+                # Only include files that the extractor's glob pattern would match
+                if fname.startswith(".") or not fnmatch.fnmatch(fname, fpattern):
+                    continue
+
+                key = (domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+                matches.setdefault(key, (os.path.join(data_dir, rel_dir, fpattern), []))[1].append(
+                    os.path.join(rel_dir, fname))
+
+    for key in sorted(matches.keys()):
+        (fpattern, items) = matches[key]
+
+        if len(items) != 1:
+            items = [os.path.join(data_dir, item) for item in items]
+            raise Exception("Ambiguous response when globbing for file pattern '%s'. Matched %d responses: %s."
+                            % (fpattern, len(items), str(items)))
+
+        catalog.files[key] = items[0]
+
+        # Every file is stat'ed, as a file rewritten in place does not change its directory
+        stat = os.stat(os.path.join(data_dir, items[0]))
+        catalog.file_stats[key] = (stat.st_mtime_ns, stat.st_size)
+
+    return catalog
+
+
+def diffCatalogs(old, new):
+    """
+    Returns a tuple of sets of the keys of the stats files that were (added, removed, modified)
+    between the ``old`` and ``new`` catalogs. Files are modified if their path, modification
+    time or size differ.
+    """
+    added = set(new.files.keys()) - set(old.files.keys())
+    removed = set(old.files.keys()) - set(new.files.keys())
+    modified = set([key for key in set(old.files.keys()) & set(new.files.keys())
+                    if (old.files[key], old.file_stats.get(key)) != (new.files[key], new.file_stats.get(key))])
+
+    return (added, removed, modified)
+
+
+# Process-wide store of catalogs, keyed by index file path
+_file_catalogs = {}
+_file_catalogs_lock = threading.Lock()
+
+
+def getFileCatalog(path):
+    """
+    Returns the FileCatalog saved at ``path``, or None if ``path`` is not set or does not exist.
+    The catalog is re-loaded when the index file is modified (e.g. after a rebuild).
+    """
+    if not path or not os.path.isfile(path):
+        return None
+
+    mtime = os.stat(path).st_mtime_ns
+
+    with _file_catalogs_lock:
+        cached = _file_catalogs.get(path)
+
+        if not cached or cached[0] != mtime:
+            cached = (mtime, FileCatalog.load(path))
+            _file_catalogs[path] = cached
+
+        return cached[1]
+
+
+def resetAfterFork():
+    "Replaces the lock of the loaded catalogs in a forked worker process (the catalogs themselves are kept)."
+    global _file_catalogs_lock
+    _file_catalogs_lock = threading.Lock()
@@ -46,12 +46,20 @@ def main(args):
 
 
 def _getNearestLatLon(lat, lon, da):
+    """
+    Returns the nearest grid point in ``da`` to (lat, lon) as a tuple of:
+        ((lat_value, lon_value), (lat_index, lon_index))
+    """
     if len(da.shape) != 3:
         raise Exception(f'3 axes expected in DataArray but not found.')
 
-    glat = axis_utils.nudgeSingleValuesToAxisValues(lat, get_coord_by_type(da, 'latitude'))
-    glon = axis_utils.nudgeSingleValuesToAxisValues(lon, get_coord_by_type(da, 'longitude'))
-    return (glat, glon)
+    lats = get_coord_by_type(da, 'latitude').values
+    lons = get_coord_by_type(da, 'longitude').values
+    lon_period = 360. if axis_utils.is_periodic(lons) else None
+
+    (glat,), (ilat,) = axis_utils.nearest_axis_values(lats, [lat])
+    (glon,), (ilon,) = axis_utils.nearest_axis_values(lons, [lon], period=lon_period)
+    return ((glat, glon), (ilat, ilon))
 
 def verify(time_period, experiment, inst_model, domain_type, var_id, statistic, lat, lon, baseline = False):
     model = inst_model.split("/")[1]
@@ -90,15 +98,12 @@ def verify(time_period, experiment, inst_model, domain_type, var_id, statistic,
         da = xr.open_dataset(fn, use_cftime=True)[var_id]
 #        vm = f[var_id]
 
-        y, x = _getNearestLatLon(float(lat), float(lon), da)
-#        ax_ids = (vm.getAxisIds()[1], vm.getAxisIds()[2])
-#        kwargs = {ax_ids[0]: y, ax_ids[1]: x, "squeeze": 1}
-#        v = f(var_id, **kwargs)
+        (y, x), (iy, ix) = _getNearestLatLon(float(lat), float(lon), da)
 
-        lat_id = get_coord_by_type(da, 'latitude')
-        lon_id = get_coord_by_type(da, 'longitude')
+        lat_id = get_coord_by_type(da, 'latitude').name
+        lon_id = get_coord_by_type(da, 'longitude').name
 
-        v = da.loc[{lat_id: y, lon_id: x}]
+        v = da.isel({lat_id: iy, lon_id: ix}).values
 
         if tmp == "mon":
             data[a].extend([v[i] for i in range(12)])
@@ -0,0 +1,179 @@
+"""
+grid_index.py
+=============
+
+An in-memory index of the global and regional (CORDEX) reference grids.
+
+The reference files are read once per process and their latitude and longitude
+axes are held as sorted NumPy arrays, so that finding the grid boxes for a
+location does not require any further NetCDF access.
+
+"""
+
+# Standard library imports
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+import numpy as np
+import xarray as xr
+from roocs_utils.xarray_utils.xarray_utils import get_coord_by_type
+
+# Local imports
+import axis_utils
+
+
+class GridAxes(object):
+    """
+    Holds the latitude and longitude axes of a single reference grid, prepared
+    for nearest-neighbour searches.
+
+    Longitudes are treated as periodic if the axis covers the whole globe.
+    """
+
+    def __init__(self, domain, lats, lons):
+        self.domain = domain
+        self.lats = axis_utils.SortedAxis(lats)
+
+        lon_period = 360. if axis_utils.is_periodic(lons) else None
+        self.lons = axis_utils.SortedAxis(lons, period=lon_period)
+
+        self.lat_bounds = (self.lats.min, self.lats.max)
+        self.lon_bounds = (self.lons.min, self.lons.max)
+
+    @classmethod
+    def fromFile(cls, domain, ref_file, ref_variable):
+        "Reads the axes of ``ref_variable`` in ``ref_file`` and returns a GridAxes instance."
+        with xr.open_dataset(ref_file, decode_times=False) as ds:
+            v = ds[ref_variable]
+            lats = get_coord_by_type(v, "latitude").values
+            lons = get_coord_by_type(v, "longitude").values
+
+        return cls(domain, lats, lons)
+
+    def wrapLongitudes(self, lons):
+        """
+        Returns an array of the longitude values to use for each of ``lons``. Accounts for
+        either of these to be defined as far -360 to 360.
+        Values that are not within the longitude bounds are returned as NaN.
+        """
+        if self.lons.period:
+            return np.asarray(lons, dtype="float64")
+
+        return axis_utils.wrap_to_range(lons, *self.lon_bounds)
+
+    def getGridBoxes(self, lats, lons, domain_type):
+        """
+        Finds the nearest grid boxes to arrays of ``lats`` and ``lons``.
+
+        Returns a tuple of arrays: (grid_lats, grid_lons, found)
+        where ``found`` is False for locations outside the domain.
+        """
+        lats = np.asarray(lats, dtype="float64")
+        lons = self.wrapLongitudes(lons)
+        found = ~np.isnan(lons)
+
+        if domain_type == "Regional":
+            (lat_min, lat_max) = self.lat_bounds
+            found &= (lats >= lat_min) & (lats <= lat_max)
+
+        lons = np.where(found, lons, self.lon_bounds[0])
+        return (self.lats.nearest(lats)[0], self.lons.nearest(lons)[0], found)
+
+
+class GridIndex(object):
+    """
+    Index of the global reference grid and all regional (CORDEX) reference grids.
+    """
+
+    def __init__(self, ref_files, ref_variable):
+        """
+        ``ref_files`` is an ordered dictionary of {domain: ref_file}. The global grid
+        must be keyed as "Global"; all other keys are treated as regional domains.
+        """
+        self.grids = OrderedDict()
+
+        for (domain, ref_file) in ref_files.items():
+            self.grids[domain] = GridAxes.fromFile(domain, ref_file, ref_variable)
+
+        self.regional_domains = [domain for domain in self.grids if domain != "Global"]
+
+    def resolve(self, lat, lon):
+        """
+        Resolves the global and all regional grid boxes for (lat, lon) in one pass.
+
+        Returns a tuple of: (global_gb, regional_gbs)
+        where ``regional_gbs`` is an Ordered Dictionary of {domain: (lat, lon)} only
+        including the domains that contain the location.
+        """
+        return self.resolveMany([lat], [lon])[0]
+
+    def resolveMany(self, lats, lons):
+        """
+        Resolves the global and all regional grid boxes for arrays of ``lats`` and ``lons``
+        using array operations for each grid.
+
+        Returns a list of (global_gb, regional_gbs) tuples, one per location, as
+        returned by ``resolve()``.
+        """
+        columns = []
+
+        for (domain, grid) in self.grids.items():
+            domain_type = "Global" if domain == "Global" else "Regional"
+            (glats, glons, found) = grid.getGridBoxes(lats, lons, domain_type)
+            columns.append((domain, glats.tolist(), glons.tolist(), found.tolist()))
+
+        return assembleGridBoxes(columns, len(lats))
+
+
+def assembleGridBoxes(columns, n_locations):
+    """
+    Assembles per-domain columns of results into a list of (global_gb, regional_gbs)
+    tuples, one per location.
+
+    ``columns`` is a list of (domain, grid_lats, grid_lons, found) where each of the
+    last three items is a list with one value per location.
+    """
+    resolved = []
+
+    for i in range(n_locations):
+        global_gb = None
+        regional_gbs = OrderedDict()
+
+        for (domain, glats, glons, found) in columns:
+            if not found[i]:
+                continue
+
+            if domain == "Global":
+                global_gb = (glats[i], glons[i])
+            else:
+                regional_gbs[domain] = (glats[i], glons[i])
+
+        resolved.append((global_gb, regional_gbs))
+
+    return resolved
+
+
+# Process-wide store of grid indexes, keyed by the reference files used to build them
+_grid_indexes = {}
+_grid_indexes_lock = threading.Lock()
+
+
+def getGridIndex(ref_files, ref_variable):
+    """
+    Returns a GridIndex for the ``ref_files`` and ``ref_variable``. The reference files
+    are only read the first time they are requested in a process.
+    """
+    key = (tuple(ref_files.items()), ref_variable)
+
+    with _grid_indexes_lock:
+        if key not in _grid_indexes:
+            _grid_indexes[key] = GridIndex(ref_files, ref_variable)
+
+        return _grid_indexes[key]
+
+
+def resetAfterFork():
+    "Replaces the lock of the process-wide indexes, which a thread of the parent process may have held when it forked."
+    global _grid_indexes_lock
+    _grid_indexes_lock = threading.Lock()
@@ -0,0 +1,206 @@
+"""
+grid_lookup.py
+==============
+
+A persisted lookup table from quantized coordinates to grid boxes.
+
+The table is built offline from a ``GridIndex`` and stored as NumPy arrays in the
+grid reference directory. Workers open the arrays memory-mapped, so they share the
+same page-cached table, and resolving a location costs one array index per axis
+with no NetCDF access.
+
+Because the reference grids are rectilinear, the nearest latitude only depends on
+the requested latitude (and likewise for longitude). The table is therefore stored
+as one latitude table and one longitude table, each holding an index into the
+axes of every domain, or ``NO_COVERAGE`` where the domain does not cover that
+coordinate. Locations are resolved at the quantized coordinate, so results may
+differ from an exact nearest-neighbour search within ``resolution / 2`` of the
+mid-point between two grid boxes.
+
+"""
+
+# Standard library imports
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from grid_index import assembleGridBoxes
+
+LAT_TABLE_FILE = "grid_lookup_lat.npy"
+LON_TABLE_FILE = "grid_lookup_lon.npy"
+AXES_FILE = "grid_lookup_axes.npz"
+
+DEFAULT_RESOLUTION = 0.01
+NO_COVERAGE = -1
+
+# Minimum number of seconds between checks (in each process) for new or modified lookup tables
+LOOKUP_CHECK_INTERVAL = 5.
+
+# Requested coordinates are valid in these ranges (see: ``checkValidLocation``)
+LAT_RANGE = (-90., 90.)
+LON_RANGE = (-360., 360.)
+
+
+def _quantizedAxis(coord_range, resolution):
+    "Returns an array of quantized coordinate values covering ``coord_range``."
+    n = int(round((coord_range[1] - coord_range[0]) / resolution)) + 1
+    return coord_range[0] + np.arange(n, dtype="float64") * resolution
+
+
+def _saveAtomically(path, array):
+    "Writes ``array`` to the ``.npy`` file at ``path`` via a temporary file and rename."
+    tmp_path = path + ".tmp"
+    np.save(tmp_path, array)
+    os.replace(tmp_path + ".npy", path)
+
+
+def buildGridLookup(grid_index, output_dir, resolution=DEFAULT_RESOLUTION):
+    """
+    Builds the lookup tables for all domains in ``grid_index`` and writes them
+    to ``output_dir``. Returns the list of files written.
+    """
+    domains = list(grid_index.grids.keys())
+    q_lats = _quantizedAxis(LAT_RANGE, resolution)
+    q_lons = _quantizedAxis(LON_RANGE, resolution)
+
+    lat_table = np.full((len(domains), len(q_lats)), NO_COVERAGE, dtype="int32")
+    lon_table = np.full((len(domains), len(q_lons)), NO_COVERAGE, dtype="int32")
+    axes = {}
+
+    for (i, domain) in enumerate(domains):
+        grid = grid_index.grids[domain]
+
+        lat_indices = grid.lats.nearest(q_lats)[1]
+        if domain != "Global":
+            (lat_min, lat_max) = grid.lat_bounds
+            lat_indices = np.where((q_lats >= lat_min) & (q_lats <= lat_max), lat_indices, NO_COVERAGE)
+
+        lons = grid.wrapLongitudes(q_lons)
+        found = ~np.isnan(lons)
+        lon_indices = grid.lons.nearest(np.where(found, lons, grid.lon_bounds[0]))[1]
+
+        lat_table[i] = lat_indices
+        lon_table[i] = np.where(found, lon_indices, NO_COVERAGE)
+
+        axes["lats_%d" % i] = grid.lats.values
+        axes["lons_%d" % i] = grid.lons.values
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    files = [os.path.join(output_dir, name) for name in (LAT_TABLE_FILE, LON_TABLE_FILE, AXES_FILE)]
+    _saveAtomically(files[0], lat_table)
+    _saveAtomically(files[1], lon_table)
+
+    tmp_path = files[2] + ".tmp.npz"
+    np.savez(tmp_path, domains=np.array(domains), resolution=np.array(resolution), **axes)
+    os.replace(tmp_path, files[2])
+
+    return files
+
+
+class GridLookup(object):
+    """
+    Resolves grid boxes from the memory-mapped lookup tables written by ``buildGridLookup``.
+
+    Provides the same ``resolve`` and ``resolveMany`` methods as ``GridIndex``.
+    """
+
+    def __init__(self, lookup_dir):
+        self.lat_table = np.load(os.path.join(lookup_dir, LAT_TABLE_FILE), mmap_mode="r")
+        self.lon_table = np.load(os.path.join(lookup_dir, LON_TABLE_FILE), mmap_mode="r")
+
+        with np.load(os.path.join(lookup_dir, AXES_FILE)) as axes:
+            self.domains = [str(domain) for domain in axes["domains"]]
+            self.resolution = float(axes["resolution"])
+            self.axes = OrderedDict((domain, (axes["lats_%d" % i], axes["lons_%d" % i]))
+                                    for (i, domain) in enumerate(self.domains))
+
+    def _quantize(self, values, coord_range, table_size):
+        "Returns an array of table positions for ``values``."
+        positions = np.rint((np.asarray(values, dtype="float64") - coord_range[0]) / self.resolution)
+        return np.clip(positions, 0, table_size - 1).astype("int64")
+
+    def resolve(self, lat, lon):
+        """
+        Resolves the global and all regional grid boxes for (lat, lon).
+        See: ``GridIndex.resolve``.
+        """
+        return self.resolveMany([lat], [lon])[0]
+
+    def resolveMany(self, lats, lons):
+        """
+        Resolves the global and all regional grid boxes for arrays of ``lats`` and ``lons``.
+        See: ``GridIndex.resolveMany``.
+        """
+        lat_rows = self.lat_table[:, self._quantize(lats, LAT_RANGE, self.lat_table.shape[1])]
+        lon_rows = self.lon_table[:, self._quantize(lons, LON_RANGE, self.lon_table.shape[1])]
+
+        columns = []
+
+        for (i, domain) in enumerate(self.domains):
+            found = (lat_rows[i] != NO_COVERAGE) & (lon_rows[i] != NO_COVERAGE)
+            (axis_lats, axis_lons) = self.axes[domain]
+
+            glats = axis_lats[np.where(found, lat_rows[i], 0)]
+            glons = axis_lons[np.where(found, lon_rows[i], 0)]
+            columns.append((domain, glats.tolist(), glons.tolist(), found.tolist()))
+
+        return assembleGridBoxes(columns, len(lats))
+
+
+# Process-wide store of lookup tables, keyed by directory, as (time checked, mtimes, GridLookup or None)
+_grid_lookups = {}
+_grid_lookups_lock = threading.Lock()
+
+
+def _getTableMtimes(lookup_dir):
+    "Returns a tuple of the modification times of the lookup table files, or None if any are missing."
+    try:
+        return tuple(os.stat(os.path.join(lookup_dir, name)).st_mtime_ns
+                     for name in (LAT_TABLE_FILE, LON_TABLE_FILE, AXES_FILE))
+    except FileNotFoundError:
+        return None
+
+
+def getGridLookup(lookup_dir, domains):
+    """
+    Returns a GridLookup for ``lookup_dir`` if lookup tables exist there for exactly
+    the ``domains`` requested. Otherwise returns None.
+    The files are checked at most every LOOKUP_CHECK_INTERVAL seconds, and the tables are
+    re-loaded when any of them have been modified (e.g. after a rebuild).
+    """
+    now = time.time()
+
+    with _grid_lookups_lock:
+        cached = _grid_lookups.get(lookup_dir)
+
+        if not cached or now - cached[0] >= LOOKUP_CHECK_INTERVAL:
+            mtimes = _getTableMtimes(lookup_dir)
+
+            if mtimes is None:
+                cached = (now, None, None)
+            elif not cached or cached[1] != mtimes:
+                cached = (now, mtimes, GridLookup(lookup_dir))
+            else:
+                cached = (now, mtimes, cached[2])
+
+            _grid_lookups[lookup_dir] = cached
+
+        lookup = cached[2]
+
+    if lookup and lookup.domains == list(domains):
+        return lookup
+
+    return None
+
+
+def resetAfterFork():
+    "Replaces the lock of the loaded lookup tables in a forked worker process (the tables themselves are kept)."
+    global _grid_lookups_lock
+    _grid_lookups_lock = threading.Lock()
@@ -10,17 +10,41 @@ Holds helper classes and functions for use by processes:
 """
 
 # Standard library imports
-import os, sys, re, glob, logging, copy, types
-import pickle
+import os, sys, re, glob, time, logging, copy, types
+import threading
+import multiprocessing
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import numpy as np
 import xarray as xr
-
-# Third-party imports
-import axis_utils
+from roocs_utils.xarray_utils.xarray_utils import get_coord_by_type
 
 # Local imports
 from vocabs import vocabs
+import grid_index
+from grid_index import getGridIndex
+import grid_lookup
+from grid_lookup import getGridLookup
+import dataset_pool
+from dataset_pool import getDatasetPool
+import file_catalog
+from file_catalog import getFileCatalog, StatsFileNotFound
+import data_cube
+from data_cube import getDataCube
+import point_reader
+from point_reader import getPointReader
+import cache_backends
+from cache_backends import getCacheBackend, createCacheBackend, collectGarbage, MemoryTier, LOCK_DIR_NAME
+import offset_index
+from offset_index import getOffsetIndex
+from stats_record import (StatsRecord, formatResults, formatCSVLines, getModelItems, getDomain,
+                          cellToBytes, cellFromBytes, bundleToBytes, bundleFromBytes)
+from settings import getSetting, getSizeSetting
+import stale_refresh
+from stale_refresh import getStaleRefresher
+from extraction_plan import ExtractionPlan, getGridBoxes, getCells
+import axis_utils
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -29,6 +53,35 @@ logger.setLevel(logging.INFO)
 # Local variables
 GWS = "/gws/nopw/j04/acclim"
 
+# The (time_period, experiment) of each part of the full summary, in the order of the CSV lines
+FULL_SUMMARY_SCENARIOS = [(time_period, experiment) for time_period in ("2035", "2055")
+                          for experiment in ("rcp45", "rcp85")]
+
+
+# Patterns of stats files known not to exist: {pattern: time at which the entry expires}
+_absent_files = {}
+_absent_files_lock = threading.Lock()
+
+
+def _addAbsentFile(fpattern, expires):
+    """
+    Records that no stats file matches ``fpattern`` until ``expires``. Expired entries are
+    dropped first: entries are kept in the order they were added, so (with the same TTL)
+    they are dropped from the front until one has not expired.
+    """
+    now = time.time()
+
+    with _absent_files_lock:
+        while _absent_files:
+            pattern = next(iter(_absent_files))
+            if _absent_files[pattern] > now:
+                break
+
+            del _absent_files[pattern]
+
+        _absent_files.pop(fpattern, None)
+        _absent_files[fpattern] = expires
+
 
 def checkValidLocation(lat, lon):
     "Checks ``lat`` and ``lon`` are in a valid range for the Earth."
@@ -42,6 +95,13 @@ def checkValidLocation(lat, lon):
         raise Exception("Location is not valid. %s" % msg)
 
 
+def _maskedToLists(values):
+    "Returns a list of lists of values from a 2D masked array, with None for missing (masked) values."
+    mask = np.ma.getmaskarray(values).tolist()
+    return [[None if missing else value for (value, missing) in zip(row, row_mask)]
+            for (row, row_mask) in zip(np.ma.getdata(values).tolist(), mask)]
+
+
 class ProcessedLocationsHolder(object):
 
     def __init__(self):
@@ -76,9 +136,25 @@ class ProcessedLocationsHolder(object):
 
 class StatsCacheBase(object):
     """
-    A base class for caching climate stats on the file system.
+    A base class for caching climate stats. Entries are stored by a backend (see: ``cache_backends.py``),
+    selected with the ``[climatestats]`` option ``cache_backend``.
+
+    The contents of each entry are a ``StatsRecord``, stored in its binary form (compressed
+    with the ``[climatestats]`` option ``cache_compression``). Sub-classes can store other
+    contents by overriding ``_encode`` and ``_decode``.
+
+    Requests can include the ``fingerprint`` of the stats files that the contents are derived
+    from (see: ``FileCatalog.getFingerprint``). It is stored with the contents on a PUT, and
+    entries with another fingerprint are misses on a GET, so entries are invalidated when
+    their stats files change.
+
+    PUT requests with ``absent`` set are for contents that are missing values because a stats
+    file does not exist. They are stored as negative entries, which are misses on a GET once
+    the ``negative_cache_ttl`` (in seconds) has passed.
     """
-    # The base directory for the cache; and the file name used for each cache file
+    # The name of the cache (used in its settings); the base directory for the cache;
+    # and the file name used for each cache file
+    NAME = "base"
     CACHE_DIR = "/tmp"
     FILE_NAME = "cached.dat"
 
@@ -86,12 +162,26 @@ class StatsCacheBase(object):
     FACETS = []
     # A dictionary of {FACET: PROCESSING_METHOD} mappings to allow special handling of facets
     FACET_MAPPERS = {} 
+    # The facets that identify the entries locked together while they are computed (default: FACETS)
+    LOCK_FACETS = None
 
     def __init__(self):
         logger.info("Setting up cache manager.")
         if not os.path.isdir(self.CACHE_DIR):
             os.mkdir(self.CACHE_DIR)
 
+        # The in-memory tier of each cache is configured with the "<NAME>_cache_memory_*" options
+        self.backend = getCacheBackend(getSetting("cache_backend", "filesystem"), self.CACHE_DIR,
+                                       self.FILE_NAME, len(self.FACETS),
+                                       memory_size=getSizeSetting("%s_cache_memory_size" % self.NAME, "64mb"),
+                                       memory_ttl=getSetting("%s_cache_memory_ttl" % self.NAME, 3600))
+        self.negative_ttl = getSetting("negative_cache_ttl", 3600)
+
+    @classmethod
+    def createBackend(cls, kind):
+        "Returns a new backend of the given ``kind`` for this cache (e.g. to migrate the cache)."
+        return createCacheBackend(kind, cls.CACHE_DIR, cls.FILE_NAME, len(cls.FACETS))
+
     def _handleLocationFloat(self, flt):
         """
         Returns a string when given a float. Floats are rounded to 4 decimal places.
@@ -99,13 +189,17 @@ class StatsCacheBase(object):
         """ 
         return ("%1.4f" % flt).replace("-", "m")
 
-    def _getDir(self, **kwargs):
+    def _handleModelName(self, inst_model):
+        "Returns ``inst_model`` (such as 'MOHC/HadGEM2-ES') with '+' instead of '/', for use as a single facet."
+        return inst_model.replace("/", "+")
+
+    def _getKey(self, facets=None, **kwargs):
         """
-        Constructs and returns a directory to hold the cached object.
+        Returns the key of the cached object: a tuple of the facet values (as strings).
+        ``facets`` defaults to all the FACETS of the cache.
         """ 
-       # logger.info("Looking for cache with details: %s" % str(kwargs))
         items = []
-        for facet in self.FACETS:
+        for facet in (facets or self.FACETS):
             if facet not in kwargs:
                 raise Exception("Facet not found in cache request: %s" % facet)
 
@@ -116,65 +210,256 @@ class StatsCacheBase(object):
  
             items.append(value)
 
-        return os.path.join(self.CACHE_DIR, "/".join(items))
+        return tuple(items)
+
+    def _getDir(self, **kwargs):
+        """
+        Constructs and returns a directory to hold the cached object (in the file system layout).
+        """
+        return os.path.join(self.CACHE_DIR, "/".join(self._getKey(**kwargs)))
 
     def get(self, **kwargs):
-        dir = self._getDir(**kwargs)
-        fpath = os.path.join(dir, self.FILE_NAME)
+        "Returns the cached contents, or False if they are not in the cache."
+        return self.getMany([kwargs])[0]
 
-        if not os.path.isdir(dir) or not os.path.isfile(fpath):
-            return False
+    def getMany(self, requests, stale=None):
+        """
+        Returns a list of the cached contents (or False) for each of ``requests``, which are
+        dictionaries of the facets (and optionally a fingerprint). The backend looks up all of
+        them at once. Entries that are not records of the current version and vocabs (see:
+        ``StatsRecord.fromBytes``), or that have another fingerprint, are misses.
+
+        If ``stale`` is a list, the contents of entries with another fingerprint are returned
+        instead, and the indices of their requests are appended to ``stale``.
+        """
+        results = self._getPayloads(requests)
+        contents = []
 
-        return self._unpackDataFile(fpath)
+        for (i, (kwargs, payload)) in enumerate(zip(requests, results)):
+            decoded = None if payload is None else self._decode(payload)
 
-    def _unpackDataFile(self, fpath):
-        "Unpacks contents of file and returns as a dictionary."
-        logger.info("Extracting data from cache file: %s" % fpath)
-        data = pickle.load(open(fpath, "rb"))
-        return data
+            if decoded is None:
+                contents.append(False)
+
+            # Entries derived from stats files that have changed since are stale
+            elif decoded[1] != kwargs.get("fingerprint", decoded[1]):
+                if stale is None:
+                    contents.append(False)
+                else:
+                    stale.append(i)
+                    contents.append(decoded[0])
+            else:
+                contents.append(decoded[0])
+
+        return contents
+
+    def _getPayloads(self, requests):
+        "Returns a list of the payload (or None) of the entry of each of ``requests``, looked up all at once."
+        return self.backend.getMany([self._getKey(**kwargs) for kwargs in requests])
+
+    def _putPayloads(self, items):
+        "Writes each of ``items``, a list of (request, payload), to the backend at once."
+        self.backend.putMany([(self._getKey(**kwargs), payload) for (kwargs, payload) in items])
+
+    def _encode(self, data, fingerprint, expires=0.):
+        """
+        Returns the contents of an entry serialised (as bytes) with the ``fingerprint`` (and time
+        at which it ``expires``).
+        """
+        return data.toBytes(getSetting("cache_compression", "none"), fingerprint, expires)
+
+    def _decode(self, payload):
+        """
+        Returns a tuple of the (contents, fingerprint) of an entry from its ``payload``, or None if
+        it can not be decoded.
+        """
+        record = StatsRecord.fromBytes(payload)
+        return None if record is None else (record, record.fingerprint)
 
     def put(self, **kwargs):
         "Puts contents in to the cache."
-        if "data" not in kwargs:
-            raise Exception("No data sent to cache PUT.")
+        self.putMany([kwargs])
 
-        dir = self._getDir(**kwargs)
-        fpath = os.path.join(dir, self.FILE_NAME)
+    def putMany(self, requests):
+        "Puts the contents of each of ``requests`` (dictionaries of the facets and data) in to the cache at once."
+        items = []
 
-        if not os.path.isdir(dir):
-            logger.info("Creating cache directories: %s" % dir)
-            os.makedirs(dir)
+        for kwargs in requests:
+            if "data" not in kwargs:
+                raise Exception("No data sent to cache PUT.")
 
-        logger.info("Writing cache file: %s" % fpath)
-        pickle.dump(kwargs["data"], open(fpath, "wb"))
+            expires = time.time() + self.negative_ttl if kwargs.get("absent") else 0.
+            items.append((kwargs, self._encode(kwargs["data"], kwargs.get("fingerprint", ""), expires)))
+
+        self._putPayloads(items)
 
     def delete(self, **kwargs):
         "Delets a record from the cache."
-        dir = self._getDir(**kwargs)
-        fpath = os.path.join(dir, self.FILE_NAME)
-        logger.warn("Deleting cache file: %s" % fpath)
+        self.backend.delete(self._getKey(**kwargs))
+
+    def getBudget(self):
+        """
+        Returns a tuple of the (max_bytes, max_entries) of the cache, from the "<NAME>_cache_max_size"
+        and "<NAME>_cache_max_entries" options (0 for no limit).
+        """
+        return (getSizeSetting("%s_cache_max_size" % self.NAME, "0"), getSetting("%s_cache_max_entries" % self.NAME, 0))
+
+    def collectGarbage(self, batch_size=100, pause=0.):
+        """
+        Evicts entries until the cache is within its budget, under the ``cache_eviction_policy``.
+        Returns a tuple of (number of entries evicted, bytes freed).
+        """
+        (max_bytes, max_entries) = self.getBudget()
+        return collectGarbage(self.backend, os.path.join(self.CACHE_DIR, LOCK_DIR_NAME), max_bytes=max_bytes,
+                              max_entries=max_entries, policy=getSetting("cache_eviction_policy", "lru"),
+                              batch_size=batch_size, pause=pause, lock_timeout=getSetting("cache_lock_timeout", 600.))
+
+    def getStats(self):
+        """
+        Returns a dictionary of the size and occupancy of the cache, and the counters of
+        its memory tier in this process (if any).
+        """
+        stats = self.backend.getUsage()
+        (stats["max_bytes"], stats["max_entries"]) = self.getBudget()
+
+        for (limit, used) in (("max_bytes", "bytes"), ("max_entries", "entries")):
+            stats[used + "_occupancy"] = float(stats[used]) / stats[limit] if stats[limit] else None
 
-        if os.path.isfile(fpath):
-            os.remove(fpath)
+        if isinstance(self.backend, MemoryTier):
+            stats["memory"] = {"entries": len(self.backend), "bytes": self.backend.nbytes, "hits": self.backend.hits,
+                               "misses": self.backend.misses, "evictions": self.backend.evictions}
+
+        return stats
+
+    def lockMany(self, requests):
+        """
+        Returns a context manager that holds an exclusive lock (across threads and processes)
+        on each of ``requests`` (dictionaries of the facets), so that only one worker computes
+        an entry at a time. Locks are given up after the ``cache_lock_timeout`` (in seconds).
+        Entries with the same LOCK_FACETS share a lock.
+        """
+        keys = set([self._getKey(facets=self.LOCK_FACETS, **kwargs) for kwargs in requests])
+        return self.backend.lockKeys(os.path.join(self.CACHE_DIR, LOCK_DIR_NAME), sorted(keys),
+                                     timeout=getSetting("cache_lock_timeout", 600.))
 
 
 class ClimateStatsCache(StatsCacheBase):
     """
-    A caching class that store pre-read data on the file system with a file per location.
+    A caching class that stores pre-read data in cells: the values of a single (grid box, var_id,
+    statistic, inst_model). Cells do not depend on the vocabs, so they are re-used when models or
+    statistics are added, and only the missing cells are extracted.
+
+    The contents of each cell are a masked array of the 12 monthly and the annual value. The
+    cells of a grid box (for an experiment and time period) are stored in one entry, keyed by the
+    CELL_FACETS inside it (see: ``bundleToBytes``), so that a grid box is read with one lookup.
+    A PUT merges the cells in to the entry, so must be made while the grid box is locked (see:
+    ``lockMany``); a delete removes all the cells of the grid box.
     """
+    NAME = "summary"
     CACHE_DIR = f"{GWS}/web_cache/summary"
     FACETS = ("domain_type", "experiment", "time_period", "lat", "lon")
-    FACET_MAPPERS = {"lat": "_handleLocationFloat", "lon": "_handleLocationFloat"} 
+    FACET_MAPPERS = {"lat": "_handleLocationFloat", "lon": "_handleLocationFloat", "inst_model": "_handleModelName"}
+    # The facets that identify a cell in the entry of its grid box
+    CELL_FACETS = ("var_id", "statistic", "inst_model")
+
+    def _getCellKey(self, **kwargs):
+        "Returns the key of a cell in the entry of its grid box: the CELL_FACETS joined with '/'."
+        return "/".join(self._getKey(facets=self.CELL_FACETS, **kwargs))
+
+    def _getBundles(self, backend, keys):
+        "Returns a dictionary of {key: cells} of the entries of ``keys`` in ``backend`` (cells are None if missing)."
+        keys = list(OrderedDict.fromkeys(keys))
+        return dict((key, None if payload is None else bundleFromBytes(payload))
+                    for (key, payload) in zip(keys, backend.getMany(keys)))
+
+    def _getPayloads(self, requests):
+        keys = [self._getKey(**kwargs) for kwargs in requests]
+        bundles = self._getBundles(self.backend, keys)
+        return [(bundles[key] or {}).get(self._getCellKey(**kwargs)) for (key, kwargs) in zip(keys, requests)]
+
+    def _putPayloads(self, items):
+        cells_by_key = OrderedDict()
+        for (kwargs, payload) in items:
+            cells_by_key.setdefault(self._getKey(**kwargs), OrderedDict())[self._getCellKey(**kwargs)] = payload
+
+        # The entries are read from the backend itself, as the memory tier may not hold cells written elsewhere
+        backend = self.backend.backend if isinstance(self.backend, MemoryTier) else self.backend
+        bundles = self._getBundles(backend, list(cells_by_key.keys()))
+        merged = []
+
+        for (key, cells) in cells_by_key.items():
+            # Cells that are no longer valid (such as expired negative cells) are dropped
+            bundle = OrderedDict((cell_key, payload) for (cell_key, payload) in (bundles[key] or {}).items()
+                                 if cell_key not in cells and cellFromBytes(payload) is not None)
+            bundle.update(cells)
+            merged.append((key, bundleToBytes(bundle)))
+
+        self.backend.putMany(merged)
+
+    def _encode(self, data, fingerprint, expires=0.):
+        return cellToBytes(data, fingerprint, expires)
+
+    def _decode(self, payload):
+        return cellFromBytes(payload)
+
+    def findStaleEntries(self, changed):
+        """
+        Returns a list of the keys of the entries with cells derived from any of the ``changed`` stats
+        files (a set of file catalog keys, see: ``FileCatalog``).
+        """
+        # The cells of both meaning periods are in one entry
+        changed = set([(domain_type, var_id, experiment, inst_model, time_period, statistic)
+                       for (domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+                       in changed])
+        stale = []
+
+        for (key, payload) in self.backend.items():
+            (domain_type, experiment, time_period, lat, lon) = key
+
+            for cell_key in (bundleFromBytes(payload) or {}):
+                (var_id, statistic, inst_model) = cell_key.split("/")
+
+                if (domain_type, var_id, experiment, inst_model.replace("+", "/"), time_period, statistic) in changed:
+                    stale.append(key)
+                    break
+
+        return stale
+
 
 class FullClimateStatsCache(StatsCacheBase):
     """
     A caching class that store pre-read data on the file system with a file per location.
     """
+    NAME = "full"
     CACHE_DIR = f"{GWS}/web_cache/full"
     FILE_NAME = "cached.dat"
     FACETS = ('domain_type', 'lat', 'lon')
     FACET_MAPPERS = {"lat": "_handleLocationFloat", "lon": "_handleLocationFloat"}
 
+    def findStaleEntries(self, changed):
+        """
+        Returns a list of the keys of the entries derived from any of the ``changed`` stats files
+        (a set of file catalog keys, see: ``FileCatalog``).
+        """
+        # The (domain_type, domain) of the changed files that are in the full summary
+        changed_domains = set()
+
+        for (domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic) in changed:
+            if (time_period, experiment) in FULL_SUMMARY_SCENARIOS and inst_model in vocabs.getAllModels(domain_type) \
+                    and (var_id, statistic) in getModelItems(domain_type, inst_model):
+                changed_domains.add((domain_type, getDomain(domain_type, inst_model)))
+
+        stale = []
+
+        for (key, payload) in self.backend.items():
+            record = StatsRecord.fromBytes(payload)
+
+            # Entries that are not records are misses anyway
+            if record and set([(record.domain_type, domain) for domain in record.grid_boxes]) & changed_domains:
+                stale.append(key)
+
+        return stale
+
 
 class Location(object):
     """
@@ -186,6 +471,7 @@ class Location(object):
      * global_gb:    (lat, lon)
      * regional_gb:  (lat, lon)
      * regional_domain: str
+     * regional_gbs: OrderedDict of {regional_domain: (lat, lon)}
 
     The regional domain is the CORDEX region code.
     """
@@ -197,118 +483,94 @@ class Location(object):
     REF_VARIABLE = "tas"
 
     def __init__(self, location):
-        if location.count(",") != 2:
-            raise Exception("Location must be a comma-seperated list of three items: AssetId,Latitude,Longitude. Not: '%s'." % str(location)) 
-     
-        items = location.strip().split(",")
-        self.requested = [float(i) for i in items[1:]]
-        self.asset_id = items[0]
+        (self.asset_id, self.requested) = self._parseLocation(location)
 
-        self._setGlobalGridBox()
-        self._setRegionalGridBox()
-        # This next one should eventually replace the above _setRegionalGridBox()
-        self._setRegionalGridBoxes()
+        (lat, lon) = self.requested
+        self._setGridBoxes(*self._getGridIndex().resolve(lat, lon))
 
     def __str__(self):
         return "(%s, %s) [%s]" % (self.requested[0], self.requested[1], self.asset_id)
 
-    def _setGlobalGridBox(self):
-        """
-        Finds the nearest global grid box and sets it to ``self.global_gb``.
+    @classmethod
+    def fromMany(cls, locations):
         """
-        global_ref_file = os.path.join(self.GRID_REFERENCE_DIR, self.GLOBAL_FILE_NAME)
-        self.global_gb = self._getGridBoxForLocation(global_ref_file, domain_type = "Global") 
+        Returns a list of Location instances for a sequence of location strings.
 
-    def _setRegionalGridBox(self):
+        All locations are parsed and validated first, then the grid boxes for every
+        location are resolved together using array operations on the grid index.
         """
-        Finds the nearest global grid box and sets it to ``self.global_gb``.
-        """
-        for domain in self.REGIONAL_DOMAINS:
-            regional_ref_file = os.path.join(self.GRID_REFERENCE_DIR, self.REGIONAL_FILE_TMPL % domain)
+        parsed = [cls._parseLocation(location) for location in locations]
 
-            resp = self._getGridBoxForLocation(regional_ref_file, domain_type = "Regional")
+        lats = np.array([requested[0] for (asset_id, requested) in parsed], dtype="float64")
+        lons = np.array([requested[1] for (asset_id, requested) in parsed], dtype="float64")
 
-            if resp:
-                self.regional_gb = resp
-                self.regional_domain = domain
-                break
-        else:
-            # If location not found in any of the regional domains then return (None, None)
-            self.regional_gb = (None, None)
-            self.regional_domain = None
+        invalid = (lats < -90) | (lats > 90) | (lons < -360) | (lons > 360)
+        if invalid.any():
+            i = int(np.argmax(invalid))
+            checkValidLocation(lats[i], lons[i])
 
-    def _setRegionalGridBoxes(self):
-        """
-        Loops through regional domains and sets Ordered Dictionary ``self.regional_gbs``.
-        Each entry is: {domain: (lat, lon)}
-        """
-        self.regional_gbs = OrderedDict()
+        resolved = cls._getGridIndex().resolveMany(lats, lons)
+        instances = []
 
-        for domain in self.REGIONAL_DOMAINS:
-            regional_ref_file = os.path.join(self.GRID_REFERENCE_DIR, self.REGIONAL_FILE_TMPL % domain)
-            resp = self._getGridBoxForLocation(regional_ref_file, domain_type = "Regional")
+        for ((asset_id, requested), (global_gb, regional_gbs)) in zip(parsed, resolved):
+            location = cls.__new__(cls)
+            (location.asset_id, location.requested) = (asset_id, requested)
+            location._setGridBoxes(global_gb, regional_gbs)
+            instances.append(location)
 
-            if resp:
-                self.regional_gbs[domain] = resp
-
-        # Note: self.regional_gbs can be empty and can be tested for as such
+        return instances
 
-    def _getGridBoxForLocation(self, ref_file, domain_type):
-        "Reads grid and returns nearest point as (lat, lon)."
-        (lat, lon) = self.requested 
-
-#        f = cdms.open(ref_file)
-#        vm = f[self.REF_VARIABLE]
-        ds = xr.open_dataset(ref_file, use_cftime=True)
-        v = ds[self.REF_VARIABLE]
-        lats = get_coord_by_type(v, 'latitude').values
-        lons = get_coord_by_type(v, 'longitude').values
+    @staticmethod
+    def _parseLocation(location):
+        "Parses a location string and returns a tuple of: (asset_id, [lat, lon])."
+        if location.count(",") != 2:
+            raise Exception("Location must be a comma-seperated list of three items: AssetId,Latitude,Longitude. "
+                            "Not: '%s'." % str(location))
 
+        items = location.strip().split(",")
+        return (items[0], [float(i) for i in items[1:]])
 
-        var_lats = [float(l) for l in lats] #  vm.getLatitude()]
-        var_lons = [float(l) for l in lons] #vm.getLongitude()]
-#        f.close()
+    @classmethod
+    def _getGridIndex(cls):
+        """
+        Returns the process-wide GridIndex for the global and regional reference files.
+        If a lookup table has been built in the reference directory (see: ``grid_lookup.py``)
+        then that is returned instead.
+        """
+        lookup = getGridLookup(cls.GRID_REFERENCE_DIR, ["Global"] + cls.REGIONAL_DOMAINS)
+        if lookup:
+            return lookup
 
-        # Check longitude is in range
-        lon = self.isInLongitudeRange(lon, var_lons, domain_type)
-        if type(lon) == bool and lon == False:
-            return False
+        return getGridIndex(cls.getReferenceFiles(), cls.REF_VARIABLE)
 
-        if domain_type == "Regional":
-            if lat > max(var_lats) or lat < min(var_lats): 
-                return False
+    @classmethod
+    def getReferenceFiles(cls):
+        "Returns an Ordered Dictionary of {domain: ref_file}, starting with the global file."
+        ref_files = OrderedDict()
+        ref_files["Global"] = os.path.join(cls.GRID_REFERENCE_DIR, cls.GLOBAL_FILE_NAME)
 
-        glat = axis_utils.nudgeSingleValuesToAxisValues(lat, var_lats)
-        glon = axis_utils.nudgeSingleValuesToAxisValues(lon, var_lons)
+        for domain in cls.REGIONAL_DOMAINS:
+            ref_files[domain] = os.path.join(cls.GRID_REFERENCE_DIR, cls.REGIONAL_FILE_TMPL % domain)
 
-        return (glat, glon)
+        return ref_files
 
-    def isInLongitudeRange(self, i, lons, domain_type):
+    def _setGridBoxes(self, global_gb, regional_gbs):
         """
-        Return value of ``i`` to use if ``i`` is ``lons``. Accounts for either of these to be defined as far
-        -360 to 360.
-        If ``i`` not in ``lons``. Return False
+        Sets the grid boxes resolved from the grid index:
+         * ``self.global_gb``
+         * ``self.regional_gbs``: Ordered Dictionary of {domain: (lat, lon)}
+         * ``self.regional_gb`` and ``self.regional_domain``: from the first matching domain
         """
-        # Special treatent for wrap-around of longitude
-        if domain_type == "Global":
-            if (i > -1 and i < -0.5) or (i > 359 and i < 359.5):
-                return 359
-            elif (i >= -0.5 and i < 0) or (i >= 359.0 and i < 360):
-                return 0
-
-        if i >= min(lons) and i <= max(lons):
-            return i
-
-        # Adjust test value just in case the range of lons is defined as (-360 to 0) or (0 to 360)
-        if i < 0: 
-            i += 360
-        elif i > 0: 
-            i -= 360
-
-        if i >= min(lons) and i <= max(lons):
-            return i
+        self.global_gb = global_gb
+        self.regional_gbs = regional_gbs
 
-        return False
+        # Note: self.regional_gbs can be empty and can be tested for as such
+        if self.regional_gbs:
+            self.regional_domain, self.regional_gb = list(self.regional_gbs.items())[0]
+        else:
+            # If location not found in any of the regional domains then use (None, None)
+            self.regional_gb = (None, None)
+            self.regional_domain = None
 
     @property
     def requested_location(self):
@@ -318,6 +580,7 @@ class Location(object):
 
 class ClimateStatsExtractor(object):
 
+    DATA_DIR = f"{GWS}/outputs/data"
     DIR_TEMPLATE = f"{GWS}/outputs/data/%(dt)s/%(var_id)s/%(experiment)s/%(inst_model)s/%(time_period)s/%(res)s"
     GLOBAL_FILE_PATTERN = "%(var_id)s_*_%(experiment)s_*r*_%(meaning_period)s_%(statistic)s_change.nc"
     REGIONAL_FILE_PATTERN = "%(var_id)s_*_%(experiment)s_*r*_%(meaning_period)s_%(statistic)s_change.nc"
@@ -325,10 +588,51 @@ class ClimateStatsExtractor(object):
 
     def __init__(self):
         """
-        Set up cache.
+        Set up caches, the pool of open stats files and the file catalog (if configured).
         """
         self.cache_stats = ClimateStatsCache()
         self.cache_full = FullClimateStatsCache()
+        self.dataset_pool = getDatasetPool()
+        self.file_catalog = getFileCatalog(getSetting("file_catalog", ""))
+        self.extraction_threads = getSetting("extraction_threads", 1)
+        self.summary_processes = getSetting("summary_processes", 0)
+        self.data_cube_dir = getSetting("data_cube_dir", "")
+        self.negative_ttl = getSetting("negative_cache_ttl", 3600)
+
+        # Stale cache entries are served, and refreshed in the background, if "cache_serve_stale" is set
+        self.serve_stale = getSetting("cache_serve_stale", False)
+
+        # Stats files are read with the decode-free netCDF4 reader unless "xarray" is configured
+        reader = getSetting("point_reader", "netcdf4")
+        if reader not in ("netcdf4", "xarray"):
+            raise Exception("Unknown point reader: '%s'. Must be 'netcdf4' or 'xarray'." % reader)
+
+        self.point_reader = getPointReader() if reader == "netcdf4" else None
+
+        # Index of stats files that can be read directly from a memory map (if configured)
+        self.offset_index = getOffsetIndex(getSetting("offset_index", ""))
+
+        # Reads through the netCDF library are serialised by the NETCDF_LOCK, so only reads from
+        # the offset index can run concurrently
+        if self.extraction_threads > 1 and not self.offset_index:
+            logger.warning("Ignoring 'extraction_threads': stats files are only read concurrently "
+                           "from an 'offset_index'.")
+            self.extraction_threads = 1
+
+        # Count of stats files that could not be read (as opposed to values that are missing)
+        self.read_errors = 0
+
+    def _map(self, func, items):
+        """
+        Returns a list of ``func(item)`` for each of ``items``, in the same order as ``items``.
+        The calls are made in a thread pool if ``extraction_threads`` is greater than 1 (which
+        requires an offset index, see: ``__init__``).
+        """
+        if self.extraction_threads > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=self.extraction_threads) as executor:
+                return list(executor.map(func, items))
+
+        return [func(item) for item in items]
 
     def _addRequestedLocationToResultsDict(self, location, domain_type, results_dict):
         """
@@ -379,62 +683,26 @@ class ClimateStatsExtractor(object):
             mtype_tag = domain_type + "Data"
             data[mtype_tag] = {"Locations": []}
 
+            # Get the results for all distinct grid boxes (from the cache or in one batched extraction)
+            results_by_gb = self._getResultsForLocations(domain_type, experiment, time_period, locations, loc_holder)
+
             for location in locations:
 
                 # Check if this location has already been used
                 if loc_holder.isProcessed(location, domain_type):
                     self._addRequestedLocationToResultsDict(location, domain_type, data[mtype_tag])
                     continue
+
+                # Check if regional GB not set
+                if domain_type == "Regional" and location.regional_gb == (None, None): continue
                 
                 data_dict = self._createLocationDict(domain_type, location)
-                data_dict["Results"] = []
+                record = results_by_gb[loc_holder._extractGridBoxDetails(location, domain_type)]
+                data_dict["Results"] = formatResults(record, (time_period, experiment))
 
-                # Set up lat, lons for cache - based on domain type
-                if domain_type == "Global":
-                    cache_lat_lon = location.global_gb
-                else:
-                    cache_lat_lon = location.regional_gb 
-
-                    # Check if regional GB not set
-                    if cache_lat_lon == (None, None): continue 
-
-                # Check cache for previously calculated results
-                cached_results = self.cache_stats.get(domain_type = domain_type, experiment = experiment, time_period = time_period, 
-                                                      lat = cache_lat_lon[0], lon = cache_lat_lon[1])
-
-                if cached_results:
-                    data_dict["Results"] = cached_results 
-                else:
-                    results_dict = {}
-
-                    for var_stat in vocabs.getStatisticIds(domain_type): 
-
-                        var_id, stat = var_stat.split(":")
-                        
-                        inst_models = vocabs.getModelList(domain_type, var_id)
-
-                        for statistic in (stat,):
-                         
-                            for inst_model in inst_models:
-
-                                logger.info("Extracting data for: %s, %s, %s, %s, %s, %s, %s" % (domain_type, inst_model, experiment, time_period, var_id, statistic, location))
-                                results_dict.setdefault(inst_model, {})
-
-                                # Extract the actual data here
-                                data_resp = self.extractDataAtPoint(domain_type, inst_model, experiment, time_period, var_id, statistic, location)
-                                month_and_year_values = data_resp["values"]
-                                
-                                for (i, meaning_period) in enumerate(vocabs.meaning_periods):
-                                    
-                                    value = month_and_year_values[i]
-                                    results_dict[inst_model]["%s:%s:%s" % (var_id, meaning_period, statistic)] = value
-                      
-                    transposed_results = self._transposeResults(results_dict, domain_type)
-                    data_dict["Results"] = transposed_results 
-                    
-                    # Write to the cache
-                    self.cache_stats.put(domain_type = domain_type, experiment = experiment, time_period = time_period,
-                                   lat = cache_lat_lon[0], lon = cache_lat_lon[1], data = data_dict["Results"])
+                # Results served from stale cache entries (which are being refreshed) are marked
+                if record.stale:
+                    data_dict["Stale"] = True
 
                 # Add location to those processed
                 loc_holder.add(location, domain_type)
@@ -442,73 +710,362 @@ class ClimateStatsExtractor(object):
 
         return data
 
+    def _getResultsForLocations(self, domain_type, experiment, time_period, locations, loc_holder):
+        """
+        Returns a dictionary of {(lat, lon, domain): record} (see: ``StatsRecord``) for each distinct
+        grid box of ``locations``.
+
+        The summary cache holds a cell for each (grid box, var_id, statistic, inst_model): the cached
+        cells of all grid boxes are looked up at once, and grid boxes with missing cells are served
+        from the full summary cache where possible. Only the remaining missing cells are extracted
+        (together, so that each stats file is only read once) and are then written to the cache.
+
+        If ``serve_stale`` is set, stale cells and full records are used too: the records of their
+        grid boxes are marked as stale, and a refresh of their entries is queued.
+        """
+        # The first location found for each grid box represents that grid box
+        representatives = OrderedDict()
+
+        for location in locations:
+            if domain_type == "Regional" and location.regional_gb == (None, None): continue
+
+            gb_details = loc_holder._extractGridBoxDetails(location, domain_type)
+            representatives.setdefault(gb_details, location)
+
+        results_by_gb = {}
+
+        # Check cache for previously calculated cells (for all grid boxes at once)
+        cached = {}
+        stale = set() if self.serve_stale else None
+        cells = [cell for location in representatives.values()
+                 for cell in getCells(domain_type, getGridBoxes(domain_type, location))]
+        self._getCachedCells(domain_type, experiment, time_period, cells, cached, stale)
+
+        plan = ExtractionPlan(domain_type, experiment, time_period, list(representatives.values()), cached=cached)
+
+        # A full summary record of the grid box holds all the statistics, so can serve the request too
+        if plan.tasks and (time_period, experiment) in FULL_SUMMARY_SCENARIOS:
+            incomplete = [(gb_details, location) for (gb_details, location) in representatives.items()
+                          if plan.getMissingCells([location])]
+            stale_full = [] if self.serve_stale else None
+            full_records = self.cache_full.getMany([self._getFullRequest(domain_type, location)
+                                                    for (gb_details, location) in incomplete], stale_full)
+
+            for (i, ((gb_details, location), record)) in enumerate(zip(incomplete, full_records)):
+                if record:
+                    results_by_gb[gb_details] = record
+                    del representatives[gb_details]
+
+                    if stale_full and i in stale_full:
+                        record.stale = True
+                        self._queueRefresh(("full", domain_type) + gb_details[:2], "_extractFullRecord",
+                                           domain_type, location)
+
+            plan = ExtractionPlan(domain_type, experiment, time_period, list(representatives.values()), cached=cached)
+
+        extracted = {}
+
+        if plan.tasks:
+            # Only one process extracts the cells of a grid box at a time: wait for those being extracted
+            # elsewhere and use their cached cells
+            missing = plan.getMissingCells()
+
+            requests = [self._getCellRequest(domain_type, experiment, time_period, *cell) for cell in missing]
+
+            with self.cache_stats.lockMany(requests):
+                self._getCachedCells(domain_type, experiment, time_period, missing, cached)
+                plan = ExtractionPlan(domain_type, experiment, time_period, list(representatives.values()),
+                                      cached=cached)
+
+                if plan.tasks:
+                    extracted = self._extractAndCache(plan)
+
+        stale_gbs = set([(domain, gb) for (domain, gb, cell) in stale or ()])
+        stale_locations = OrderedDict()
 
-    def _transposeResults(self, results_dict, domain_type):
+        for (gb_details, location) in representatives.items():
+            results_by_gb[gb_details] = plan.getRecord(location, extracted)
+
+            if stale_gbs & set(getGridBoxes(domain_type, location).items()):
+                results_by_gb[gb_details].stale = True
+                stale_locations[gb_details] = location
+
+        if stale_locations:
+            self._queueRefresh(("summary", domain_type, experiment, time_period, tuple(stale_locations)),
+                               "_refreshCells", domain_type, experiment, time_period, list(stale_locations.values()))
+
+        return results_by_gb
+
+    def _queueRefresh(self, key, method, *args):
+        """
+        Queues a call of ``method`` (the name of an extractor method) with ``args`` to refresh the
+        stale cache entries identified by ``key`` in the background (see: ``StaleRefresher``).
+        Refreshes run on an extractor of their own (see: ``_refreshStaleEntries``), not this one.
+        """
+        refresher = getStaleRefresher(getSetting("stale_refresh_threads", 1),
+                                      getSetting("stale_refresh_max_pending", 100))
+        refresher.submit(key, _refreshStaleEntries, method, *args)
+
+    def _refreshCells(self, domain_type, experiment, time_period, locations):
+        """
+        Re-extracts the cells of the grid boxes of ``locations`` that are stale (or missing) and
+        rewrites them in the summary cache.
+        """
+        cells = [cell for location in locations for cell in getCells(domain_type, getGridBoxes(domain_type, location))]
+
+        requests = [self._getCellRequest(domain_type, experiment, time_period, *cell) for cell in cells]
+
+        with self.cache_stats.lockMany(requests):
+            # Only current cells are cached: cells refreshed elsewhere while waiting for the lock are not
+            # extracted again
+            cached = {}
+            self._getCachedCells(domain_type, experiment, time_period, cells, cached)
+            plan = ExtractionPlan(domain_type, experiment, time_period, locations, cached=cached)
+
+            if plan.tasks:
+                self._extractAndCache(plan)
+
+    def getSummaryRecords(self, domain_type, experiment, time_period, locations):
         """
-        Transposes the structure of the results dictionary and returns a new dictionary fit for the output structure.
+        Returns a dictionary of {(lat, lon, domain): record} of each distinct grid box of ``locations``,
+        from the caches or extracted together (and then cached). See: ``_getResultsForLocations``.
         """
-        results = []
+        return self._getResultsForLocations(domain_type, experiment, time_period, locations, ProcessedLocationsHolder())
 
-        for var_stat in vocabs.getStatisticIds(domain_type): #var_keys:
-            var_id, stat = var_stat.split(":")
+    def _getCellRequest(self, domain_type, experiment, time_period, domain, grid_box, cell):
+        """
+        Returns the summary cache request (a dictionary of the facets) for a cell (see: ``getCells``),
+        with the fingerprint of its stats files if there is a file catalog.
+        """
+        (inst_model, var_id, statistic) = cell
+        request = dict(domain_type = domain_type, experiment = experiment, time_period = time_period,
+                       lat = grid_box[0], lon = grid_box[1], var_id = var_id, statistic = statistic,
+                       inst_model = inst_model)
+
+        if self.file_catalog:
+            request["fingerprint"] = self.file_catalog.getFingerprint(
+                [(domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+                 for meaning_period in ("mon", "ann")])
 
-            inst_models = vocabs.getModelList(domain_type, var_id)
+        return request
 
-            for statistic in (stat,): #vocabs.getStatsList(var_id):
+    def _getFullRequest(self, domain_type, location):
+        """
+        Returns the full summary cache request for ``location``, with the fingerprint of all the stats
+        files of the full summary of its domains if there is a file catalog.
+        """
+        (lat, lon) = location.global_gb if domain_type == "Global" else location.regional_gb
+        request = dict(domain_type = domain_type, lat = lat, lon = lon)
 
-                for meaning_period in vocabs.meaning_periods:
-                    key = "%s:%s:%s" % (var_id, meaning_period, statistic)
+        if self.file_catalog:
+            domains = tuple(getGridBoxes(domain_type, location).keys())
+            keys = [(domain_type, var_id, experiment, inst_model, time_period, meaning_period, statistic)
+                    for (time_period, experiment) in FULL_SUMMARY_SCENARIOS
+                    for inst_model in vocabs.getAllModels(domain_type) if getDomain(domain_type, inst_model) in domains
+                    for (var_id, statistic) in getModelItems(domain_type, inst_model)
+                    for meaning_period in ("mon", "ann")]
 
-                    values = [results_dict[inst_model][key] for inst_model in inst_models]
+            # The files only depend on the domains, so the fingerprint is shared by their grid boxes
+            request["fingerprint"] = self.file_catalog.getFingerprint(keys, memo_key=("full", domain_type, domains))
 
-                    # Format as rounded strings
-                    values_rounded = values 
-                    results.append( {"VariableName": key, "Values": values_rounded} )
+        return request
+
+    def _getCachedCells(self, domain_type, experiment, time_period, cells, cached, stale=None):
+        """
+        Looks up ``cells`` (see: ``getCells``) in the summary cache, all at once, and adds the values
+        of those found to ``cached``: {(domain, (lat, lon)): {(inst_model, var_id, statistic): values}}.
+        If ``stale`` is a set, stale cells are added to ``cached`` too, and to ``stale``.
+        """
+        cells = [(domain, gb, cell) for (domain, gb, cell) in OrderedDict.fromkeys(cells)
+                 if cell not in cached.get((domain, gb), {})]
+        stale_indices = None if stale is None else []
+        requests = [self._getCellRequest(domain_type, experiment, time_period, *cell) for cell in cells]
+        found = self.cache_stats.getMany(requests, stale_indices)
+
+        for ((domain, gb, cell), values) in zip(cells, found):
+            if values is not False:
+                cached.setdefault((domain, gb), {})[cell] = values
+
+        if stale_indices:
+            stale.update([cells[i] for i in stale_indices])
+
+    def _extractAndCache(self, plan):
+        """
+        Extracts the cells of the ``plan`` that are not cached, writes them to the cache and
+        returns them (see: ``ExtractionPlan.scatter``).
+        """
+        (extracted, failed, absent) = self._runExtractionPlan(plan)
+        to_cache = []
+
+        for ((domain, gb), cells) in extracted.items():
+            for (cell, values) in cells.items():
+
+                # Do not cache values that are missing because a file could not be read
+                if (domain, gb, cell) in failed:
+                    continue
+
+                request = self._getCellRequest(plan.domain_type, plan.experiment, plan.time_period, domain, gb, cell)
+                to_cache.append(dict(request, data = values, absent = (domain, gb, cell) in absent))
+
+        # Write to the cache
+        self.cache_stats.putMany(to_cache)
+        return extracted
+
+    def _runExtractionPlan(self, plan):
+        """
+        Reads each stats file in the ``plan`` once, for all the points it is needed for.
+        Returns a tuple of (extracted, failed, absent) where ``extracted`` holds the values scattered per
+        grid box (see: ``ExtractionPlan.scatter``), ``failed`` is a set of the (domain, grid box, cell)
+        items for which a stats file could not be read and ``absent`` is a set of those for which
+        a stats file does not exist.
+        """
+        def extractTask(task):
+            logger.info("Extracting data for: %s, %s, %s, %s, %s, %s, %s (%d points)" % (
+                plan.domain_type, task.inst_model, plan.experiment, plan.time_period, task.var_id, task.statistic,
+                task.meaning_period, len(task.points)))
+
+            try:
+                file_path = self._getStatsFilePath(plan.domain_type, task.inst_model, plan.experiment,
+                                                   plan.time_period, task.var_id, task.statistic,
+                                                   task.meaning_period)
+            except StatsFileNotFound as err:
+                logger.warning(str(err))
+                n_periods = 1 if task.meaning_period == "ann" else 12
+                return (np.ma.masked_all((len(task.points), n_periods)), False, True)
+
+            return self._extractPointsFromFile(task.meaning_period, file_path, task.var_id, task.points) + (False,)
+
+        task_values = [None] * len(plan.tasks)
+        file_tasks = []
+        cube_records = {}
+        failed = set()
+        absent = set()
+
+        for (i, task) in enumerate(plan.tasks):
+            cube = getDataCube(self.data_cube_dir, task.domain)
+
+            # Read from the data cube if there is one for the domain (one read per grid box)
+            if cube:
+                # Tasks of a domain can be for different points (where some cells are cached)
+                records_key = (task.domain, tuple(task.points))
+                if records_key not in cube_records:
+                    cube_records[records_key] = cube.getRecords(plan.experiment, plan.time_period, task.points)
+
+                values = cube.getValues(cube_records[records_key], task.inst_model, task.var_id, task.statistic)
+                periods = slice(0, 12) if task.meaning_period == "mon" else slice(12, 13)
+                task_values[i] = np.ma.masked_invalid(values[:, periods])
+            else:
+                file_tasks.append(i)
 
-        return results 
+        task_results = self._map(extractTask, [plan.tasks[i] for i in file_tasks])
 
+        for (i, (values, read_error, missing)) in zip(file_tasks, task_results):
+            task_values[i] = values
+            task = plan.tasks[i]
+            cells = [(task.domain, gb, (task.inst_model, task.var_id, task.statistic)) for gb in task.points]
+
+            if read_error:
+                self.read_errors += 1
+                failed.update(cells)
+            elif missing:
+                absent.update(cells)
+
+        return (plan.scatter(task_values), failed, absent)
 
     def extractDataAtPoint(self, domain_type, inst_model, experiment, time_period, var_id, statistic, location):
         """
         Works out which data file to use, reads it and returns data value.
         Returns dictionary of: {"values": [...], "grid_box": (lat, lon)}
         """
-        values = []
-        model = inst_model.split("/")[-1]
+        (grid_box, values, read_errors, absent) = self._extractValuesAtPoint(domain_type, inst_model, experiment,
+                                                                             time_period, var_id, statistic, location)
+        self.read_errors += read_errors
+
+        return {"values": _maskedToLists(values[np.newaxis])[0], "grid_box": grid_box}
 
+    def _extractValuesAtPoint(self, domain_type, inst_model, experiment, time_period, var_id, statistic, location):
+        """
+        Reads the monthly and annual values for the location.
+        Returns a tuple of (grid_box, values, read_errors, absent) where ``values`` is a masked array of
+        the 13 values, ``read_errors`` is the number of files that could not be read and ``absent`` the
+        number of files that do not exist.
+        """
         # Defines settings based on domain type
         if domain_type == "Global":
-            res = "1_deg"
-            file_template = self.GLOBAL_FILE_PATTERN
             lat, lon = location.global_gb
         else:
             # Return if domain is not relevant to the selected grid box
             regional_domain = inst_model.split("/")[1]
 
             if regional_domain not in location.regional_gbs: 
-                return {"values": [None] * 13, "grid_box": None}
+                return (None, np.ma.masked_all(len(vocabs.meaning_periods)), 0, 0)
 
-            res = "0.5_deg"
-            file_template = self.REGIONAL_FILE_PATTERN
             lat, lon = location.regional_gbs[regional_domain]
 
-        dt = domain_type.lower()
+        values = []
+        read_errors = 0
+        absent = 0
 
         for meaning_period in ("mon", "ann"):
  
-            dr = self.DIR_TEMPLATE % vars()
-            fpattern = os.path.join(dr, file_template % vars())
-            items = glob.glob(fpattern)
-
-            if len(items) != 1:
-                raise Exception("Ambiguous response when globbing for file pattern '%s'. Matched %d responses: %s." % (fpattern, len(items), str(items)))
-
             logger.warn("Extracting data at: %s %s %s %s %s %s %s %s %s" % (domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period, lat, lon))
  
-            file_path = items[0] 
-            values.extend( self._extractPointDataFromFile(domain_type, meaning_period, file_path, var_id, lat, lon) )
+            try:
+                file_path = self._getStatsFilePath(domain_type, inst_model, experiment, time_period, var_id,
+                                                   statistic, meaning_period)
+            except StatsFileNotFound as err:
+                logger.warning(str(err))
+                values.append(np.ma.masked_all(1 if meaning_period == "ann" else 12))
+                absent += 1
+                continue
+
+            (point_values, read_error) = self._extractPointsFromFile(meaning_period, file_path, var_id, [(lat, lon)])
+
+            values.append(point_values[0])
+            read_errors += read_error
  
-        return {"values": values, "grid_box": (lat, lon)}
+        return ((lat, lon), np.ma.concatenate(values), read_errors, absent)
+
+    def _getStatsFilePath(self, domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period):
+        """
+        Returns the path to the stats file for the given facets. Raises StatsFileNotFound if there
+        is no such file: it is then known to be absent, and not looked for again in this process,
+        until the ``negative_cache_ttl`` has passed.
+        """
+        model = inst_model.split("/")[-1]
+
+        # Defines settings based on domain type
+        if domain_type == "Global":
+            res = "1_deg"
+            file_template = self.GLOBAL_FILE_PATTERN
+        else:
+            res = "0.5_deg"
+            file_template = self.REGIONAL_FILE_PATTERN
+
+        dt = domain_type.lower()
+
+        dr = self.DIR_TEMPLATE % vars()
+        fpattern = os.path.join(dr, file_template % vars())
+
+        if _absent_files.get(fpattern, 0) > time.time():
+            raise StatsFileNotFound("No stats file matches pattern (known absent): '%s'." % fpattern)
+
+        if self.file_catalog:
+            fpath = self.file_catalog.getPath(domain_type, inst_model, experiment, time_period, var_id, statistic,
+                                              meaning_period)
+            items = [fpath] if fpath else []
+        else:
+            items = glob.glob(fpattern)
+
+        if not items:
+            _addAbsentFile(fpattern, time.time() + self.negative_ttl)
+            raise StatsFileNotFound("No stats file matches pattern: '%s'." % fpattern)
+
+        if len(items) != 1:
+            raise Exception("Ambiguous response when globbing for file pattern '%s'. Matched %d responses: %s."
+                            % (fpattern, len(items), str(items)))
+
+        return items[0]
 
     def _createLocationDict(self, domain_type, location):
         "Returns a dictionary about location and mappings."
@@ -526,37 +1083,53 @@ class ClimateStatsExtractor(object):
 
     def _extractPointDataFromFile(self, domain_type, meaning_period, fpath, var_id, lat, lon):
         "Returns a list of data values for the given point."
-        logger.warn("Reading data from: %s" % fpath)
-
-        f = cdms.open(fpath)
-    
-        try: 
-            values = f(var_id, latitude=lat, longitude=lon, squeeze=1)
-        except:
-            logger.warn("Cannot extract variable '%s' from: %s (at: (%s, %s))." % (var_id, fpath, lat, lon))
-            if meaning_period == "ann":
-                values = [None]
-            else:
-                values = [None] * 12
-
-        try:
-            values = list(values)
-        except:
-            values = [float(values)]
-
-        # Replace missing values with None value
-        resp = []
-        for value in values:
-            # Test if it is a Masked Value by checking if count of non-masked items is 1
-            if (hasattr(value, "count") and (value.count() == 1)) or (type(value) == float and not N.isnan(value)): 
-                resp.append(value)
-            else:
-                resp.append(None)
+        (values, read_error) = self._extractPointsFromFile(meaning_period, fpath, var_id, [(lat, lon)])
+        self.read_errors += read_error
 
-        f.close()
+        return _maskedToLists(values)[0]
 
-        return resp
+    def _extractPointsFromFile(self, meaning_period, fpath, var_id, points):
+        """
+        Reads the values for all ``points`` (a list of (lat, lon) grid boxes) from the file in one go.
+        Returns a tuple of (values, read_error) where ``values`` is a masked array of shape
+        (len(points), number of time steps) in which missing values are masked. If the file
+        cannot be read, all values are masked and ``read_error`` is True.
+        """
+        logger.warn("Reading data from: %s" % fpath)
 
+        try:
+            # Files that are not in the offset index fall back to the point reader
+            values = self.offset_index.readPoints(fpath, var_id, points) if self.offset_index else None
+
+            if values is None and self.point_reader:
+                values = self.point_reader.readPoints(fpath, var_id, points)
+            elif values is None:
+                values = self._readPointsWithXarray(fpath, var_id, points)
+        except Exception as err:
+            logger.warning("Cannot extract variable '%s' from: %s (at: %s): %s" % (var_id, fpath, points, err))
+            n_periods = 1 if meaning_period == "ann" else 12
+            return (np.ma.masked_all((len(points), n_periods)), True)
+
+        return (values, False)
+
+    def _readPointsWithXarray(self, fpath, var_id, points):
+        "Reads the values for all ``points`` from the file, opened with full xarray decoding."
+        with self.dataset_pool.open(fpath) as ds:
+            da = ds[var_id]
+            lat_coord = get_coord_by_type(da, "latitude")
+            lon_coord = get_coord_by_type(da, "longitude")
+
+            lon_period = 360. if axis_utils.is_periodic(lon_coord.values) else None
+            lat_indices = axis_utils.nearest_axis_values(lat_coord.values, [lat for (lat, lon) in points])[1]
+            lon_indices = axis_utils.nearest_axis_values(lon_coord.values, [lon for (lat, lon) in points],
+                                                         period=lon_period)[1]
+
+            # Vectorised (pointwise) selection: returns an array of shape (time, points)
+            values = da.isel({lat_coord.name: xr.DataArray(lat_indices, dims="points"),
+                              lon_coord.name: xr.DataArray(lon_indices, dims="points")}).values
+
+        # Fill values are decoded to NaN when reading, so missing values are the ones that are not finite
+        return np.ma.masked_invalid(values.reshape(-1, len(points)).T)
 
     def extractFullSummaryCSV(self, location):
         """
@@ -576,72 +1149,204 @@ class ClimateStatsExtractor(object):
         """
         Returns data content for CSV file for given experiment.
         """
+        record = self.getFullRecord(domain_type, location)
+
+        if record is None:
+            return []
+
+        return formatCSVLines(record)
+
+    def getFullRecord(self, domain_type, location):
+        """
+        Returns the "full" StatsRecord of ``location`` for the domain type, from the cache or
+        extracted (and then cached). Returns None if the location is not in any regional domain.
+
+        If ``serve_stale`` is set, a stale cached record is returned (marked as stale) and a
+        refresh of it is queued.
+        """
+        # Check if regional GB not set
+        if domain_type == "Regional" and location.regional_gb == (None, None): return None
+
         # Check cache for previously calculated results
-        # Set up lat, lons for cache - based on domain type
-        if domain_type == "Global":
-            cache_lat_lon = location.global_gb
+        cache_request = self._getFullRequest(domain_type, location)
+        stale = [] if self.serve_stale else None
+        record = self.cache_full.getMany([cache_request], stale)[0]
+
+        if record:
+            if stale:
+                record.stale = True
+                self._queueRefresh(("full", domain_type, cache_request["lat"], cache_request["lon"]),
+                                   "_extractFullRecord", domain_type, location)
+
+            return record
+
+        return self._extractFullRecord(domain_type, location)
+
+    def _extractFullRecord(self, domain_type, location):
+        """
+        Extracts the "full" StatsRecord of ``location`` for the domain type and writes it to the
+        cache, unless a current record was cached by another worker meanwhile. Returns the record.
+        """
+        cache_request = self._getFullRequest(domain_type, location)
+
+        # Only one process extracts the record of a grid box at a time: others wait for, and use, its results
+        with self.cache_full.lockMany([cache_request]):
+            record = self.cache_full.get(**cache_request)
+
+            if record:
+                return record
+
+            (record, read_errors, absent) = self._buildFullRecord(domain_type, location)
+            self.read_errors += read_errors
+
+            # Do not cache records that are missing values because a file could not be read
+            # (records missing values because a file does not exist are cached until they expire)
+            if not read_errors:
+                self.cache_full.put(data = record, absent = absent > 0, **cache_request)
+
+        return record
+
+    def _buildFullRecord(self, domain_type, location):
+        """
+        Extracts the data for the CSV file for all time periods, experiments and models.
+        Returns a tuple of (record, read_errors, absent) where ``record`` is a "full" StatsRecord,
+        ``read_errors`` is the number of files that could not be read and ``absent`` the number
+        of files that do not exist.
+        """
+        # The work is split into units of (time_period, experiment, inst_model)
+        work_units = []
+
+        for (time_period, experiment) in FULL_SUMMARY_SCENARIOS:
+
+            for inst_model in vocabs.getAllModels(domain_type):
+                work_units.append((domain_type, time_period, experiment, inst_model, location))
+
+        if self.summary_processes > 0 and len(work_units) > 1:
+            # Fork so that workers inherit the configuration (and any overridden class settings)
+            context = multiprocessing.get_context("fork")
+
+            with ProcessPoolExecutor(max_workers=self.summary_processes, mp_context=context,
+                                     initializer=_initSummaryWorker) as executor:
+                unit_results = list(executor.map(_extractSummaryUnit, work_units))
         else:
-            cache_lat_lon = location.regional_gb
-            
-            # Check if regional GB not set
-            if cache_lat_lon == (None, None): return []
+            unit_results = [self._getSummaryUnitValues(*unit) for unit in work_units]
 
-        # Check cache for previously calculated results
-        cached_results = self.cache_full.get(domain_type = domain_type, lat = cache_lat_lon[0], lon = cache_lat_lon[1])
+        grid_boxes = {"Global": location.global_gb} if domain_type == "Global" else location.regional_gbs
+        record = StatsRecord(domain_type, "full", FULL_SUMMARY_SCENARIOS, grid_boxes)
+        read_errors = 0
+        absent = 0
 
-        if cached_results:
-            return cached_results
+        for (unit, (grid_box, items, values, unit_read_errors, unit_absent)) in zip(work_units, unit_results):
+            read_errors += unit_read_errors
+            absent += unit_absent
+            (time_period, experiment, inst_model) = unit[1:4]
 
-        lines = []
-        months = "jan feb mar apr may jun jul aug sep oct nov dec".split()
+            # Models that do not cover the location have no values
+            if grid_box is not None:
+                record.setValues((time_period, experiment), inst_model, items, values)
 
-        for time_period in ("2035", "2055"):
-            for experiment in ("rcp45", "rcp85"):
+        return (record, read_errors, absent)
 
-                    inst_models = vocabs.getAllModels(domain_type) 
+    def _getSummaryUnitValues(self, domain_type, time_period, experiment, inst_model, location):
+        """
+        Extracts the values for all variables and statistics of one model for the full summary.
+        Returns a tuple of (grid_box, items, values, read_errors, absent) where ``items`` is a list of
+        (var_id, statistic), ``values`` is a masked array of shape (len(items), 13) in which missing
+        values are masked, ``read_errors`` is the number of files that could not be read and ``absent``
+        the number of files that do not exist.
+        ``grid_box`` is None if the model does not cover the location.
+        """
+        items = getModelItems(domain_type, inst_model)
 
-                    for inst_model in inst_models:
+        def extractItem(item):
+            (var_id, statistic) = item
+            logger.info("Extracting data for: %s, %s, %s, %s, %s, %s, %s" % (
+                domain_type, inst_model, experiment, time_period, var_id, statistic, location))
 
-                        for var_id in vocabs.getVariableList(domain_type, inst_model):
+            # Extract the actual data here
+            return self._extractValuesAtPoint(domain_type, inst_model, experiment, time_period, var_id, statistic,
+                                              location)
 
-                            for statistic in vocabs.getStatsList(var_id):
+        no_values = (None, [], np.ma.masked_all((0, len(vocabs.meaning_periods))), 0, 0)
 
-                                # Ignore any models not required for this variable
-                                required_models = vocabs.getModelList(domain_type, var_id)
-                                if inst_model not in required_models: continue 
+        domain = "Global" if domain_type == "Global" else inst_model.split("/")[1]
+        cube = getDataCube(self.data_cube_dir, domain)
 
-                                logger.info("Extracting data for: %s, %s, %s, %s, %s, %s, %s" % (domain_type, inst_model, experiment, time_period, var_id, statistic, location))
-                                (var_name, units) = vocabs.variables[var_id]
+        # Read the whole record of the grid box from the data cube if there is one for the domain
+        if cube:
+            if domain_type == "Global":
+                grid_box = location.global_gb
+            else:
+                grid_box = location.regional_gbs.get(domain)
 
-                                # Extract the actual data here
-                                data_resp = self.extractDataAtPoint(domain_type, inst_model, experiment, time_period, var_id, statistic, location)
+            if grid_box is None or not items:
+                return no_values
 
-                                # Do not provide data if grid box is not in regional domain
-                                if data_resp["grid_box"] == None:
-                                    continue
-                                else:
-                                    actual_lat, actual_lon = data_resp["grid_box"]
+            record = cube.getRecords(experiment, time_period, [grid_box])
+            values = np.ma.masked_invalid([cube.getValues(record, inst_model, var_id, statistic)[0]
+                                           for (var_id, statistic) in items])
+            return (grid_box, items, values, 0, 0)
 
-                                month_and_year_values = data_resp["values"]
+        responses = self._map(extractItem, items)
+
+        if not responses or responses[0][0] is None:
+            return no_values
+
+        values = np.ma.stack([response[1] for response in responses])
+        return (responses[0][0], items, values, sum([response[2] for response in responses]),
+                sum([response[3] for response in responses]))
+
+
+# Extractor used by each process in the full summary (or cache warm-up) process pool
+_summary_extractor = None
+
+
+def _initSummaryWorker():
+    "Initialises a full summary (or cache warm-up, see: ``cache_warmup.py``) worker process."
+    global _summary_extractor
+
+    global _absent_files_lock
+
+    # Do not share open file handles (or locks) with the parent process: it may be the threaded
+    # server, or have refresh threads, so a lock may have been held by another thread when it forked
+    dataset_pool.resetAfterFork()
+
+    for module in (cache_backends, grid_index, grid_lookup, data_cube, file_catalog, offset_index, point_reader,
+                   stale_refresh):
+        module.resetAfterFork()
+
+    _absent_files_lock = threading.Lock()
+    _summary_extractor = ClimateStatsExtractor()
+
+    # The worker is already one of a pool of processes: do not start another pool from it
+    _summary_extractor.summary_processes = 0
+
+
+def _extractSummaryUnit(unit):
+    "Process pool entry point. See: ``ClimateStatsExtractor._getSummaryUnitValues``."
+    return _summary_extractor._getSummaryUnitValues(*unit)
+
+
+# Extractor used by each stale refresh thread, so that refreshes do not share the state of the
+# extractors serving requests
+_refresh_extractors = threading.local()
+
+
+def _refreshStaleEntries(method, *args):
+    """
+    Stale refresh entry point: calls ``method`` (the name of a ClimateStatsExtractor method) with
+    ``args`` on the extractor of the current refresh thread, which is created on first use.
+    """
+    extractor = getattr(_refresh_extractors, "extractor", None)
+
+    if extractor is None:
+        extractor = _refresh_extractors.extractor = ClimateStatsExtractor()
+
+        # Refreshes re-extract stale entries, so must not serve (or queue refreshes of) them
+        extractor.serve_stale = False
+
+    return getattr(extractor, method)(*args)
 
-                                # Build CSV line
-                                line = "%s,%s,%s,%s,%s,%s,%s,%s,%s," % (time_period, experiment, inst_model, domain_type.title(), var_name, statistic, units, actual_lat, actual_lon)
- 
-                                # Handle missing values 
-                                values_string = ""
-                                for value in month_and_year_values:
-                                    if type(value) == types.NoneType: 
-                                        values_string += "NaN,"
-                                    else:
-                                        values_string += "%0.2f," % value
-                                
-                                line += values_string[:-1] + "\n" 
-                                lines.append(line)
-
-        # Write to cache:
-        self.cache_full.put(domain_type = domain_type, lat = cache_lat_lon[0], lon = cache_lat_lon[1], data = lines)
-        return lines
-                             
 
 if __name__ == "__main__":
 
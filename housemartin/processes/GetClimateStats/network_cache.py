@@ -0,0 +1,432 @@
+"""
+network_cache.py
+================
+
+A cache backend (see: ``cache_backends.py``) on a networked key-value store that speaks
+the Redis protocol (RESP), such as Redis, Valkey or KeyDB. All the WPS nodes share the
+store, instead of each reading the caches through a shared file system.
+
+ * ``RedisBackend``: looks up all the keys of a request in one pipeline of MGET commands,
+   and writes all the entries of a request in one pipeline of SET commands, so each takes
+   a single round-trip. Keys are prefixed with the name of the cache (e.g. "housemartin:summary:"),
+   so both caches can share a database. Entries are evicted by the server under its
+   ``maxmemory-policy``, not by ``housemartin cache gc``. Locks are keys that expire, so the
+   locks of a worker that dies are released, and are released by a script that only deletes
+   the locks still held by the worker.
+ * ``FakeRedisServer``: an in-process server of the same protocol (for the commands used by
+   ``RedisBackend``), for tests and for development without a Redis server.
+
+"""
+
+# Standard library imports
+import os
+import time
+import uuid
+import socket
+import hashlib
+import fnmatch
+import logging
+import threading
+import socketserver
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Local imports
+from cache_backends import CacheBackend, LOCK_STRIPES, LOCK_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of keys in a single MGET (or DEL) command: larger requests are pipelined
+REDIS_BATCH_SIZE = 1000
+
+# Number of keys returned by each SCAN command
+REDIS_SCAN_COUNT = 1000
+
+# Script that deletes the lock keys (KEYS) still held with a token (ARGV[1]), so a lock that has
+# expired and been taken by another worker is not released. It runs atomically on the server.
+RELEASE_LOCKS_SCRIPT = """
+local released = 0
+for i, key in ipairs(KEYS) do
+    if redis.call("GET", key) == ARGV[1] then
+        released = released + redis.call("DEL", key)
+    end
+end
+return released
+"""
+
+
+class RESPError(Exception):
+    "An error reply from the server."
+
+
+def _toBytes(value):
+    "Returns a command argument as bytes."
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+
+    return str(value).encode("utf-8")
+
+
+def _encodeCommand(args):
+    "Returns a command (a list of arguments) encoded as a RESP array of bulk strings."
+    args = [_toBytes(arg) for arg in args]
+    return b"".join([b"*%d\r\n" % len(args)] + [b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args])
+
+
+def _readReply(reader):
+    """
+    Reads a reply from ``reader`` (a binary file). Error replies are returned as RESPError
+    instances, so that the rest of a pipeline can still be read.
+    """
+    line = reader.readline()
+
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the cache server.")
+
+    (kind, value) = (line[:1], line[1:-2])
+
+    if kind == b"+":
+        return value.decode("utf-8")
+    elif kind == b"-":
+        return RESPError(value.decode("utf-8"))
+    elif kind == b":":
+        return int(value)
+    elif kind == b"$":
+        size = int(value)
+        return None if size < 0 else reader.read(size + 2)[:-2]
+    elif kind == b"*":
+        size = int(value)
+        return None if size < 0 else [_readReply(reader) for i in range(size)]
+
+    raise ConnectionError("Unknown reply from the cache server: %r" % line)
+
+
+class RESPConnection(object):
+    "A connection to a server of the Redis protocol, on which commands are sent in pipelines."
+
+    def __init__(self, host, port, db=0, password=None, timeout=10.):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+
+        if password:
+            self.execute("AUTH", password)
+
+        if db:
+            self.execute("SELECT", db)
+
+    def pipeline(self, commands):
+        """
+        Sends all ``commands`` (lists of arguments) at once, then reads their replies.
+        Returns a list of the replies, or raises the first error reply.
+        """
+        self.sock.sendall(b"".join([_encodeCommand(command) for command in commands]))
+        replies = [_readReply(self.reader) for command in commands]
+
+        for reply in replies:
+            if isinstance(reply, RESPError):
+                raise reply
+
+        return replies
+
+    def execute(self, *command):
+        "Sends a single command and returns its reply."
+        return self.pipeline([command])[0]
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisBackend(CacheBackend):
+    """
+    Stores entries in a server of the Redis protocol at ``url`` (e.g. "redis://:password@host:6379/0"),
+    under keys prefixed with "<namespace>:". Each thread (and process) has its own connection.
+    """
+
+    def __init__(self, url, namespace, timeout=10.):
+        parsed = urlparse(url)
+
+        if parsed.scheme != "redis":
+            raise Exception("Cache URL must be a 'redis://' URL, not: '%s'." % url)
+
+        self.url = url
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.db = int(parsed.path.strip("/") or 0)
+        self.password = parsed.password
+        self.timeout = timeout
+        self.prefix = ("%s:" % namespace).encode("utf-8")
+        self._local = threading.local()
+
+        # Number of round-trips made to the server by this process
+        self.round_trips = 0
+
+    def _connect(self):
+        "Returns the connection of the current thread, opening it if needed."
+        conn = getattr(self._local, "conn", None)
+
+        # Connections must not be shared with forked processes
+        if conn is None or self._local.pid != os.getpid():
+            conn = RESPConnection(self.address[0], self.address[1], db=self.db, password=self.password,
+                                  timeout=self.timeout)
+            (self._local.conn, self._local.pid) = (conn, os.getpid())
+
+        return conn
+
+    def _pipeline(self, commands):
+        "Sends ``commands`` in one round-trip, reconnecting (once) if the connection has been lost."
+        for attempt in (1, 2):
+            conn = self._connect()
+
+            try:
+                self.round_trips += 1
+                return conn.pipeline(commands)
+            except (OSError, ConnectionError) as err:
+                self._local.conn = None
+                conn.close()
+
+                if attempt == 2:
+                    raise Exception("Cannot reach the cache server at: %s (%s)" % (self.url, err))
+
+                logger.warning("Lost connection to the cache server at: %s (%s). Reconnecting." % (self.url, err))
+
+    def _getKey(self, key):
+        return self.prefix + "/".join(key).encode("utf-8")
+
+    def _scanKeys(self):
+        "Yields the (server) keys of all entries."
+        cursor = b"0"
+
+        while True:
+            command = ["SCAN", cursor, "MATCH", self.prefix + b"*", "COUNT", REDIS_SCAN_COUNT]
+            (cursor, keys) = self._pipeline([command])[0]
+
+            for key in keys:
+                yield key
+
+            if int(cursor) == 0:
+                break
+
+    def getMany(self, keys):
+        if not keys:
+            return []
+
+        commands = [["MGET"] + [self._getKey(key) for key in keys[start:start + REDIS_BATCH_SIZE]]
+                    for start in range(0, len(keys), REDIS_BATCH_SIZE)]
+        return [data for reply in self._pipeline(commands) for data in reply]
+
+    def putMany(self, items):
+        if items:
+            self._pipeline([["SET", self._getKey(key), data] for (key, data) in items])
+
+    def deleteMany(self, keys):
+        for key in keys:
+            logger.warn("Deleting cache entry: %s" % "/".join(key))
+
+        if keys:
+            self._pipeline([["DEL"] + [self._getKey(key) for key in keys[start:start + REDIS_BATCH_SIZE]]
+                            for start in range(0, len(keys), REDIS_BATCH_SIZE)])
+
+    def _scanEntryKeys(self):
+        "Yields lists of (at most REDIS_BATCH_SIZE of) the (server) keys of all entries."
+        batch = []
+
+        for key in self._scanKeys():
+            # Lock keys are not entries
+            if not key.startswith(self.prefix + b"lock:"):
+                batch.append(key)
+
+            if len(batch) == REDIS_BATCH_SIZE:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def items(self):
+        for batch in self._scanEntryKeys():
+            for item in self._getItems(batch):
+                yield item
+
+    def _getItems(self, keys):
+        "Returns a list of (key, data) of the entries of (server) ``keys`` that still exist."
+        if not keys:
+            return []
+
+        values = self._pipeline([["MGET"] + keys])[0]
+        return [(tuple(key[len(self.prefix):].decode("utf-8").split("/")), data)
+                for (key, data) in zip(keys, values) if data is not None]
+
+    def touchMany(self, keys):
+        # The server records accesses itself (for its eviction policy)
+        pass
+
+    def getUsage(self):
+        (entries, nbytes) = (0, 0)
+
+        # Only the sizes of the entries are read (a batch of STRLEN commands per round-trip), not their data
+        for batch in self._scanEntryKeys():
+            sizes = self._pipeline([["STRLEN", key] for key in batch])
+            entries += len(sizes)
+            nbytes += sum(sizes)
+
+        return {"entries": entries, "bytes": nbytes, "oldest_access": None}
+
+    def getVictims(self, policy, limit):
+        # Entries are evicted by the server
+        return []
+
+    def reindexAccess(self):
+        return 0
+
+    @contextmanager
+    def lockKeys(self, lock_dir, keys, timeout=600.):
+        """
+        Holds a lock for each of ``keys`` on the server (see: ``cache_backends.lockKeys``). Each lock is a
+        key that expires after ``timeout`` seconds, so the locks of a worker that dies are released.
+        ``lock_dir`` is not used.
+        """
+        stripes = sorted(set([int(hashlib.sha1("/".join(key).encode()).hexdigest(), 16) % LOCK_STRIPES
+                              for key in keys]))
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        held = []
+
+        try:
+            for stripe in stripes:
+                lock_key = self.prefix + b"lock:%04d" % stripe
+
+                while not self._pipeline([["SET", lock_key, token, "NX", "PX", int(timeout * 1000)]])[0]:
+                    if time.time() > deadline:
+                        break
+
+                    time.sleep(LOCK_POLL_INTERVAL)
+                else:
+                    held.append(lock_key)
+                    continue
+
+                logger.warning("Timed out waiting for cache locks on: %s" % self.url)
+                break
+
+            yield
+        finally:
+            if held:
+                # Only release the locks that have not expired (and been taken by another worker)
+                self._pipeline([["EVAL", RELEASE_LOCKS_SCRIPT, len(held)] + held + [token]])
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """
+    An in-process server of the Redis protocol, holding its data in memory. It implements the
+    commands used by ``RedisBackend`` (PING, AUTH, SELECT, GET, MGET, STRLEN, SET [NX] [PX], DEL, SCAN
+    and EVAL of RELEASE_LOCKS_SCRIPT, which is run in Python). Call ``start()`` to serve from a background
+    thread, and use its ``url`` as the cache URL.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        socketserver.ThreadingTCPServer.__init__(self, address, _FakeRedisHandler)
+
+        # Dictionary of {key: (value, expiry time or None)}
+        self.data = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "redis://%s:%d/0" % self.server_address
+
+    def start(self):
+        "Serves requests from a background thread. Returns the server."
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _get(self, key, now):
+        "Returns the value of ``key``, or None if it is not set (or has expired). Must be called with the lock held."
+        (value, expires) = self.data.get(key, (None, None))
+
+        if expires is not None and expires <= now:
+            del self.data[key]
+            return None
+
+        return value
+
+    def execute(self, command):
+        "Returns the reply to a ``command`` (a list of bytes)."
+        name = command[0].decode("utf-8").upper()
+        args = command[1:]
+        now = time.time()
+
+        with self.lock:
+            if name == "PING":
+                return "PONG"
+            elif name in ("AUTH", "SELECT"):
+                return "OK"
+            elif name == "GET":
+                return self._get(args[0], now)
+            elif name == "MGET":
+                return [self._get(key, now) for key in args]
+            elif name == "STRLEN":
+                return len(self._get(args[0], now) or b"")
+            elif name == "SET":
+                options = [option.decode("utf-8").upper() for option in args[2:]]
+
+                if "NX" in options and self._get(args[0], now) is not None:
+                    return None
+
+                expires = now + int(options[options.index("PX") + 1]) / 1000. if "PX" in options else None
+                self.data[args[0]] = (args[1], expires)
+                return "OK"
+            elif name == "DEL":
+                return len([self.data.pop(key) for key in args if self._get(key, now) is not None])
+            elif name == "SCAN":
+                # All keys are returned by the first SCAN
+                options = dict(zip([option.decode("utf-8").upper() for option in args[1::2]], args[2::2]))
+                pattern = options.get("MATCH", b"*").decode("latin-1")
+                keys = [key for key in list(self.data) if self._get(key, now) is not None]
+                return [b"0", [key for key in keys if fnmatch.fnmatchcase(key.decode("latin-1"), pattern)]]
+            elif name == "EVAL":
+                if args[0].decode("utf-8") != RELEASE_LOCKS_SCRIPT:
+                    return RESPError("ERR only the lock release script can be run")
+
+                nkeys = int(args[1])
+                (keys, token) = (args[2:2 + nkeys], args[2 + nkeys])
+                return len([self.data.pop(key) for key in keys if self._get(key, now) == token])
+
+        return RESPError("ERR unknown command '%s'" % name)
+
+
+def _encodeReply(reply):
+    "Returns a reply encoded in RESP."
+    if reply is None:
+        return b"$-1\r\n"
+    elif isinstance(reply, RESPError):
+        return b"-%s\r\n" % str(reply).encode("utf-8")
+    elif isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode("utf-8")
+    elif isinstance(reply, int):
+        return b":%d\r\n" % reply
+    elif isinstance(reply, list):
+        return b"".join([b"*%d\r\n" % len(reply)] + [_encodeReply(item) for item in reply])
+
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+class _FakeRedisHandler(socketserver.StreamRequestHandler):
+    "Serves the commands of one connection to a FakeRedisServer."
+
+    def handle(self):
+        while True:
+            try:
+                command = _readReply(self.rfile)
+            except (OSError, ConnectionError):
+                break
+
+            if not isinstance(command, list) or not command:
+                break
+
+            self.wfile.write(_encodeReply(self.server.execute(command)))
@@ -0,0 +1,307 @@
+"""
+offset_index.py
+===============
+
+An index of the byte offsets of the data in the climate stats files, so that points
+can be read from a memory map of a file without any calls into the netCDF/HDF5 library.
+
+Most stats files hold a small variable that is stored contiguously and uncompressed.
+For these, the index records the offset, dtype (including byte order) and shape of
+the data, along with the layout needed to find and decode a grid box (see:
+``point_reader.FileLayout``). Files that are chunked, compressed or modified since
+they were indexed are not read from the index, so they fall back to the normal reader.
+
+The index is built offline (see: ``buildOffsetIndex``) and saved as a JSON file.
+
+"""
+
+# Standard library imports
+import os
+import sys
+import json
+import mmap
+import logging
+import threading
+from collections import OrderedDict
+
+# Third-party imports
+import numpy as np
+import netCDF4
+
+# Local imports
+import axis_utils
+import dataset_pool
+from point_reader import FileLayout, readLayout, decodeValues
+
+logger = logging.getLogger(__name__)
+
+OFFSET_INDEX_VERSION = 1
+
+BYTE_ORDERS = {"little": "<", "big": ">", "native": "<" if sys.byteorder == "little" else ">"}
+
+
+class FileOffsets(object):
+    "The location and layout of the data of one variable in a stats file."
+
+    def __init__(self, var_id, mtime, size, offset, dtype, shape, layout):
+        self.var_id = var_id
+        self.mtime = mtime
+        self.size = size
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.layout = layout
+
+
+def _isContiguous(var):
+    "Returns True if ``var`` is stored contiguously and without any filters (such as compression)."
+    filters = var.filters() or {}
+    return var.chunking() == "contiguous" and not any(filters.values())
+
+
+def _findOffset(fpath, data):
+    """
+    Returns the offset of the bytes of ``data`` in the file, or None if they are not found
+    exactly once (e.g. storage has not been allocated because the variable was never written).
+    """
+    target = data.tobytes()
+
+    with open(fpath, "rb") as reader:
+        with mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = mm.find(target)
+
+            if offset < 0 or mm.find(target, offset + 1) >= 0:
+                return None
+
+    return offset
+
+
+def indexFile(fpath, var_id):
+    """
+    Returns the FileOffsets of variable ``var_id`` in the stats file, or None if the
+    variable cannot be read directly from the file (because it is chunked or compressed).
+    """
+    stat = os.stat(fpath)
+
+    with dataset_pool.NETCDF_LOCK:
+        ds = netCDF4.Dataset(fpath)
+
+        try:
+            ds.set_auto_maskandscale(False)
+            var = ds.variables[var_id]
+
+            if not _isContiguous(var):
+                return None
+
+            layout = readLayout(ds, var_id, stat.st_mtime_ns)
+            dtype = var.dtype.newbyteorder(BYTE_ORDERS[var.endian()])
+            data = np.asarray(var[:]).astype(dtype)
+        finally:
+            ds.close()
+
+    # The data is stored as it is in memory, so its offset can be found by searching for it
+    offset = _findOffset(fpath, data)
+    if offset is None:
+        return None
+
+    return FileOffsets(var_id, stat.st_mtime_ns, stat.st_size, offset, dtype.str, data.shape, layout)
+
+
+class OffsetIndex(object):
+    """
+    An index of {path: FileOffsets} of stats files that can be read directly.
+
+    Up to ``max_open`` memory maps of files are kept open.
+    """
+
+    def __init__(self, entries=None, max_open=256):
+        self.entries = entries or {}
+        self.max_open = max_open
+
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Counts of files indexed and re-used during the last build
+        self.indexed_files = 0
+        self.reused_files = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _getMap(self, fpath, entry):
+        "Returns an array view of the data of the file, backed by a (cached) memory map."
+        key = (fpath, entry.mtime)
+
+        with self._lock:
+            view = self._maps.get(key)
+
+            if view is not None:
+                self._maps.move_to_end(key)
+                return view
+
+        with open(fpath, "rb") as reader:
+            mm = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = np.ndarray(entry.shape, dtype=entry.dtype, buffer=mm, offset=entry.offset)
+
+        with self._lock:
+            self._maps[key] = view
+
+            # Memory maps are closed when the last view of them is released
+            while len(self._maps) > self.max_open:
+                self._maps.popitem(last=False)
+
+        return view
+
+    def readPoints(self, fpath, var_id, points):
+        """
+        Reads the values for all ``points`` (a list of (lat, lon) grid boxes) from a memory map of the file.
+        Returns a masked array of shape (len(points), number of time steps) as ``NetCDF4PointReader.readPoints``,
+        or None if the file is not in the index or has been modified since it was indexed.
+        """
+        entry = self.entries.get(fpath)
+        if entry is None or entry.var_id != var_id:
+            return None
+
+        stat = os.stat(fpath)
+        if stat.st_mtime_ns != entry.mtime or stat.st_size != entry.size:
+            return None
+
+        layout = entry.layout
+        view = self._getMap(fpath, entry)
+
+        lat_indices = layout.lats.nearest([lat for (lat, lon) in points])[1]
+        lon_indices = layout.lons.nearest([lon for (lat, lon) in points])[1]
+
+        # Move the latitude and longitude axes to the end, so indexing them gives (time steps, points)
+        view = np.moveaxis(view, (layout.lat_axis, layout.lon_axis), (-2, -1))
+        values = view[..., lat_indices, lon_indices].reshape(-1, len(points)).T
+
+        return decodeValues(layout, values.astype(entry.dtype.newbyteorder("=")))
+
+    def save(self, path):
+        "Writes the index to the JSON file at ``path`` (via a temporary file and rename)."
+        axes = OrderedDict()
+        files = []
+
+        def axisId(axis):
+            return axes.setdefault(tuple(axis.values.tolist()), len(axes))
+
+        for (fpath, entry) in sorted(self.entries.items()):
+            layout = entry.layout
+            files.append({"path": fpath, "var_id": entry.var_id, "mtime": entry.mtime, "size": entry.size,
+                          "offset": entry.offset, "dtype": entry.dtype.str, "shape": list(entry.shape),
+                          "lat_axis": layout.lat_axis, "lon_axis": layout.lon_axis,
+                          "lats": axisId(layout.lats), "lons": axisId(layout.lons),
+                          "fill_values": layout.fill_values.tolist(),
+                          "scale_factor": None if layout.scale_factor is None else float(layout.scale_factor),
+                          "add_offset": None if layout.add_offset is None else float(layout.add_offset)})
+
+        content = {"version": OFFSET_INDEX_VERSION, "axes": [list(axis) for axis in axes], "files": files}
+
+        dr = os.path.dirname(path)
+        if dr and not os.path.isdir(dr):
+            os.makedirs(dr)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as writer:
+            json.dump(content, writer)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        "Reads an index from the JSON file at ``path``."
+        with open(path) as reader:
+            content = json.load(reader)
+
+        if content.get("version") != OFFSET_INDEX_VERSION:
+            raise Exception("Unsupported offset index version in: %s" % path)
+
+        lat_axes = {}
+        lon_axes = {}
+
+        # Axes are shared by all the files on the same grid
+        def getAxis(axes, i, periodic=False):
+            if i not in axes:
+                values = content["axes"][i]
+                period = 360. if periodic and axis_utils.is_periodic(values) else None
+                axes[i] = axis_utils.SortedAxis(values, period=period)
+
+            return axes[i]
+
+        entries = {}
+
+        for item in content["files"]:
+            layout = FileLayout(item["mtime"], item["lat_axis"], item["lon_axis"], getAxis(lat_axes, item["lats"]),
+                                getAxis(lon_axes, item["lons"], periodic=True), len(item["shape"]),
+                                np.array(item["fill_values"]), item["scale_factor"], item["add_offset"])
+            entries[item["path"]] = FileOffsets(item["var_id"], item["mtime"], item["size"], item["offset"],
+                                                item["dtype"], item["shape"], layout)
+
+        return cls(entries)
+
+
+def buildOffsetIndex(files, previous=None):
+    """
+    Returns an OffsetIndex of the stats files in ``files`` (a list of (path, var_id)) that
+    can be read directly. Entries for files that are unmodified since the ``previous`` index
+    was built are re-used.
+    """
+    index = OffsetIndex()
+    previous = previous.entries if previous else {}
+    skipped = 0
+
+    for (fpath, var_id) in files:
+        stat = os.stat(fpath)
+        entry = previous.get(fpath)
+
+        if entry and entry.var_id == var_id and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+            index.entries[fpath] = entry
+            index.reused_files += 1
+            continue
+
+        entry = indexFile(fpath, var_id)
+        index.indexed_files += 1
+
+        if entry:
+            index.entries[fpath] = entry
+        else:
+            skipped += 1
+
+    logger.info("Indexed %d files (%d re-used, %d cannot be read directly)" % (len(index), index.reused_files, skipped))
+    return index
+
+
+# Process-wide store of offset indexes, keyed by index file path
+_offset_indexes = {}
+_offset_indexes_lock = threading.Lock()
+
+
+def getOffsetIndex(path):
+    """
+    Returns the OffsetIndex saved at ``path``, or None if ``path`` is not set or does not exist.
+    The index is re-loaded when the file is modified (e.g. after a rebuild).
+    """
+    if not path or not os.path.isfile(path):
+        return None
+
+    mtime = os.stat(path).st_mtime_ns
+
+    with _offset_indexes_lock:
+        cached = _offset_indexes.get(path)
+
+        if not cached or cached[0] != mtime:
+            cached = (mtime, OffsetIndex.load(path))
+            _offset_indexes[path] = cached
+
+        return cached[1]
+
+
+def resetAfterFork():
+    "Replaces the locks of the loaded indexes, and of each index, in a forked worker process."
+    global _offset_indexes_lock
+    _offset_indexes_lock = threading.Lock()
+
+    for (mtime, index) in _offset_indexes.values():
+        index._lock = threading.Lock()
@@ -0,0 +1,188 @@
+"""
+point_reader.py
+===============
+
+A lightweight reader of point values from the climate stats files that uses the
+low-level ``netCDF4`` API instead of opening each file with full xarray (and cftime)
+decoding.
+
+The layout of each file (its latitude and longitude axes, the dimensions of the
+variable and its fill values) is read once and kept in a small metadata index, keyed
+by path and modification time, so reading a point is a single indexed read of the
+variable (typically one chunk).
+
+"""
+
+# Standard library imports
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+import axis_utils
+import dataset_pool
+
+
+# Ways of recognising the latitude and longitude coordinate variables
+AXIS_IDENTIFIERS = {"latitude": (("lat", "latitude"), ("degrees_north", "degree_north", "degrees_N")),
+                    "longitude": (("lon", "longitude"), ("degrees_east", "degree_east", "degrees_E"))}
+
+# The layout of a variable in a stats file
+FileLayout = namedtuple("FileLayout", ["mtime", "lat_axis", "lon_axis", "lats", "lons", "n_dims",
+                                       "fill_values", "scale_factor", "add_offset"])
+
+
+def _findAxis(ds, var, axis_type):
+    "Returns the position in the dimensions of ``var`` of the ``axis_type`` (latitude or longitude) axis."
+    (names, units) = AXIS_IDENTIFIERS[axis_type]
+
+    for (i, dim) in enumerate(var.dimensions):
+        if dim not in ds.variables:
+            continue
+
+        coord = ds.variables[dim]
+        attrs = dict((key, coord.getncattr(key)) for key in coord.ncattrs())
+
+        if attrs.get("standard_name") == axis_type or attrs.get("units") in units or dim.lower() in names:
+            return i
+
+    raise Exception("Cannot find %s axis of variable: %s" % (axis_type, var.name))
+
+
+def readLayout(ds, var_id, mtime):
+    "Returns the FileLayout of variable ``var_id`` in the (open) netCDF4 Dataset ``ds``."
+    var = ds.variables[var_id]
+
+    lat_axis = _findAxis(ds, var, "latitude")
+    lon_axis = _findAxis(ds, var, "longitude")
+
+    lats = ds.variables[var.dimensions[lat_axis]][:]
+    lons = ds.variables[var.dimensions[lon_axis]][:]
+    lon_period = 360. if axis_utils.is_periodic(lons) else None
+
+    attrs = dict((key, var.getncattr(key)) for key in var.ncattrs())
+    fill_values = [np.asarray(attrs[key]).ravel() for key in ("_FillValue", "missing_value") if key in attrs]
+    fill_values = np.concatenate(fill_values) if fill_values else np.array([])
+
+    return FileLayout(mtime, lat_axis, lon_axis, axis_utils.SortedAxis(lats),
+                      axis_utils.SortedAxis(lons, period=lon_period), len(var.dimensions),
+                      fill_values, attrs.get("scale_factor"), attrs.get("add_offset"))
+
+
+def decodeValues(layout, values):
+    """
+    Returns a masked array of the raw ``values`` read from a file with the given ``layout``,
+    with the fill values and non-finite values masked and the scale factor and offset (if any) applied.
+    """
+    mask = ~np.isfinite(values)
+
+    if layout.fill_values.size:
+        mask |= np.isin(values, layout.fill_values)
+
+    if layout.scale_factor is not None:
+        values = values * layout.scale_factor
+    if layout.add_offset is not None:
+        values = values + layout.add_offset
+
+    return np.ma.masked_array(values, mask=mask)
+
+
+class NetCDF4PointReader(object):
+    """
+    Reads the values at points from stats files held open in a pool of ``netCDF4.Dataset``
+    handles (see: ``getDatasetPool("netcdf4")``).
+
+    Up to ``max_layouts`` file layouts are cached. A layout (and any open handle) is
+    dropped when the modification time of its file changes.
+    """
+
+    def __init__(self, pool, max_layouts=4096):
+        self.pool = pool
+        self.max_layouts = max_layouts
+
+        self._layouts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _getLayout(self, fpath, var_id, mtime):
+        "Returns the cached layout for the file and variable, or None if it is not cached or out of date."
+        key = (fpath, var_id)
+
+        with self._lock:
+            layout = self._layouts.get(key)
+
+            if layout is None:
+                return None
+
+            if layout.mtime == mtime:
+                self._layouts.move_to_end(key)
+                return layout
+
+            del self._layouts[key]
+
+        # The file has been replaced, so its handle in the pool (if any) is out of date
+        self.pool.discard(fpath)
+        return None
+
+    def _putLayout(self, fpath, var_id, layout):
+        with self._lock:
+            self._layouts[(fpath, var_id)] = layout
+
+            while len(self._layouts) > self.max_layouts:
+                self._layouts.popitem(last=False)
+
+    def readPoints(self, fpath, var_id, points):
+        """
+        Reads the values for all ``points`` (a list of (lat, lon) grid boxes) from the file.
+        Returns a masked array of shape (len(points), number of time steps) in which fill
+        values and non-finite values are masked.
+        """
+        mtime = os.stat(fpath).st_mtime_ns
+        layout = self._getLayout(fpath, var_id, mtime)
+
+        with self.pool.open(fpath) as ds:
+            with dataset_pool.NETCDF_LOCK:
+                if layout is None:
+                    layout = readLayout(ds, var_id, mtime)
+                    self._putLayout(fpath, var_id, layout)
+
+                lat_indices = layout.lats.nearest([lat for (lat, lon) in points])[1]
+                lon_indices = layout.lons.nearest([lon for (lat, lon) in points])[1]
+
+                var = ds.variables[var_id]
+                index = [slice(None)] * layout.n_dims
+                values = []
+
+                for (ilat, ilon) in zip(lat_indices, lon_indices):
+                    index[layout.lat_axis] = ilat
+                    index[layout.lon_axis] = ilon
+                    values.append(np.asarray(var[tuple(index)]).ravel())
+
+        return decodeValues(layout, np.array(values).reshape(len(points), -1))
+
+
+# Process-wide reader shared across requests
+_point_reader = None
+_point_reader_lock = threading.Lock()
+
+
+def getPointReader():
+    "Returns the process-wide NetCDF4PointReader, which reads from the process-wide pool of netCDF4 handles."
+    global _point_reader
+    pool = dataset_pool.getDatasetPool("netcdf4")
+
+    with _point_reader_lock:
+        # The pool is replaced in forked worker processes (see: ``dataset_pool.resetAfterFork``)
+        if _point_reader is None or _point_reader.pool is not pool:
+            _point_reader = NetCDF4PointReader(pool)
+
+        return _point_reader
+
+
+def resetAfterFork():
+    "Discards the process-wide reader (and its lock) inherited from the parent process."
+    global _point_reader, _point_reader_lock
+    _point_reader = None
+    _point_reader_lock = threading.Lock()
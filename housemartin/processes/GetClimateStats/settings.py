@@ -0,0 +1,51 @@
+"""
+settings.py
+===========
+
+Access to the ``[climatestats]`` section of the service configuration (see: ``default.cfg``).
+
+"""
+
+from pywps import configuration
+
+SECTION = "climatestats"
+
+# Accepted values of boolean options (as in ``configparser``)
+BOOLEAN_VALUES = {"1": True, "yes": True, "true": True, "on": True,
+                  "0": False, "no": False, "false": False, "off": False}
+
+
+def getSetting(option, default):
+    """
+    Returns the value of ``option`` converted to the type of ``default``.
+    Returns ``default`` if the option is not set.
+    """
+    value = configuration.get_config_value(SECTION, option)
+
+    if value == "":
+        return default
+
+    if isinstance(default, bool):
+        # pywps converts "true" and "false" itself
+        if isinstance(value, bool):
+            return value
+
+        if value.lower() not in BOOLEAN_VALUES:
+            raise Exception("Invalid boolean value for option '%s': %s" % (option, value))
+
+        return BOOLEAN_VALUES[value.lower()]
+    elif isinstance(default, int):
+        return int(value)
+    elif isinstance(default, float):
+        return float(value)
+
+    return value
+
+
+def getSizeSetting(option, default):
+    """
+    Returns the value of a size ``option`` (such as "256mb") in bytes.
+    Returns ``default`` (also a size string) converted to bytes if the option is not set.
+    """
+    value = configuration.get_config_value(SECTION, option) or default
+    return int(configuration.get_size_mb(value) * 1024 * 1024)
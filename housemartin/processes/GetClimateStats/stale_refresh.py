@@ -0,0 +1,110 @@
+"""
+stale_refresh.py
+================
+
+A bounded queue of background refreshes of stale cache entries.
+
+When the ``[climatestats]`` option ``cache_serve_stale`` is set, cache entries that were
+derived from stats files that have changed since (see: ``FileCatalog.getFingerprint``) are
+served straight away and a refresh, which re-extracts and rewrites the entries, is queued
+here. Refreshes run in a small pool of threads in the worker process:
+
+ * A refresh of entries that already have one pending is not queued again.
+ * Once ``max_pending`` refreshes are pending, further refreshes are dropped: the entries
+   stay stale, so a refresh is queued again by the next request that is served them.
+
+"""
+
+# Standard library imports
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class StaleRefresher(object):
+    "Runs refreshes of stale cache entries in ``threads`` background threads."
+
+    def __init__(self, threads=1, max_pending=100):
+        self.max_pending = max_pending
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="stale-refresh")
+
+        # Counts of the refreshes that were completed, failed and dropped (as the queue was full)
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, key, func, *args):
+        """
+        Queues ``func(*args)`` to refresh the entries identified by ``key`` (a hashable value).
+        Returns True if it was queued, or False if a refresh of ``key`` is already pending or
+        the queue is full.
+        """
+        with self.condition:
+            if key in self.pending:
+                return False
+
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                logger.warning("Refresh queue is full: not refreshing stale entries of: %s" % (key,))
+                return False
+
+            self.pending.add(key)
+
+        self.executor.submit(self._run, key, func, args)
+        return True
+
+    def _run(self, key, func, args):
+        try:
+            func(*args)
+            succeeded = True
+        except Exception as err:
+            logger.error("Cannot refresh stale entries of: %s (%s)" % (key, err))
+            succeeded = False
+
+        with self.condition:
+            self.pending.discard(key)
+
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        "Waits until no refreshes are pending (or the ``timeout``, in seconds). Returns True if none are pending."
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout)
+
+
+# Process-wide refresher, shared by all the extractors in a worker
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def getStaleRefresher(threads=1, max_pending=100):
+    """
+    Returns the process-wide StaleRefresher. It is created with ``threads`` and ``max_pending``
+    the first time it is requested in a process.
+    """
+    global _refresher
+
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = StaleRefresher(threads, max_pending)
+
+        return _refresher
+
+
+def resetAfterFork():
+    """
+    Discards the refresher inherited from the parent process: its threads do not run in a
+    forked process, and its condition may have been held by one of them when it forked.
+    """
+    global _refresher, _refresher_lock
+    _refresher = None
+    _refresher_lock = threading.Lock()
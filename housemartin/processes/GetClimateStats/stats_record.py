@@ -0,0 +1,370 @@
+"""
+stats_record.py
+===============
+
+The payload of the climate stats caches: a compact, versioned binary record of the
+values of a grid box, from which both the GetClimateStats (JSON) results and the
+GetFullClimateStats CSV lines are formatted.
+
+A ``StatsRecord`` holds a float32 array of shape:
+
+    (scenario, item, meaning_period, model)
+
+where a scenario is a (time_period, experiment), an item is a (var_id, statistic) and
+missing values are NaN. The items and models are laid out from the vocabs:
+
+ * "summary" records hold the vital statistics (as returned by GetClimateStats).
+ * "full" records hold all statistics (as in the GetFullClimateStats CSV), so they
+   can also serve the summary.
+
+Records are serialised as:
+
+    <magic> <version: uint8> <header length: uint32> <header: JSON> <values>
+
+The header holds the signature of the vocabs used for the layout, the scenarios, the
+grid box of each domain, the compression ("none" or "zlib") of the values and the
+fingerprint of the stats files the values were read from (see: ``FileCatalog.getFingerprint``). Payloads
+of another version, or of another layout of the vocabs, are not decoded.
+
+Records (and cells) with values that are missing because a stats file does not exist are
+"negative" entries: they also hold the time (in seconds since the epoch) at which they
+expire, after which they are not decoded, so the files are looked for again.
+
+The summary cache holds cells: the 12 monthly and the annual value of one (grid box,
+var_id, statistic, inst_model), serialised (see: ``cellToBytes``) as:
+
+    <cell magic> <version: uint8> <fingerprint length: uint32> <fingerprint: ASCII> <values>
+
+or, for negative cells:
+
+    <negative cell magic> <version: uint8> <header length: uint32> <expires: float64> <fingerprint: ASCII> <values>
+
+Cells do not depend on the layout of the vocabs, so they stay valid when models or
+statistics are added to the vocabs. The cells of a grid box are stored in one entry, a
+bundle (see: ``bundleToBytes``), serialised as:
+
+    <bundle magic> <version: uint8> <index length: uint32> <index: JSON> <cells>
+
+where the index is a list of the [key, length] of each cell, in the order of the cells.
+
+"""
+
+# Standard library imports
+import json
+import time
+import zlib
+import struct
+import hashlib
+from collections import namedtuple, OrderedDict
+
+# Third-party imports
+import numpy as np
+
+# Local imports
+from vocabs import vocabs
+
+
+MAGIC = b"HMSR"
+CELL_MAGIC = b"HMSC"
+NEGATIVE_CELL_MAGIC = b"HMSN"
+BUNDLE_MAGIC = b"HMSB"
+VERSION = 1
+PREFIX = struct.Struct("<4sBI")
+EXPIRES = struct.Struct("<d")
+
+LAYOUTS = ("summary", "full")
+COMPRESSIONS = ("none", "zlib")
+
+# The items (a list of (var_id, statistic)) and models of a layout, and a signature of the vocabs they came from
+RecordLayout = namedtuple("RecordLayout", ["items", "models", "signature"])
+
+
+def getDomain(domain_type, inst_model):
+    "Returns the domain that ``inst_model`` covers: 'Global' or the CORDEX domain code."
+    if domain_type == "Global":
+        return "Global"
+
+    return inst_model.split("/")[1]
+
+
+def getModelItems(domain_type, inst_model):
+    "Returns a list of the (var_id, statistic) items of ``inst_model`` in the full summary."
+    items = []
+
+    for var_id in vocabs.getVariableList(domain_type, inst_model):
+
+        # Ignore any models not required for this variable
+        if inst_model not in vocabs.getModelList(domain_type, var_id):
+            continue
+
+        items.extend([(var_id, statistic) for statistic in vocabs.getStatsList(var_id)])
+
+    return items
+
+
+def getLayout(domain_type, layout):
+    "Returns the RecordLayout of ``layout`` ('summary' or 'full') for the domain type."
+    if layout == "summary":
+        items = [tuple(var_stat.split(":")) for var_stat in vocabs.getStatisticIds(domain_type)]
+    elif layout == "full":
+        items = [(var_id, statistic) for var_id in vocabs.getAllVariables(domain_type)
+                 for statistic in vocabs.getStatsList(var_id)]
+    else:
+        raise Exception("Unknown record layout: '%s'. Must be one of: %s." % (layout, ", ".join(LAYOUTS)))
+
+    models = list(vocabs.getAllModels(domain_type))
+    content = json.dumps([domain_type, layout, items, models, vocabs.meaning_periods])
+
+    return RecordLayout(items, models, hashlib.sha1(content.encode("utf-8")).hexdigest()[:16])
+
+
+class StatsRecord(object):
+    """
+    The values of a grid box for each of ``scenarios`` (a list of (time_period, experiment)),
+    in the given ``layout``. ``grid_boxes`` is a dictionary of {domain: (lat, lon)} of the
+    domains that cover the location. Values are NaN until they are set.
+
+    ``fingerprint`` is that of the stats files the values were read from (if known). ``expires``
+    is the time at which a negative record expires (0 if the record does not expire). ``stale``
+    is set on records served from stale cache entries (it is not serialised).
+    """
+
+    def __init__(self, domain_type, layout, scenarios, grid_boxes, values=None, fingerprint="", expires=0.):
+        self.domain_type = domain_type
+        self.fingerprint = fingerprint
+        self.expires = expires
+        self.stale = False
+        self.layout = layout
+        self.scenarios = [tuple(scenario) for scenario in scenarios]
+        self.grid_boxes = dict((domain, tuple(grid_box)) for (domain, grid_box) in grid_boxes.items())
+
+        (self.items, self.models, self.signature) = getLayout(domain_type, layout)
+        self._item_indices = dict((item, i) for (i, item) in enumerate(self.items))
+        self._model_indices = dict((inst_model, i) for (i, inst_model) in enumerate(self.models))
+
+        shape = (len(self.scenarios), len(self.items), len(vocabs.meaning_periods), len(self.models))
+        self.values = np.full(shape, np.nan, dtype="float32") if values is None else values.reshape(shape)
+
+    def setValues(self, scenario, inst_model, items, values):
+        "Sets the ``values`` (a masked array of shape (len(items), 13)) of ``items`` of a model in a scenario."
+        indices = [self._item_indices[item] for item in items]
+        self.values[self.scenarios.index(scenario), indices, :, self._model_indices[inst_model]] = \
+            np.ma.filled(np.ma.asarray(values, dtype="float32"), np.nan)
+
+    def getValues(self, scenario, inst_model, items):
+        """
+        Returns an array of shape (len(items), 13) of the values of ``items`` of a model in a
+        scenario (NaN if missing).
+        """
+        indices = [self._item_indices[item] for item in items]
+        return self.values[self.scenarios.index(scenario), indices, :, self._model_indices[inst_model]]
+
+    def getModelValues(self, scenario, item, inst_models):
+        """
+        Returns an array of shape (len(inst_models), 13) of the values of an item of each model in
+        a scenario (NaN if missing).
+        """
+        indices = [self._model_indices[inst_model] for inst_model in inst_models]
+        return self.values[self.scenarios.index(scenario), self._item_indices[item], :, indices]
+
+    def toBytes(self, compression="none", fingerprint=None, expires=None):
+        """
+        Returns the record serialised, with the values compressed with ``compression`` ('none' or 'zlib').
+        The ``fingerprint`` and the time at which the record ``expires`` default to those of the record.
+        """
+        fingerprint = self.fingerprint if fingerprint is None else fingerprint
+        expires = self.expires if expires is None else expires
+
+        if compression not in COMPRESSIONS:
+            raise Exception("Unknown record compression: '%s'. Must be one of: %s." %
+                            (compression, ", ".join(COMPRESSIONS)))
+
+        header = json.dumps({"layout": self.layout, "signature": self.signature, "domain_type": self.domain_type,
+                             "scenarios": self.scenarios, "grid_boxes": self.grid_boxes,
+                             "compression": compression, "fingerprint": fingerprint,
+                             "expires": expires}).encode("utf-8")
+
+        data = self.values.astype("<f4").tobytes()
+        if compression == "zlib":
+            data = zlib.compress(data, 1)
+
+        return PREFIX.pack(MAGIC, VERSION, len(header)) + header + data
+
+    @classmethod
+    def fromBytes(cls, payload):
+        """
+        Returns the record serialised in ``payload``, or None if it is not a (valid) record of
+        this version for the current vocabs, such as the pickled entries of older versions,
+        or if it is a negative record that has expired. The values of the record are a read-only
+        view of ``payload`` (if not compressed).
+        """
+        if len(payload) < PREFIX.size:
+            return None
+
+        (magic, version, header_size) = PREFIX.unpack_from(payload)
+        if magic != MAGIC or version != VERSION:
+            return None
+
+        try:
+            start = PREFIX.size + header_size
+            header = json.loads(bytes(payload[PREFIX.size:start]).decode("utf-8"))
+
+            if header["signature"] != getLayout(header["domain_type"], header["layout"]).signature:
+                return None
+
+            expires = header.get("expires", 0.)
+            if expires and expires <= time.time():
+                return None
+
+            data = memoryview(payload)[start:]
+            if header["compression"] == "zlib":
+                data = zlib.decompress(data)
+
+            return cls(header["domain_type"], header["layout"], header["scenarios"], header["grid_boxes"],
+                       values=np.frombuffer(data, dtype="<f4"), fingerprint=header.get("fingerprint", ""),
+                       expires=expires)
+        except (ValueError, KeyError, zlib.error):
+            return None
+
+
+def cellToBytes(values, fingerprint="", expires=0.):
+    """
+    Returns the values of a cell (a masked array of the 12 monthly and the annual value) serialised,
+    with the ``fingerprint`` of the stats files they were read from. The cell is a negative cell,
+    which expires at ``expires``, if that is set.
+    """
+    data = np.ma.filled(np.ma.asarray(values, dtype="float32"), np.nan).astype("<f4")
+
+    if data.shape != (len(vocabs.meaning_periods),):
+        raise Exception("A cell must have %d values, not: %s." % (len(vocabs.meaning_periods), data.shape))
+
+    header = fingerprint.encode("ascii")
+    if expires:
+        prefix = PREFIX.pack(NEGATIVE_CELL_MAGIC, VERSION, EXPIRES.size + len(header))
+        return prefix + EXPIRES.pack(expires) + header + data.tobytes()
+
+    return PREFIX.pack(CELL_MAGIC, VERSION, len(header)) + header + data.tobytes()
+
+
+def cellFromBytes(payload):
+    """
+    Returns a tuple of (values, fingerprint) of the cell serialised in ``payload``, where ``values``
+    is a masked array (in which missing values are masked). Returns None if it is not a (valid)
+    cell of this version, or if it is a negative cell that has expired.
+    """
+    if len(payload) < PREFIX.size:
+        return None
+
+    (magic, version, header_size) = PREFIX.unpack_from(payload)
+    start = PREFIX.size + header_size
+
+    if magic not in (CELL_MAGIC, NEGATIVE_CELL_MAGIC) or version != VERSION or \
+            len(payload) != start + 4 * len(vocabs.meaning_periods):
+        return None
+
+    header_start = PREFIX.size
+
+    if magic == NEGATIVE_CELL_MAGIC:
+        if header_size < EXPIRES.size or EXPIRES.unpack_from(payload, header_start)[0] <= time.time():
+            return None
+
+        header_start += EXPIRES.size
+
+    try:
+        fingerprint = bytes(payload[header_start:start]).decode("ascii")
+    except UnicodeDecodeError:
+        return None
+
+    return (np.ma.masked_invalid(np.frombuffer(payload, dtype="<f4", offset=start)), fingerprint)
+
+
+def bundleToBytes(cells):
+    "Returns the ``cells`` (a dictionary of {key: serialised cell}) of a grid box serialised as one bundle."
+    index = json.dumps([[key, len(payload)] for (key, payload) in cells.items()]).encode("utf-8")
+    data = b"".join(bytes(payload) for payload in cells.values())
+    return PREFIX.pack(BUNDLE_MAGIC, VERSION, len(index)) + index + data
+
+
+def bundleFromBytes(payload):
+    """
+    Returns an ordered dictionary of {key: serialised cell} of the bundle serialised in ``payload``
+    (see: ``cellFromBytes``), or None if it is not a (valid) bundle of this version.
+    """
+    if len(payload) < PREFIX.size:
+        return None
+
+    (magic, version, index_size) = PREFIX.unpack_from(payload)
+    if magic != BUNDLE_MAGIC or version != VERSION:
+        return None
+
+    start = PREFIX.size + index_size
+    cells = OrderedDict()
+
+    try:
+        for (key, size) in json.loads(bytes(payload[PREFIX.size:start]).decode("utf-8")):
+            cells[key] = memoryview(payload)[start:start + size]
+            start += size
+    except (ValueError, TypeError):
+        return None
+
+    return cells if start == len(payload) else None
+
+
+def _toLists(values):
+    "Returns a list of lists of values from a 2D array, with None for missing (NaN) values."
+    return [[None if value != value else value for value in row] for row in values.tolist()]
+
+
+def formatResults(record, scenario):
+    """
+    Returns the GetClimateStats results of a scenario of the ``record``, as a list of:
+    {"VariableName": "<var_id>:<meaning_period>:<statistic>", "Values": [value of each model]}
+    """
+    results = []
+
+    for var_stat in vocabs.getStatisticIds(record.domain_type):
+        var_id, statistic = var_stat.split(":")
+        inst_models = vocabs.getModelList(record.domain_type, var_id)
+
+        # Transposed to one list of the values of each model per meaning period
+        values = record.getModelValues(scenario, (var_id, statistic), inst_models)
+
+        for (meaning_period, period_values) in zip(vocabs.meaning_periods, _toLists(values.T)):
+            results.append({"VariableName": "%s:%s:%s" % (var_id, meaning_period, statistic), "Values": period_values})
+
+    return results
+
+
+def formatCSVLines(record):
+    """
+    Returns the GetFullClimateStats CSV lines of a "full" ``record``, for each scenario and
+    each model that covers the location.
+    """
+    lines = []
+    domain_type = record.domain_type
+
+    for scenario in record.scenarios:
+        (time_period, experiment) = scenario
+
+        for inst_model in vocabs.getAllModels(domain_type):
+            grid_box = record.grid_boxes.get(getDomain(domain_type, inst_model))
+
+            # Do not provide data if grid box is not in regional domain
+            if grid_box is None:
+                continue
+
+            (actual_lat, actual_lon) = grid_box
+            items = getModelItems(domain_type, inst_model)
+
+            values = _toLists(record.getValues(scenario, inst_model, items))
+
+            for ((var_id, statistic), month_and_year_values) in zip(items, values):
+                (var_name, units) = vocabs.variables[var_id]
+
+                line = "%s,%s,%s,%s,%s,%s,%s,%s,%s," % (time_period, experiment, inst_model, domain_type.title(),
+                                                        var_name, statistic, units, actual_lat, actual_lon)
+                line += ",".join(["NaN" if value is None else "%0.2f" % value
+                                  for value in month_and_year_values]) + "\n"
+                lines.append(line)
+
+    return lines
@@ -0,0 +1,47 @@
+import numpy as np
+
+import axis_utils
+
+
+def test_nearest_increasing_and_decreasing_axes():
+    axis = np.arange(-89.5, 90, 1.0)
+
+    for ax in (axis, axis[::-1]):
+        values, indices = axis_utils.nearest_axis_values(ax, [-50.1, 0.2, 89.9, -95])
+        assert values.tolist() == [-50.5, 0.5, 89.5, -89.5]
+        assert ax[indices].tolist() == values.tolist()
+
+
+def test_nearest_periodic_0_to_360():
+    lons = np.arange(0, 360, 1.0)
+    assert axis_utils.is_periodic(lons)
+
+    values, indices = axis_utils.nearest_axis_values(lons, [-0.7, -0.3, 359.4, 359.8, -2, 0.3, 720.2], period=360)
+    assert values.tolist() == [359, 0, 359, 0, 358, 0, 0]
+    assert indices.tolist() == [359, 0, 359, 0, 358, 0, 0]
+
+
+def test_nearest_periodic_minus_180_to_180():
+    lons = np.arange(-179.75, 180, 0.5)
+
+    values, indices = axis_utils.nearest_axis_values(lons, [180.1, 359.9, -180.1], period=360)
+    assert values.tolist() == [-179.75, -0.25, 179.75]
+    assert lons[indices].tolist() == values.tolist()
+
+
+def test_nearest_ties_resolve_to_first_in_axis():
+    axis = [10., 11., 12.]
+    assert axis_utils.nearest_axis_values(axis, [10.5])[0].tolist() == [10.]
+    assert axis_utils.nearest_axis_values(axis[::-1], [10.5])[0].tolist() == [11.]
+
+
+def test_wrap_to_range():
+    wrapped = axis_utils.wrap_to_range([-100, 260, 10, 50], -171.75, -22.25)
+    assert wrapped[:2].tolist() == [-100, -100]
+    assert np.isnan(wrapped[2:]).all()
+
+
+def test_scalar_helpers():
+    axis = [0., 1., 2.]
+    assert axis_utils.find_nearest(axis, 1.2) == 1.
+    assert axis_utils.nudgeSingleValuesToAxisValues(1.7, axis) == 2.
@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+
+import cache_backends
+
+
+KEYS = [("Global", "rcp45", "2035", "51.5000", "m0.5000"),
+        ("Regional", "rcp85", "2055", "m21.7500", "318.2500")]
+
+
+def _backends(tmp_path):
+    return [cache_backends.createCacheBackend("filesystem", str(tmp_path / "fs"), "cached.dat", 5),
+            cache_backends.SQLiteBackend(str(tmp_path / "cache.sqlite"))]
+
+
+def test_get_and_put_many(tmp_path):
+    for backend in _backends(tmp_path):
+        assert backend.getMany(KEYS) == [None, None]
+
+        backend.putMany([(KEYS[1], b"\x00\x01payload")])
+        assert backend.getMany(KEYS) == [None, b"\x00\x01payload"]
+
+        backend.put(KEYS[0], b"line 1\n")
+        backend.put(KEYS[1], b"")
+        assert backend.getMany(KEYS) == [b"line 1\n", b""]
+
+        backend.delete(KEYS[0])
+        assert backend.get(KEYS[0]) is None
+        assert list(backend.items()) == [(KEYS[1], b"")]
+
+
+def test_get_many_in_batches(tmp_path):
+    backend = cache_backends.SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    keys = [("Global", "rcp45", "2035", str(i), "0") for i in range(1234)]
+
+    backend.putMany([(key, str(i).encode()) for (i, key) in enumerate(keys)])
+    assert backend.getMany(keys[::-1] + [KEYS[0]]) == [str(i).encode() for i in range(1233, -1, -1)] + [None]
+
+
+def test_migrate_file_system_cache_to_sqlite(tmp_path):
+    (source, target) = _backends(tmp_path)
+    source.putMany([(key, "/".join(key).encode()) for key in KEYS])
+
+    assert cache_backends.migrateCache(source, target, batch_size=1) == 2
+    assert sorted(target.items()) == sorted((key, "/".join(key).encode()) for key in KEYS)
+
+
+def test_memory_tier(tmp_path, monkeypatch):
+    backend = cache_backends.SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    backend.put(KEYS[0], b"0123456789" * 10)
+
+    memory = cache_backends.MemoryTier(backend, max_bytes=150, ttl=60)
+    assert memory.getMany(KEYS) == [b"0123456789" * 10, None]
+    assert (memory.hits, memory.misses, len(memory)) == (0, 2, 1)
+
+    assert memory.get(KEYS[0]) == b"0123456789" * 10
+    assert memory.hits == 1
+
+    # Writes go to both tiers, and the least recently used entry is evicted when memory is full
+    memory.put(KEYS[1], b"x" * 100)
+    assert backend.get(KEYS[1]) == b"x" * 100
+    assert (len(memory), memory.evictions) == (1, 1)
+    assert memory.nbytes <= 150
+
+    # Expired entries are read from the backend again
+    now = cache_backends.time.time()
+    monkeypatch.setattr(cache_backends.time, "time", lambda: now + 61)
+    assert memory.get(KEYS[1]) == b"x" * 100
+    assert memory.misses == 3
+
+    memory.delete(KEYS[1])
+    assert memory.get(KEYS[1]) is None and backend.get(KEYS[1]) is None
+
+
+def test_collect_garbage(tmp_path):
+    keys = [("Global", "rcp45", "2035", str(i), "0") for i in range(6)]
+
+    for backend in _backends(tmp_path):
+        for (i, key) in enumerate(keys):
+            backend.put(key, b"x" * 100)
+            for hit in range(len(keys) - i):
+                backend.access.touchMany([key])
+
+        usage = backend.getUsage()
+        assert (usage["entries"], usage["bytes"]) == (6, usage["bytes"] // 6 * 6)
+
+        # The least recently used entry goes first, then the least frequently used ones
+        lock_dir = str(tmp_path / "locks")
+        assert cache_backends.collectGarbage(backend, lock_dir, max_entries=5, policy="lru") == (1, usage["bytes"] // 6)
+        assert backend.get(keys[0]) is None
+        assert backend.get(keys[1]) is not None
+
+        (evicted, freed) = cache_backends.collectGarbage(backend, lock_dir, max_bytes=usage["bytes"] // 2,
+                                                         policy="lfu", batch_size=1)
+        assert evicted == 2
+        assert backend.getMany(keys[1:]) == [b"x" * 100] * 3 + [None] * 2
+
+        # Entries missing from the access index are added back with their size
+        backend.access.removeMany(keys)
+        assert backend.getUsage()["entries"] == 0
+        assert backend.reindexAccess() == 3
+        assert backend.getUsage()["entries"] == 3
+
+
+def test_collect_garbage_waits_for_locked_entries(tmp_path):
+    backend = cache_backends.SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    backend.putMany([(key, b"x") for key in KEYS])
+    lock_dir = str(tmp_path / "locks")
+
+    # A worker is writing the least recently used entry
+    with cache_backends.lockKeys(lock_dir, KEYS[:1]):
+        collector = threading.Thread(target=cache_backends.collectGarbage, args=(backend, lock_dir),
+                                     kwargs={"max_entries": 1})
+        collector.start()
+        time.sleep(0.2)
+        assert backend.get(KEYS[0]) == b"x"
+
+    collector.join()
+    assert backend.getMany(KEYS) == [None, b"x"]
+
+
+def test_file_system_hits_are_recorded_in_batches(tmp_path, monkeypatch):
+    backend = cache_backends.createCacheBackend("filesystem", str(tmp_path / "fs"), "cached.dat", 5)
+    backend.putMany([(key, b"x") for key in KEYS])
+
+    touches = []
+    touch = backend.touched.touch
+    monkeypatch.setattr(backend.touched, "touch", lambda keys: touches.append(sorted(keys)) or touch(keys))
+    monkeypatch.setattr(cache_backends, "ACCESS_FLUSH_SIZE", 2)
+
+    # Reads do not write to the access index until a batch is due
+    assert backend.getMany(KEYS[:1]) == [b"x"]
+    assert backend.getMany(KEYS[:1]) == [b"x"]
+    assert touches == []
+
+    assert backend.getMany(KEYS) == [b"x", b"x"]
+    assert touches == [sorted(KEYS)]
+
+    # The hits so far are passed on before the index is read
+    backend.get(KEYS[1])
+    assert backend.getVictims("lfu", 1) == [(KEYS[0], 1)]
+    assert touches == [sorted(KEYS), [KEYS[1]]]
+
+
+def test_sqlite_journal_mode(tmp_path, monkeypatch):
+    backend = cache_backends.SQLiteBackend(str(tmp_path / "local.sqlite"))
+    assert backend.connections.connect().execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    # WAL is not used on a network file system
+    monkeypatch.setattr(cache_backends, "isNetworkFileSystem", lambda path: True)
+    backend = cache_backends.SQLiteBackend(str(tmp_path / "network.sqlite"))
+    assert backend.connections.connect().execute("PRAGMA journal_mode").fetchone() == ("delete",)
+
+
+def test_network_file_systems(tmp_path, monkeypatch):
+    mounts = tmp_path / "mounts"
+    mounts.write_text("/dev/sda1 / ext4 rw 0 0\n"
+                      "server:/gws /gws nfs4 rw 0 0\n"
+                      "/dev/sdb1 /gws/a\\040b ext4 rw 0 0\n")
+
+    real_open = open
+    monkeypatch.setattr("builtins.open", lambda path, *args: real_open(str(mounts) if path == "/proc/mounts" else path,
+                                                                       *args))
+
+    assert cache_backends.isNetworkFileSystem("/gws/nopw/cache")
+    assert not cache_backends.isNetworkFileSystem("/gwsx/cache")
+    assert not cache_backends.isNetworkFileSystem("/gws/a b/cache")
+
+
+def test_snapshot(tmp_path, monkeypatch):
+    source = cache_backends.SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    source.putMany([(KEYS[0], b"first"), (KEYS[1], b"second"), (("Global", "rcp45", "2035", "0.5000", "0.5000"), b"")])
+
+    snapshot_dir = str(tmp_path / "snapshots")
+    path = cache_backends.writeSnapshot(source, snapshot_dir)
+    assert os.path.basename(path) == "snapshot-000001.dat"
+
+    monkeypatch.setattr(cache_backends, "SNAPSHOT_CHECK_INTERVAL", 0.)
+    backend = cache_backends.createCacheBackend("snapshot", str(tmp_path), "cached.dat", 5)
+    found = backend.getMany(KEYS + [("Global", "rcp85", "2035", "51.5000", "m0.5000")])
+
+    assert [None if data is None else bytes(data) for data in found] == [b"first", b"second", None]
+    assert isinstance(found[0], memoryview)
+    assert backend.getUsage()["entries"] == 3 and backend.getUsage()["bytes"] == len(b"firstsecond")
+    assert [key for (key, data) in backend.items()] == sorted([key for (key, data) in source.items()])
+
+    # Writes are ignored (without locking), and a new snapshot replaces the current one for open backends
+    with backend.lockKeys(str(tmp_path / "missing" / "locks"), KEYS):
+        backend.putMany([(KEYS[0], b"changed")])
+
+    assert not os.path.exists(str(tmp_path / "missing"))
+    source.putMany([(KEYS[0], b"changed")])
+
+    for version in (2, 3):
+        cache_backends.writeSnapshot(source, snapshot_dir)
+
+    assert bytes(backend.get(KEYS[0])) == b"changed"
+    assert bytes(found[0]) == b"first"
+    assert sorted(os.listdir(snapshot_dir)) == ["current", "snapshot-000002.dat", "snapshot-000003.dat"]
@@ -0,0 +1,125 @@
+import os
+import time
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import lib
+import cache_backends
+
+
+SHARED_KEYS = [("Global", "rcp45", "2035", "%d.0000" % i, "0.0000") for i in range(3)]
+N_WORKERS = 8
+
+# Cells of the summary cache needed by every worker: two grid boxes, with two cells each
+SHARED_CELLS = [(lat, cell) for lat in (51.5, 52.5)
+                for cell in (("MOHC/HadGEM2-ES", "tas", "avg"), ("NCAR/CCSM4", "pr", "99p"))]
+
+
+def _createBackend(kind, cache_dir):
+    return cache_backends.createCacheBackend(kind, cache_dir, "cached.dat", 5)
+
+
+def _createCache(kind, cache_dir):
+    "Returns a summary cache in ``cache_dir`` that stores entries in a backend of the given ``kind``."
+    cache = type("TestCache", (lib.ClimateStatsCache,), {"CACHE_DIR": cache_dir})()
+    cache.backend = cache.createBackend(kind)
+    return cache
+
+
+def _getCellRequest(lat, cell):
+    (inst_model, var_id, statistic) = cell
+    return dict(domain_type="Global", experiment="rcp45", time_period="2035", lat=lat, lon=0.5,
+                var_id=var_id, statistic=statistic, inst_model=inst_model)
+
+
+def _extractOnce(args):
+    """
+    Gets the cells from the cache, computing (and logging) the missing ones as the extractor does:
+    look up, lock the missing cells, look them up again and compute the ones still missing.
+    """
+    (kind, cache_dir, cells, log_path) = args
+    cache = _createCache(kind, cache_dir)
+    requests = [_getCellRequest(*cell) for cell in cells]
+
+    missing = [request for (request, values) in zip(requests, cache.getMany(requests)) if values is False]
+
+    with cache.lockMany(missing):
+        missing = [request for (request, values) in zip(missing, cache.getMany(missing)) if values is False]
+
+        with open(log_path, "a") as writer:
+            writer.write("".join(["%(lat)s/%(inst_model)s/%(var_id)s/%(statistic)s\n" % request
+                                  for request in missing]))
+
+        time.sleep(0.2)
+        cache.putMany([dict(request, data=np.ma.masked_array(np.full(13, os.getpid() + request["lat"])))
+                       for request in missing])
+
+    return [values.tolist() for values in cache.getMany(requests)]
+
+
+def _write(args):
+    (kind, cache_dir, n) = args
+    backend = _createBackend(kind, cache_dir)
+
+    for i in range(n):
+        backend.put(SHARED_KEYS[0], bytes([i % 256]) * 200000)
+
+
+def _read(args):
+    "Returns the number of reads of the key that were missing or incomplete."
+    (kind, cache_dir, n) = args
+    backend = _createBackend(kind, cache_dir)
+    bad = 0
+
+    for i in range(n):
+        data = backend.get(SHARED_KEYS[0])
+        if data is None or len(data) != 200000 or len(set(data)) != 1:
+            bad += 1
+
+    return bad
+
+
+@pytest.mark.parametrize("kind", ["filesystem", "sqlite"])
+def test_single_flight_across_processes(tmp_path, kind):
+    cache_dir = str(tmp_path / "summary")
+    log_path = str(tmp_path / "computed.log")
+    os.mkdir(cache_dir)
+
+    # Each worker needs the shared cells and one of its own
+    work = [(kind, cache_dir, SHARED_CELLS + [(60. + i, ("MOHC/HadGEM2-ES", "tas", "avg"))], log_path)
+            for i in range(N_WORKERS)]
+
+    with multiprocessing.get_context("fork").Pool(N_WORKERS) as pool:
+        results = pool.map(_extractOnce, work)
+
+    with open(log_path) as reader:
+        computed = reader.read().split()
+
+    # Every cell was computed once, and all workers got the same results for the shared cells
+    assert sorted(computed) == sorted(set(computed))
+    assert len(computed) == len(SHARED_CELLS) + N_WORKERS
+
+    for worker_results in results:
+        assert worker_results[:len(SHARED_CELLS)] == results[0][:len(SHARED_CELLS)]
+        assert len(worker_results) == len(SHARED_CELLS) + 1
+
+
+@pytest.mark.parametrize("kind", ["filesystem", "sqlite"])
+def test_readers_never_see_partial_writes(tmp_path, kind):
+    cache_dir = str(tmp_path)
+    _write((kind, cache_dir, 1))
+
+    work = [(kind, cache_dir, 20)] + [(kind, cache_dir, 50)] * 4
+
+    with multiprocessing.get_context("fork").Pool(len(work)) as pool:
+        writer = pool.apply_async(_write, (work[0],))
+        bad_reads = pool.map(_read, work[1:])
+        writer.get()
+
+    assert bad_reads == [0] * 4
+
+    if kind == "filesystem":
+        entry_dir = os.path.dirname(_createBackend(kind, cache_dir)._getPath(SHARED_KEYS[0]))
+        assert os.listdir(entry_dir) == ["cached.dat"]
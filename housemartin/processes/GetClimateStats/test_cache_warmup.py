@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import cache_warmup
+from cache_warmup import Checkpoint, planWarmup, readAssets, runWarmup
+from conftest import makeLocation, holdProcessLocks, runWithTimeout
+
+
+SCENARIOS = [("2035", "rcp45"), ("2055", "rcp85")]
+
+
+def _location(global_gb, regional_gb=(None, None)):
+    return SimpleNamespace(global_gb=global_gb, regional_gb=regional_gb)
+
+
+LOCATIONS = [_location((51.5, 0.5), (51.25, 0.25)), _location((51.5, 0.5), (51.75, 0.25)),
+             _location((51.5, 0.5), (51.25, 0.25)), _location((-30.5, 150.5))]
+
+
+def test_read_assets(tmp_path):
+    path = tmp_path / "assets.txt"
+    path.write_text("LAT\tLON\n-12.359722\t124.269722\n\n-21.9825\t114.007222\n")
+
+    assert readAssets(str(path)) == ["001,-12.359722,124.269722", "002,-21.9825,114.007222"]
+
+
+def test_plan_deduplicates_grid_boxes():
+    units = planWarmup(LOCATIONS, scenarios=SCENARIOS, batch_size=2)
+
+    # Global: 2 grid boxes in one batch per scenario; Regional: 2 grid boxes (one location is not in any domain)
+    summary = [unit for unit in units if unit.kind == "summary"]
+    assert [(unit.domain_type, unit.scenario, len(unit.entries)) for unit in summary] == [
+        ("Global", SCENARIOS[0], 2), ("Global", SCENARIOS[1], 2),
+        ("Regional", SCENARIOS[0], 2), ("Regional", SCENARIOS[1], 2)]
+    assert summary[0].entries == ["summary/Global/rcp45/2035/51.5/0.5", "summary/Global/rcp45/2035/-30.5/150.5"]
+    assert summary[0].locations == [LOCATIONS[0], LOCATIONS[3]]
+
+    full = [unit for unit in units if unit.kind == "full"]
+    assert [unit.entries for unit in full] == [["full/Global/51.5/0.5"], ["full/Global/-30.5/150.5"],
+                                               ["full/Regional/51.25/0.25"], ["full/Regional/51.75/0.25"]]
+    assert units.index(full[0]) > units.index(summary[-1])
+
+    assert [unit.kind for unit in planWarmup(LOCATIONS, scenarios=SCENARIOS, kinds=["full"])] == ["full"] * 4
+
+
+def test_resume_from_checkpoint(tmp_path, monkeypatch):
+    warmed = []
+
+    def warmUnit(unit):
+        warmed.append(unit)
+
+        if unit.entries == ["full/Regional/51.75/0.25"]:
+            raise KeyboardInterrupt()
+
+        # A stats file could not be read for the other regional grid box
+        return (int(unit.entries == ["full/Regional/51.25/0.25"]), 0.)
+
+    monkeypatch.setattr(cache_warmup, "_warmUnit", warmUnit)
+    path = str(tmp_path / "warm-cache.checkpoint")
+    progress = []
+
+    units = planWarmup(LOCATIONS, scenarios=SCENARIOS[:1], batch_size=1)
+    assert len(units) == 8
+
+    try:
+        runWarmup(units, Checkpoint(path), progress=lambda stats, unit, read_errors: progress.append(read_errors))
+    except KeyboardInterrupt:
+        pass
+
+    assert progress == [0, 0, 0, 0, 0, 0, 1]
+
+    # Units that failed, or were not run, are warmed again
+    checkpoint = Checkpoint(path)
+    assert len(checkpoint) == 6
+    units = planWarmup(LOCATIONS, scenarios=SCENARIOS[:1], batch_size=1, done=checkpoint.done)
+    assert [unit.entries for unit in units] == [["full/Regional/51.25/0.25"], ["full/Regional/51.75/0.25"]]
+
+    monkeypatch.setattr(cache_warmup, "_warmUnit", lambda unit: (0, 0.))
+    stats = runWarmup(units, checkpoint)
+    assert (stats.completed_units, stats.failed_units, stats.grid_boxes) == (2, 0, 2)
+    assert len(Checkpoint(path)) == 8
+
+    checkpoint.clear()
+    assert len(Checkpoint(path)) == 0
+
+
+def test_failed_units_do_not_stop_an_in_process_warmup(tmp_path, monkeypatch):
+    def warmUnit(unit):
+        if unit.kind == "full":
+            raise Exception("Cannot read the stats files")
+
+        return (0, 0.)
+
+    monkeypatch.setattr(cache_warmup, "_warmUnit", warmUnit)
+    checkpoint = Checkpoint(str(tmp_path / "warm-cache.checkpoint"))
+
+    units = planWarmup(LOCATIONS, scenarios=SCENARIOS[:1], batch_size=1)
+    stats = runWarmup(units, checkpoint)
+
+    assert (stats.completed_units, stats.failed_units) == (4, 4)
+    assert len(checkpoint) == 4
+
+
+def test_warmup_workers_do_not_inherit_held_locks(stats_archive, tmp_path):
+    fpaths = stats_archive.write("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg")
+    units = planWarmup([makeLocation((45., 5.))], scenarios=SCENARIOS[:1])
+    checkpoint = Checkpoint(str(tmp_path / "warm-cache.checkpoint"))
+    extractor = stats_archive.getExtractor()
+
+    # The workers read and write the caches, and look up absent files, whose locks are held in this process
+    with holdProcessLocks(extractor):
+        stats = runWithTimeout(lambda: runWarmup(units, checkpoint, processes=2))
+
+    assert (stats.completed_units, stats.failed_units) == (2, 0)
+
+    records = extractor.getSummaryRecords("Global", "rcp45", "2035", [makeLocation((45., 5.))])
+    values = list(records.values())[0].getValues(SCENARIOS[0], "MOHC/HadGEM2-ES", [("tas", "avg")])[0]
+    assert values.tolist() == stats_archive.getValues(fpaths, (45., 5.))
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pytest
+
+import data_cube
+from file_catalog import StatsFileNotFound
+
+
+def test_build_and_read_data_cube(stats_archive, tmp_path):
+    cells = [("MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg"), ("NCAR/CCSM4", "rcp85", "2055", "pr", "99p")]
+    written = [stats_archive.write("Global", inst_model, experiment, time_period, var_id, statistic)
+               for (inst_model, experiment, time_period, var_id, statistic) in cells]
+
+    cube_dir = str(tmp_path / "cubes")
+    extractor = stats_archive.getExtractor()
+    path = data_cube.buildDataCube("Global", cube_dir, extractor._getStatsFilePath)
+
+    assert os.listdir(cube_dir) == [os.path.basename(path)]
+    assert data_cube.getDataCube(cube_dir, "EUR-44") is None and data_cube.getDataCube("", "Global") is None
+
+    cube = data_cube.getDataCube(cube_dir, "Global")
+    assert data_cube.getDataCube(cube_dir, "Global") is cube
+
+    points = [(45., 5.), (-25., 175.)]
+
+    for ((inst_model, experiment, time_period, var_id, statistic), fpaths) in zip(cells, written):
+        records = cube.getRecords(experiment, time_period, points)
+        assert records.shape[0] == 2
+
+        values = cube.getValues(records, inst_model, var_id, statistic)
+        assert values.tolist() == [stats_archive.getValues(fpaths, gb) for gb in points]
+
+        # Values of files that do not exist, and of items that are not in the cube, are NaN
+        assert np.isnan(cube.getValues(records, "BNU/BNU-ESM", var_id, statistic)).all()
+        assert np.isnan(cube.getValues(records, inst_model, "unknown", statistic)).shape == (2, 13)
+
+    records = cube.getRecords("rcp45", "2055", points)
+    assert np.isnan(cube.getValues(records, "MOHC/HadGEM2-ES", "tas", "avg")).all()
+
+
+def test_build_data_cube_only_skips_missing_files(tmp_path):
+    def getStatsFilePath(domain_type, inst_model, experiment, time_period, var_id, statistic, meaning_period):
+        raise StatsFileNotFound("No stats file")
+
+    with pytest.raises(Exception, match="No stats files found"):
+        data_cube.buildDataCube("Global", str(tmp_path), getStatsFilePath)
+
+    def getAmbiguousPath(*args):
+        raise Exception("Ambiguous response when globbing for file pattern")
+
+    with pytest.raises(Exception, match="Ambiguous"):
+        data_cube.buildDataCube("Global", str(tmp_path), getAmbiguousPath)
+
+    assert not [name for name in os.listdir(str(tmp_path)) if not name.startswith("tmp")]
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+
+import settings
+from dataset_pool import DatasetPool
+
+
+class _Handle(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.closed = False
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+
+
+def _makePool(max_open=128):
+    opened = []
+
+    def opener(path):
+        handle = _Handle(path)
+        opened.append(handle)
+        return handle
+
+    pool = DatasetPool(max_open=max_open, opener=opener, close_lock=threading.Lock())
+    return (pool, opened)
+
+
+def _use(pool, path):
+    with pool.open(path) as handle:
+        return handle
+
+
+def test_pool_reuses_handles_and_evicts_least_recently_used_by_count():
+    (pool, opened) = _makePool(max_open=2)
+
+    a = _use(pool, "a")
+    assert _use(pool, "a") is a
+    _use(pool, "b")
+
+    # "a" is more recently used than "b", so "b" is evicted
+    _use(pool, "a")
+    _use(pool, "c")
+
+    assert len(pool) == 2 and (pool.hits, pool.misses, pool.evictions) == (2, 3, 1)
+    assert [(h.path, h.closed) for h in opened] == [("a", False), ("b", True), ("c", False)]
+
+    assert _use(pool, "b") is not opened[1]
+    assert opened[0].closed
+
+
+def test_modified_files_are_opened_again(tmp_path):
+    (pool, opened) = _makePool()
+    path = str(tmp_path / "stats.nc")
+    open(path, "w").close()
+
+    with pool.open(path) as first:
+        assert _use(pool, path) is first
+
+        # The handle of the old version is closed once it is returned
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+        second = _use(pool, path)
+        assert second is not first and not first.closed
+
+    assert first.closed and not second.closed
+    assert _use(pool, path) is second
+    assert len(pool) == 1 and (pool.hits, pool.misses) == (2, 2)
+
+
+def test_borrowed_handles_are_closed_when_returned():
+    (pool, opened) = _makePool(max_open=1)
+
+    with pool.open("a") as a:
+        _use(pool, "b")
+        assert len(pool) == 1 and not a.closed
+
+        pool.discard("b")
+        assert opened[1].closed
+
+    assert a.closed
+
+    with pool.open("c") as c:
+        pool.clear()
+        assert len(pool) == 0 and not c.closed
+
+    assert c.closed
+
+
+def test_boolean_settings(monkeypatch):
+    values = {}
+    monkeypatch.setattr(settings.configuration, "get_config_value", lambda section, option: values[option])
+
+    for (value, expected) in (("", True), ("yes", True), ("On", True), ("1", True),
+                              ("no", False), ("0", False), ("off", False), ("False", False), (False, False)):
+        values["flag"] = value
+        assert settings.getSetting("flag", True) is expected
+
+    values["flag"] = "maybe"
+    with pytest.raises(Exception, match="Invalid boolean"):
+        settings.getSetting("flag", False)
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+
+from extraction_plan import ExtractionPlan, getCells
+from vocabs import vocabs
+from conftest import makeLocation
+
+
+def _location(lat, lon):
+    return SimpleNamespace(global_gb=(lat, lon), regional_gbs=OrderedDict([("EUR-44", (lat - 0.25, lon - 0.25))]))
+
+
+def test_only_missing_cells_are_read():
+    locations = [_location(51.5, 0.5), _location(52.5, 0.5)]
+    plan = ExtractionPlan("Global", "rcp45", "2035", locations)
+
+    cells = getCells("Global", {"Global": (51.5, 0.5)})
+    n_cells = sum([len(vocabs.getModelList("Global", var_stat.split(":")[0]))
+                   for var_stat in vocabs.getStatisticIds("Global")])
+    assert len(cells) == n_cells
+    assert len(plan.getMissingCells()) == 2 * n_cells
+
+    # One file per cell and meaning period, for both grid boxes
+    assert len(plan.tasks) == 2 * n_cells
+    assert set([tuple(task.points) for task in plan.tasks]) == set([((51.5, 0.5), (52.5, 0.5))])
+
+    # All cells of the first grid box are cached, and one of the second
+    cached = {("Global", (51.5, 0.5)): dict((cell, np.ma.arange(13.)) for (domain, gb, cell) in cells),
+              ("Global", (52.5, 0.5)): {cells[0][2]: np.ma.masked_all(13)}}
+    plan = ExtractionPlan("Global", "rcp45", "2035", locations, cached=cached)
+
+    assert plan.getMissingCells([locations[0]]) == []
+    assert len(plan.getMissingCells()) == n_cells - 1
+    assert len(plan.tasks) == 2 * (n_cells - 1)
+    assert set([tuple(task.points) for task in plan.tasks]) == set([((52.5, 0.5),)])
+
+    # Records are assembled from the cached and extracted cells
+    extracted = plan.scatter([np.ma.ones((1, 12 if task.meaning_period == "mon" else 1)) for task in plan.tasks])
+    record = plan.getRecord(locations[1], extracted)
+    (inst_model, var_id, statistic) = cells[0][2]
+
+    assert np.isnan(record.getValues(("2035", "rcp45"), inst_model, [(var_id, statistic)])).all()
+    assert np.nansum(record.values) == 13 * (n_cells - 1)
+    assert np.nansum(plan.getRecord(locations[0], {}).values) == 78 * n_cells
+
+
+def test_regional_cells_use_the_grid_box_of_their_domain():
+    cells = getCells("Regional", OrderedDict([("EUR-44", (51.25, 0.25))]))
+
+    assert cells
+    assert set([(domain, gb) for (domain, gb, cell) in cells]) == set([("EUR-44", (51.25, 0.25))])
+    assert all([cell[0].endswith("/EUR-44") for (domain, gb, cell) in cells])
+
+
+def test_run_extraction_plan_reads_each_file_once_and_scatters_values(stats_archive):
+    locations = [makeLocation((45., 5.)), makeLocation((-25., 175.)), makeLocation((45., 5.))]
+    written = dict((cell, stats_archive.write("Global", cell[0], "rcp45", "2035", cell[1], cell[2]))
+                   for cell in (("MOHC/HadGEM2-ES", "tas", "avg"), ("NCAR/CCSM4", "pr", "99p")))
+
+    # The stats file of one cell can not be read
+    unreadable = stats_archive.getPath("Global", "BNU/BNU-ESM", "rcp45", "2035", "tas", "avg", "mon")
+    stats_archive.write("Global", "BNU/BNU-ESM", "rcp45", "2035", "tas", "avg")
+    with open(unreadable, "wb") as writer:
+        writer.write(b"not a netCDF file")
+
+    for threads in (1, 4):
+        extractor = stats_archive.getExtractor(extraction_threads=threads)
+        reads = []
+        extractPointsFromFile = extractor._extractPointsFromFile
+
+        def recordRead(meaning_period, fpath, var_id, points):
+            reads.append((fpath, tuple(points)))
+            return extractPointsFromFile(meaning_period, fpath, var_id, points)
+
+        extractor._extractPointsFromFile = recordRead
+        plan = ExtractionPlan("Global", "rcp45", "2035", locations)
+        (extracted, failed, absent) = extractor._runExtractionPlan(plan)
+
+        # Each file is read once, for both (de-duplicated) grid boxes
+        assert sorted(reads) == sorted([(fpath, ((45., 5.), (-25., 175.))) for fpath in stats_archive.files])
+        assert set(extracted.keys()) == set([("Global", (45., 5.)), ("Global", (-25., 175.))])
+        assert extractor.read_errors == 1
+
+        for gb in ((45., 5.), (-25., 175.)):
+            cells = extracted[("Global", gb)]
+            assert len(cells) == len(plan.getMissingCells([locations[0]]))
+
+            for (cell, fpaths) in written.items():
+                assert cells[cell].tolist() == stats_archive.getValues(fpaths, gb)
+                assert ("Global", gb, cell) not in failed | absent
+
+            assert cells[("BNU/BNU-ESM", "tas", "avg")].mask.tolist() == [True] * 12 + [False]
+            assert ("Global", gb, ("BNU/BNU-ESM", "tas", "avg")) in failed
+
+            missing = [cell for cell in cells if cell not in written and cell != ("BNU/BNU-ESM", "tas", "avg")]
+            assert all([cells[cell].mask.all() and ("Global", gb, cell) in absent for cell in missing])
+
+    # Cached cells are not read again
+    cached = {("Global", (45., 5.)): {("MOHC/HadGEM2-ES", "tas", "avg"): np.ma.arange(13.)}}
+    plan = ExtractionPlan("Global", "rcp45", "2035", locations, cached=cached)
+    extracted = stats_archive.getExtractor()._runExtractionPlan(plan)[0]
+
+    assert ("MOHC/HadGEM2-ES", "tas", "avg") not in extracted[("Global", (45., 5.))]
+    assert extracted[("Global", (-25., 175.))][("MOHC/HadGEM2-ES", "tas", "avg")].tolist() == \
+        stats_archive.getValues(written[("MOHC/HadGEM2-ES", "tas", "avg")], (-25., 175.))
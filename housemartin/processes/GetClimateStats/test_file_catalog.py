@@ -0,0 +1,118 @@
+import os
+import json
+
+import pytest
+
+from file_catalog import FileCatalog, buildFileCatalog, diffCatalogs, getFileCatalog
+
+
+PATTERNS = {"Global": "%(var_id)s_*_%(experiment)s_*r*_%(meaning_period)s_%(statistic)s_change.nc",
+            "Regional": "%(var_id)s_*_%(experiment)s_*r*_%(meaning_period)s_%(statistic)s_change.nc"}
+
+
+def _writeStatsFile(data_dir, meaning_period, content=b"data", time_period="2035", fname=None):
+    dr = os.path.join(data_dir, "global", "tas", "rcp45", "MOHC", "HadGEM2-ES", time_period, "1_deg")
+    os.makedirs(dr, exist_ok=True)
+    fname = fname or "tas_HadGEM2-ES_rcp45_r1i1p1_%s_avg_change.nc" % meaning_period
+
+    with open(os.path.join(dr, fname), "wb") as writer:
+        writer.write(content)
+
+    return os.path.join(dr, fname)
+
+
+def _key(meaning_period, time_period="2035"):
+    return ("Global", "tas", "rcp45", "MOHC/HadGEM2-ES", time_period, meaning_period, "avg")
+
+
+def test_build_load_and_incremental_rebuild(tmp_path):
+    data_dir = str(tmp_path / "data")
+    fpath = _writeStatsFile(data_dir, "mon")
+    _writeStatsFile(data_dir, "ann")
+
+    # Files that the extractor's patterns would not match are not included
+    _writeStatsFile(data_dir, "mon", fname="tas_HadGEM2-ES_rcp45_r1i1p1_mon_avg.nc")
+    _writeStatsFile(data_dir, "mon", fname=".tas_HadGEM2-ES_rcp45_r1i1p1_mon_avg_change.nc")
+    os.makedirs(os.path.join(data_dir, "global", "tas", "rcp45", "MOHC", "HadGEM2-ES", "2035", "0.5_deg"))
+
+    catalog = buildFileCatalog(data_dir, PATTERNS)
+    assert sorted(catalog.files.keys()) == [_key("ann"), _key("mon")]
+    assert catalog.getPath("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg", "mon") == fpath
+    assert catalog.getPath("Global", "MOHC/HadGEM2-ES", "rcp85", "2035", "tas", "avg", "mon") is None
+    assert (catalog.scanned_dirs, catalog.reused_dirs) == (8, 0)
+
+    path = str(tmp_path / "index" / "catalog.json")
+    catalog.save(path)
+    loaded = getFileCatalog(path)
+    assert loaded.files == catalog.files and loaded.dir_listings == catalog.dir_listings
+    assert getFileCatalog(path) is loaded
+    assert getFileCatalog("") is None and getFileCatalog(str(tmp_path / "missing.json")) is None
+
+    # Only the directories that have changed are listed again
+    _writeStatsFile(data_dir, "mon", time_period="2055")
+    rebuilt = buildFileCatalog(data_dir, PATTERNS, previous=loaded)
+
+    assert sorted(rebuilt.files.keys()) == [_key("ann"), _key("mon"), _key("mon", "2055")]
+    assert (rebuilt.scanned_dirs, rebuilt.reused_dirs) == (3, 7)
+    assert rebuilt.file_stats[_key("mon")] == catalog.file_stats[_key("mon")]
+
+    # The rebuilt catalog is re-loaded once it is saved
+    rebuilt.save(path)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    assert len(getFileCatalog(path)) == 3
+
+    # Catalogs of version 1 (without file stats) can still be loaded
+    with open(path) as reader:
+        content = json.load(reader)
+
+    content["version"] = 1
+    content["files"] = [item[:-2] for item in content["files"]]
+
+    with open(path, "w") as writer:
+        json.dump(content, writer)
+
+    assert FileCatalog.load(path).files == rebuilt.files
+    assert FileCatalog.load(path).file_stats == {}
+
+
+def test_ambiguous_files_are_rejected(tmp_path):
+    data_dir = str(tmp_path / "data")
+    _writeStatsFile(data_dir, "mon")
+    _writeStatsFile(data_dir, "mon", fname="tas_HadGEM2-ES_rcp45_r2i1p1_mon_avg_change.nc")
+
+    with pytest.raises(Exception, match="Matched 2 responses"):
+        buildFileCatalog(data_dir, PATTERNS)
+
+
+def test_fingerprints_and_diff(tmp_path):
+    data_dir = str(tmp_path / "data")
+    _writeStatsFile(data_dir, "mon")
+
+    catalog = buildFileCatalog(data_dir, PATTERNS)
+    catalog.save(str(tmp_path / "catalog.json"))
+    loaded = FileCatalog.load(str(tmp_path / "catalog.json"))
+
+    assert loaded.files == catalog.files
+    assert loaded.file_stats[_key("mon")][1] == 4
+
+    keys = [_key("mon"), _key("ann")]
+    fingerprint = loaded.getFingerprint(keys)
+    assert fingerprint == catalog.getFingerprint(keys)
+    assert fingerprint != catalog.getFingerprint(keys[:1])
+
+    # A data drop adds one file and rewrites another
+    _writeStatsFile(data_dir, "ann")
+    _writeStatsFile(data_dir, "mon", content=b"new data")
+
+    rebuilt = buildFileCatalog(data_dir, PATTERNS, previous=loaded)
+    assert diffCatalogs(loaded, rebuilt) == (set([_key("ann")]), set(), set([_key("mon")]))
+    assert rebuilt.getFingerprint(keys) != fingerprint
+    assert diffCatalogs(rebuilt, rebuilt) == (set(), set(), set())
+
+    # A file rewritten in place is found by an incremental rebuild, though its directory is unchanged
+    dr = os.path.dirname(_writeStatsFile(data_dir, "mon"))
+    os.utime(dr, ns=(0, rebuilt.dir_listings[os.path.relpath(dr, data_dir)][0]))
+
+    updated = buildFileCatalog(data_dir, PATTERNS, previous=rebuilt)
+    assert updated.reused_dirs == len(rebuilt.dir_listings)
+    assert diffCatalogs(rebuilt, updated) == (set(), set(), set([_key("mon")]))
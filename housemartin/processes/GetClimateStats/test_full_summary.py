@@ -0,0 +1,46 @@
+import numpy as np
+
+import dataset_pool
+from conftest import makeLocation, holdProcessLocks, runWithTimeout
+
+
+def test_process_pool_builds_the_same_record_as_the_serial_path(stats_archive):
+    for (time_period, experiment) in (("2035", "rcp45"), ("2055", "rcp85")):
+        stats_archive.write("Global", "MOHC/HadGEM2-ES", experiment, time_period, "tas", "avg")
+        stats_archive.write("Global", "NCAR/CCSM4", experiment, time_period, "pr", "99p")
+
+    # One stats file can not be read
+    with open(stats_archive.getPath("Global", "NCAR/CCSM4", "rcp85", "2055", "pr", "99p", "ann"), "wb") as writer:
+        writer.write(b"not a netCDF file")
+
+    location = makeLocation((45., 5.))
+
+    # The serial path leaves files open in this process's pool, which the workers must not share
+    (record, read_errors, absent) = stats_archive.getExtractor()._buildFullRecord("Global", location)
+    assert len(dataset_pool.getDatasetPool("netcdf4")) > 0
+
+    extractor = stats_archive.getExtractor(summary_processes=2)
+    (pooled, pooled_read_errors, pooled_absent) = extractor._buildFullRecord("Global", location)
+
+    assert pooled.toBytes() == record.toBytes()
+    assert pooled_read_errors == read_errors == 1
+    assert pooled_absent == absent > 0
+
+    values = record.getValues(("2035", "rcp45"), "MOHC/HadGEM2-ES", [("tas", "avg")])[0]
+    assert values.tolist() == stats_archive.getValues(stats_archive.files[:2], (45., 5.))
+    assert np.isnan(record.getValues(("2055", "rcp85"), "NCAR/CCSM4", [("pr", "99p")])[0][12])
+
+
+def test_workers_do_not_inherit_held_locks(stats_archive):
+    stats_archive.write("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg")
+    location = makeLocation((45., 5.))
+
+    (record, read_errors, absent) = stats_archive.getExtractor()._buildFullRecord("Global", location)
+    extractor = stats_archive.getExtractor(summary_processes=2)
+
+    # Workers look up absent files and open point readers, whose locks are held in this process
+    with holdProcessLocks(extractor):
+        (pooled, pooled_read_errors, pooled_absent) = runWithTimeout(
+            lambda: extractor._buildFullRecord("Global", location))
+
+    assert pooled.toBytes() == record.toBytes() and pooled_absent == absent > 0
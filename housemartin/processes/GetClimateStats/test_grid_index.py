@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+import pytest
+
+import lib
+from grid_index import GridIndex
+from conftest import writeRefFile
+
+
+# Reference grids: a 0-360 and a -180-180 global grid, and two overlapping regional grids
+GRIDS = OrderedDict([("Global", (np.arange(89.5, -90, -1.), np.arange(0.5, 360, 1.))),
+                     ("Global180", (np.arange(-89.5, 90, 1.), np.arange(-179.5, 180, 1.))),
+                     ("EUR-44", (np.arange(30.25, 60, 0.5), np.arange(-19.75, 40, 0.5))),
+                     ("MNA-44", (np.arange(-5.5, 45, 0.5), np.arange(-15., 60.5, 0.5)))])
+
+
+@pytest.fixture
+def ref_dir(tmp_path):
+    "Writes the reference files as laid out for ``lib.Location``. Returns the directory."
+    for (domain, (lats, lons)) in GRIDS.items():
+        file_name = "tas_global.nc" if domain == "Global" else "tas_%si.nc" % domain
+        writeRefFile(str(tmp_path / file_name), lats, lons)
+
+    return str(tmp_path)
+
+
+def _perFileGridBox(ref_file, lat, lon, domain_type):
+    """
+    Returns the grid box (lat, lon) nearest to a location, or None, as found by reading the
+    reference file for each location (as ``lib.Location`` did before the grid index).
+    """
+    with xr.open_dataset(ref_file) as ds:
+        (lats, lons) = (ds["lat"].values.tolist(), ds["lon"].values.tolist())
+
+    if not min(lons) <= lon <= max(lons):
+        lon += 360 if lon < 0 else -360
+
+        if not min(lons) <= lon <= max(lons):
+            return None
+
+    if domain_type == "Regional" and not min(lats) <= lat <= max(lats):
+        return None
+
+    return (min(lats, key=lambda value: abs(value - lat)), min(lons, key=lambda value: abs(value - lon)))
+
+
+def _buildGridIndex(ref_dir, domains):
+    ref_files = OrderedDict([(domain, "%s/%s" % (ref_dir, "tas_global.nc" if domain == "Global" else
+                                                 "tas_%si.nc" % domain)) for domain in domains])
+    return (GridIndex(ref_files, "tas"), ref_files)
+
+
+def _edgePoints(domain):
+    "Returns (lat, lon) points on, and just outside, the bounds of the grid of ``domain``."
+    (lats, lons) = GRIDS[domain]
+    (lat_range, lon_range) = ((lats.min(), lats.max()), (lons.min(), lons.max()))
+    (lat_mid, lon_mid) = (sum(lat_range) / 2, sum(lon_range) / 2)
+
+    points = []
+    for edge in lat_range:
+        points += [(edge, lon_mid), (edge - 0.01, lon_mid), (edge + 0.01, lon_mid)]
+    for edge in lon_range:
+        points += [(lat_mid, edge), (lat_mid, edge - 0.01), (lat_mid, edge + 0.01),
+                   (lat_mid, edge - 360), (lat_mid, edge + 360)]
+
+    return points
+
+
+def test_resolve_matches_per_file_search(ref_dir):
+    (index, ref_files) = _buildGridIndex(ref_dir, ["Global", "EUR-44", "MNA-44"])
+
+    rng = np.random.RandomState(1)
+    points = list(zip(rng.uniform(-90, 90, 300), rng.uniform(-360, 360, 300)))
+    points += _edgePoints("EUR-44") + _edgePoints("MNA-44")
+
+    # Only valid locations are resolved, and the per-file search does not wrap around the global
+    # grid: those points are tested below
+    points = [(lat, lon) for (lat, lon) in points if -360 <= lon <= 360 and 1. <= lon % 360 <= 359.]
+
+    for (lat, lon) in points:
+        expected = [(domain, _perFileGridBox(ref_file, lat, lon, "Global" if domain == "Global" else "Regional"))
+                    for (domain, ref_file) in ref_files.items()]
+        (global_gb, regional_gbs) = index.resolve(lat, lon)
+
+        assert global_gb == expected[0][1], (lat, lon)
+        assert list(regional_gbs.items()) == [(domain, gb) for (domain, gb) in expected[1:] if gb], (lat, lon)
+
+
+def test_resolve_wraps_around_global_grids(ref_dir):
+    index = _buildGridIndex(ref_dir, ["Global"])[0]
+    index180 = GridIndex({"Global": "%s/tas_Global180i.nc" % ref_dir}, "tas")
+
+    # The nearest grid box is found across 0/360 (and -180/180), which the per-file search did not do.
+    # Ties go to the grid box that comes first in the axis.
+    for (lon, expected) in ((0., 0.5), (-0.3, 359.5), (-0.7, 359.5), (359.8, 359.5), (360., 0.5), (-360., 0.5),
+                            (719.8, 359.5)):
+        assert index.resolve(10.2, lon)[0] == (10.5, expected), lon
+
+    for (lon, expected) in ((180., -179.5), (179.9, 179.5), (-179.9, -179.5), (180.2, -179.5), (-180.2, 179.5)):
+        assert index180.resolve(10.2, lon)[0] == (10.5, expected), lon
+
+    # The per-file search found no grid box at all for some of them
+    assert _perFileGridBox("%s/tas_global.nc" % ref_dir, 10.2, 0., "Global") is None
+    assert _perFileGridBox("%s/tas_Global180i.nc" % ref_dir, 10.2, 179.9, "Global") is None
+
+
+def test_locations_list_matching_regional_domains_in_order(ref_dir, monkeypatch):
+    monkeypatch.setattr(lib.Location, "GRID_REFERENCE_DIR", ref_dir)
+
+    for domains in (["EUR-44", "MNA-44"], ["MNA-44", "EUR-44"]):
+        monkeypatch.setattr(lib.Location, "REGIONAL_DOMAINS", domains)
+
+        # Only in EUR-44, in both (and the first domain is used), only in MNA-44, and in neither
+        for (lat, lon, matching) in ((50.1, 10.1, ["EUR-44"]), (40.1, 10.1, domains), (10.1, 10.1, ["MNA-44"]),
+                                     (-30.1, 10.1, [])):
+            location = lib.Location("asset,%s,%s" % (lat, lon))
+
+            expected = OrderedDict()
+            for domain in matching:
+                expected[domain] = _perFileGridBox("%s/tas_%si.nc" % (ref_dir, domain), lat, lon, "Regional")
+
+            assert location.global_gb == _perFileGridBox("%s/tas_global.nc" % ref_dir, lat, lon, "Global")
+            assert location.regional_gbs == expected
+            assert location.regional_domain == (matching[0] if matching else None)
+            assert location.regional_gb == (expected[matching[0]] if matching else (None, None))
+
+
+def test_from_many_matches_single_locations(ref_dir, monkeypatch):
+    monkeypatch.setattr(lib.Location, "GRID_REFERENCE_DIR", ref_dir)
+    monkeypatch.setattr(lib.Location, "REGIONAL_DOMAINS", ["EUR-44", "MNA-44"])
+
+    rng = np.random.RandomState(2)
+    points = list(zip(rng.uniform(-90, 90, 50), rng.uniform(-360, 360, 50)))
+    points += _edgePoints("EUR-44") + [(-90., 0.), (90., -360.), (10.2, 360.)]
+    strings = ["asset%s,%s,%s" % (i, lat, lon) for (i, (lat, lon)) in enumerate(points) if -360 <= lon <= 360]
+
+    many = lib.Location.fromMany(strings)
+    single = [lib.Location(location) for location in strings]
+    assert len(many) == len(single) == len(strings)
+
+    for (location, expected) in zip(many, single):
+        assert (location.asset_id, location.requested) == (expected.asset_id, expected.requested)
+        assert location.global_gb == expected.global_gb
+        assert location.regional_gbs == expected.regional_gbs
+        assert (location.regional_domain, location.regional_gb) == (expected.regional_domain, expected.regional_gb)
+
+    assert lib.Location.fromMany([]) == []
+
+
+@pytest.mark.parametrize("locations, message", [
+    (["a,10,10", "b,95,10", "c,-91,10"], "Latitude is out of range: 95.0"),
+    (["a,10,10", "b,10,-360.5"], "Longitude is out of range: -360.5"),
+    (["a,10,10", "b,10,10,10"], "comma-seperated list of three items"),
+    (["a,10,10", "b,10"], "comma-seperated list of three items"),
+])
+def test_from_many_rejects_invalid_locations(ref_dir, monkeypatch, locations, message):
+    monkeypatch.setattr(lib.Location, "GRID_REFERENCE_DIR", ref_dir)
+
+    with pytest.raises(Exception, match=message):
+        lib.Location.fromMany(locations)
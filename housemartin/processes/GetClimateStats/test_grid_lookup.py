@@ -0,0 +1,104 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import grid_lookup
+from grid_index import GridIndex
+from conftest import writeRefFile
+
+
+def _buildGridIndex(tmp_path):
+    ref_files = OrderedDict()
+    ref_files["Global"] = str(tmp_path / "global.nc")
+    ref_files["EUR-11"] = str(tmp_path / "eur.nc")
+
+    writeRefFile(ref_files["Global"], np.arange(89.5, -90, -1.), np.arange(0.5, 360, 1.))
+    writeRefFile(ref_files["EUR-11"], np.arange(30.25, 60, 0.5), np.arange(-19.75, 40, 0.5))
+    return GridIndex(ref_files, "tas")
+
+
+def test_lookup_matches_grid_index_at_quantized_coordinates(tmp_path):
+    index = _buildGridIndex(tmp_path)
+    files = grid_lookup.buildGridLookup(index, str(tmp_path / "lookup"))
+    names = [grid_lookup.LAT_TABLE_FILE, grid_lookup.LON_TABLE_FILE, grid_lookup.AXES_FILE]
+    assert [os.path.basename(f) for f in files] == names
+
+    lookup = grid_lookup.GridLookup(str(tmp_path / "lookup"))
+    assert lookup.domains == ["Global", "EUR-11"]
+
+    rng = np.random.RandomState(0)
+    lats = np.round(rng.uniform(-90, 90, 500), 2).tolist() + [-90., 90., 45.12, 10.]
+    lons = np.round(rng.uniform(-360, 360, 500), 2).tolist() + [-360., 360., -378.4 + 360, 39.99]
+
+    assert lookup.resolveMany(lats, lons) == index.resolveMany(lats, lons)
+    assert lookup.resolve(45.12, 18.01) == index.resolve(45.12, 18.01)
+
+    (global_gb, regional_gbs) = lookup.resolve(10., 39.99)
+    assert global_gb == (10.5, 39.5) and not regional_gbs
+
+
+def test_lookup_quantizes_coordinates(tmp_path):
+    index = _buildGridIndex(tmp_path)
+    grid_lookup.buildGridLookup(index, str(tmp_path / "lookup"), resolution=0.1)
+    lookup = grid_lookup.GridLookup(str(tmp_path / "lookup"))
+
+    # Both are quantized to 10.0, which lies on the mid-point between global grid boxes
+    assert lookup.resolve(10.04, 5.2) == lookup.resolve(9.96, 5.2) == index.resolve(10.0, 5.2)
+    assert index.resolve(10.04, 5.2) != index.resolve(9.96, 5.2)
+
+    # Out-of-range coordinates are clipped to the edges of the table
+    assert lookup.resolve(95., 400.) == lookup.resolve(90., 360.)
+
+
+def test_get_grid_lookup_reloads_modified_tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(grid_lookup, "LOOKUP_CHECK_INTERVAL", 0.)
+    lookup_dir = str(tmp_path / "lookup")
+    assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is None
+
+    index = _buildGridIndex(tmp_path)
+    grid_lookup.buildGridLookup(index, lookup_dir)
+
+    lookup = grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"])
+    assert lookup is not None
+    assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is lookup
+    assert grid_lookup.getGridLookup(lookup_dir, ["Global"]) is None
+
+    # A rebuild (with new modification times) is picked up by the next request
+    grid_lookup.buildGridLookup(index, lookup_dir, resolution=0.1)
+    path = os.path.join(lookup_dir, grid_lookup.AXES_FILE)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+
+    reloaded = grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"])
+    assert reloaded is not lookup and reloaded.resolution == 0.1
+
+    os.remove(path)
+    assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is None
+
+
+def test_get_grid_lookup_checks_the_tables_at_intervals(tmp_path, monkeypatch):
+    lookup_dir = str(tmp_path / "lookup")
+    now = [1000.]
+    checks = []
+
+    getTableMtimes = grid_lookup._getTableMtimes
+    monkeypatch.setattr(grid_lookup, "_getTableMtimes", lambda path: checks.append(path) or getTableMtimes(path))
+    monkeypatch.setattr(grid_lookup.time, "time", lambda: now[0])
+
+    # Missing tables are only looked for once per interval
+    for i in range(3):
+        assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is None
+
+    assert len(checks) == 1
+
+    grid_lookup.buildGridLookup(_buildGridIndex(tmp_path), lookup_dir)
+    assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is None
+
+    now[0] += grid_lookup.LOOKUP_CHECK_INTERVAL
+    lookup = grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"])
+    assert lookup is not None and len(checks) == 2
+
+    for i in range(3):
+        assert grid_lookup.getGridLookup(lookup_dir, ["Global", "EUR-11"]) is lookup
+
+    assert len(checks) == 2
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+import pytest
+
+import lib
+import stats_record
+from lib import _maskedToLists
+from file_catalog import StatsFileNotFound
+from extraction_plan import ExtractionPlan, getCells
+from conftest import LATS, LONS, makeLocation, writeStatsFile
+
+
+def test_masked_to_lists():
+    values = np.ma.masked_array([[1., 2., 3.], [4., 5., np.nan]], mask=[[False, True, False], [False, False, True]])
+    assert _maskedToLists(values) == [[1., None, 3.], [4., 5., None]]
+
+    assert _maskedToLists(np.ma.masked_all((2, 1))) == [[None], [None]]
+    assert _maskedToLists(np.ma.masked_array(np.arange(3.)[np.newaxis])) == [[0., 1., 2.]]
+
+
+def test_missing_values_are_none_and_unreadable_files_are_counted(stats_archive, tmp_path):
+    data = np.ones((12, len(LATS), len(LONS)), dtype="f4")
+    data[:6] = 1e20
+    data[6] = np.nan
+    fpath = str(tmp_path / "tas.nc")
+    writeStatsFile(fpath, "tas", data, fill_value=np.float32(1e20))
+
+    (lat, lon) = (LATS[3], LONS[7])
+    expected = [None] * 7 + [1.] * 5
+
+    for reader in ("netcdf4", "xarray"):
+        extractor = stats_archive.getExtractor()
+        if reader == "xarray":
+            extractor.point_reader = None
+
+        assert extractor._extractPointDataFromFile("Global", "mon", fpath, "tas", lat, lon) == expected
+        assert extractor.read_errors == 0
+
+        # A file that can not be read gives all missing values, and is counted as a read error
+        unreadable = str(tmp_path / "missing.nc")
+        assert extractor._extractPointDataFromFile("Global", "ann", unreadable, "tas", lat, lon) == [None]
+        assert extractor.read_errors == 1
+
+    # Files that do not exist are absent, not read errors
+    extractor = stats_archive.getExtractor()
+    result = extractor.extractDataAtPoint("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg",
+                                          makeLocation((45., 5.)))
+    assert result == {"values": [None] * 13, "grid_box": (45., 5.)}
+    assert extractor.read_errors == 0
+
+
+def test_absent_files_are_not_looked_for_again_until_they_expire(stats_archive, monkeypatch):
+    globbed = []
+    globFiles = lib.glob.glob
+    monkeypatch.setattr(lib.glob, "glob", lambda pattern: globbed.append(pattern) or globFiles(pattern))
+
+    extractor = stats_archive.getExtractor(negative_ttl=60)
+    facets = ("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg", "mon")
+
+    with pytest.raises(StatsFileNotFound, match="No stats file matches pattern: "):
+        extractor._getStatsFilePath(*facets)
+
+    (pattern,) = globbed
+    assert lib._absent_files[pattern] > time.time() + 50
+
+    # A file added while the pattern is known to be absent is not found until the entry expires
+    (fpath, ann_fpath) = stats_archive.write("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg")
+
+    with pytest.raises(StatsFileNotFound, match="known absent"):
+        extractor._getStatsFilePath(*facets)
+
+    assert len(globbed) == 1
+
+    lib._absent_files[pattern] = time.time() - 1
+    assert extractor._getStatsFilePath(*facets) == fpath
+    assert len(globbed) == 2
+
+    # Expired entries are dropped when others are added
+    lib._absent_files[pattern] = time.time() - 1
+
+    with pytest.raises(StatsFileNotFound):
+        extractor._getStatsFilePath("Global", "MOHC/HadGEM2-ES", "rcp85", "2035", "tas", "avg", "mon")
+
+    assert list(lib._absent_files.keys()) == [globbed[-1]]
+
+
+def test_absent_cells_are_cached_as_negative_cells(stats_archive):
+    fpaths = stats_archive.write("Global", "MOHC/HadGEM2-ES", "rcp45", "2035", "tas", "avg")
+    location = makeLocation((45., 5.))
+
+    extractor = stats_archive.getExtractor()
+    extractor.cache_stats.negative_ttl = 60
+    extractor._extractAndCache(ExtractionPlan("Global", "rcp45", "2035", [location]))
+
+    cells = [cell for (domain, gb, cell) in getCells("Global", {"Global": (45., 5.)})]
+    absent_cell = [cell for cell in cells if cell != ("MOHC/HadGEM2-ES", "tas", "avg")][0]
+    requests = [extractor._getCellRequest("Global", "rcp45", "2035", "Global", (45., 5.), cell)
+                for cell in (("MOHC/HadGEM2-ES", "tas", "avg"), absent_cell)]
+    (payload, absent_payload) = extractor.cache_stats._getPayloads(requests)
+
+    assert payload[:4] == stats_record.CELL_MAGIC
+    assert absent_payload[:4] == stats_record.NEGATIVE_CELL_MAGIC
+    assert 50 < stats_record.EXPIRES.unpack_from(absent_payload, stats_record.PREFIX.size)[0] - time.time() <= 60
+
+    (values, absent_values) = extractor.cache_stats.getMany(requests)
+    assert values.tolist() == stats_archive.getValues(fpaths, (45., 5.))
+    assert absent_values.mask.all()
@@ -0,0 +1,105 @@
+import time
+import threading
+
+import pytest
+
+from network_cache import RedisBackend, FakeRedisServer
+
+
+KEYS = [("Global", "rcp45", "2035", "51.5000", "m0.5000", "tas", "avg", "MOHC+HadGEM2-ES"),
+        ("Regional", "rcp85", "2055", "m21.7500", "318.2500", "pr", "99p", "CORDEX+EUR-44")]
+
+
+@pytest.fixture
+def server():
+    server = FakeRedisServer().start()
+    yield server
+    server.stop()
+
+
+def test_get_and_put_many(server):
+    backend = RedisBackend(server.url, "housemartin:summary")
+    other = RedisBackend(server.url, "housemartin:full")
+
+    assert backend.getMany(KEYS) == [None, None]
+
+    backend.putMany([(KEYS[1], b"\x00\r\n\x01payload")])
+    assert backend.getMany(KEYS) == [None, b"\x00\r\n\x01payload"]
+    assert other.getMany(KEYS) == [None, None]
+
+    backend.put(KEYS[0], b"")
+    assert backend.get(KEYS[0]) == b""
+    assert sorted(backend.items()) == sorted([(KEYS[0], b""), (KEYS[1], b"\x00\r\n\x01payload")])
+    assert backend.getUsage()["entries"] == 2
+
+    backend.delete(KEYS[1])
+    assert backend.getMany(KEYS) == [b"", None]
+
+
+def test_lookups_take_one_round_trip(server):
+    backend = RedisBackend(server.url, "housemartin:summary")
+    keys = [("Global", "rcp45", "2035", "%d" % i, "0") for i in range(2500)]
+
+    backend.putMany([(key, b"%d" % i) for (i, key) in enumerate(keys)])
+    round_trips = backend.round_trips
+
+    assert backend.getMany(keys) == [b"%d" % i for i in range(2500)]
+    assert backend.round_trips == round_trips + 1
+
+
+def test_usage_reads_sizes_not_values(server, monkeypatch):
+    backend = RedisBackend(server.url, "housemartin:summary")
+    keys = [("Global", "rcp45", "2035", "%d" % i, "0") for i in range(2500)]
+    backend.putMany([(key, b"x" * (i % 7)) for (i, key) in enumerate(keys)])
+
+    # Lock keys are not entries
+    with backend.lockKeys(None, KEYS[:1], timeout=5):
+        commands = []
+        execute = server.execute
+        monkeypatch.setattr(server, "execute", lambda command: commands.append(command[0].upper()) or execute(command))
+        round_trips = backend.round_trips
+
+        usage = backend.getUsage()
+
+        assert (usage["entries"], usage["bytes"]) == (2500, sum([i % 7 for i in range(2500)]))
+        assert set(commands) == set([b"SCAN", b"STRLEN"])
+        assert backend.round_trips == round_trips + 1 + 3
+
+
+def test_locks(server):
+    backend = RedisBackend(server.url, "housemartin:summary")
+    holders = []
+    overlapped = []
+
+    def worker(name):
+        with backend.lockKeys(None, KEYS[:1], timeout=5):
+            holders.append(name)
+            overlapped.append(len(holders) > 1)
+            time.sleep(0.1)
+            holders.remove(name)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Each worker held the lock on its own, and released it
+    assert overlapped == [False] * 4
+    assert [key for (key, data) in backend.items()] == []
+
+
+def test_expired_locks_taken_by_another_worker_are_not_released(server):
+    backend = RedisBackend(server.url, "housemartin:summary")
+
+    with backend.lockKeys(None, KEYS[:1], timeout=0.05):
+        (lock_key,) = [key for key in server.data if key.startswith(b"housemartin:summary:lock:")]
+        time.sleep(0.1)
+
+        # The lock has expired, and another worker takes it
+        assert server.execute([b"SET", lock_key, b"other", b"NX"]) == "OK"
+        round_trips = backend.round_trips
+
+    # The lock of the other worker is kept, and the release took one round-trip
+    assert server.data[lock_key][0] == b"other"
+    assert backend.round_trips == round_trips + 1
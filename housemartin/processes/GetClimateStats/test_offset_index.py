@@ -0,0 +1,129 @@
+import os
+import threading
+
+import numpy as np
+import netCDF4
+
+import lib
+import dataset_pool
+import offset_index
+from dataset_pool import DatasetPool, openNetCDF4Dataset
+from point_reader import NetCDF4PointReader
+
+
+def _writeStatsFile(fpath, endian="native", **var_kwargs):
+    ds = netCDF4.Dataset(fpath, "w")
+
+    for (dim, values) in (("time", np.arange(12.)), ("lat", np.arange(-85., 90, 10)), ("lon", np.arange(5., 360, 10))):
+        ds.createDimension(dim, len(values))
+        ds.createVariable(dim, "f8", (dim,))[:] = values
+
+    ds["lat"].standard_name = "latitude"
+    ds["lon"].standard_name = "longitude"
+
+    var = ds.createVariable("tas", "f4", ("time", "lat", "lon"), fill_value=np.float32(1e20), endian=endian,
+                            **var_kwargs)
+    data = np.arange(12 * 18 * 36, dtype="f4").reshape(12, 18, 36)
+    data[:, 0, 0] = 1e20
+    var[:] = data
+
+    ds.close()
+
+
+def test_offset_index_reads_same_values_as_netcdf4_reader(tmp_path):
+    points = [(-85, 5), (0.1, 179.9), (84, -1), (45, 725)]
+    reader = NetCDF4PointReader(DatasetPool(opener=openNetCDF4Dataset))
+
+    files = []
+    for endian in ("little", "big"):
+        fpath = str(tmp_path / ("tas_%s.nc" % endian))
+        _writeStatsFile(fpath, endian=endian)
+        files.append((fpath, "tas"))
+
+    index = offset_index.buildOffsetIndex(files)
+    assert len(index) == 2
+
+    index.save(str(tmp_path / "offsets.json"))
+    index = offset_index.OffsetIndex.load(str(tmp_path / "offsets.json"))
+
+    for (fpath, var_id) in files:
+        values = index.readPoints(fpath, var_id, points)
+        expected = reader.readPoints(fpath, var_id, points)
+
+        assert values.shape == (4, 12)
+        assert values.mask[0].all() and not values.mask[1:].any()
+        assert values.dtype == expected.dtype
+        assert values.filled(0).tolist() == expected.filled(0).tolist()
+
+
+def test_offset_index_falls_back_for_compressed_and_modified_files(tmp_path):
+    compressed = str(tmp_path / "compressed.nc")
+    _writeStatsFile(compressed, zlib=True, chunksizes=(12, 1, 1))
+    assert offset_index.indexFile(compressed, "tas") is None
+
+    fpath = str(tmp_path / "contiguous.nc")
+    _writeStatsFile(fpath)
+    index = offset_index.buildOffsetIndex([(fpath, "tas"), (compressed, "tas")])
+
+    assert list(index.entries.keys()) == [fpath]
+    assert index.readPoints(compressed, "tas", [(0, 0)]) is None
+
+    stat = os.stat(fpath)
+    os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert index.readPoints(fpath, "tas", [(0, 0)]) is None
+
+
+def test_extraction_threads_read_the_offset_index_concurrently(tmp_path, monkeypatch):
+    points = [(-85, 5), (0.1, 179.9)]
+    files = []
+    for name in ("tas_a.nc", "tas_b.nc"):
+        fpath = str(tmp_path / name)
+        _writeStatsFile(fpath)
+        files.append(fpath)
+
+    index = offset_index.buildOffsetIndex([(fpath, "tas") for fpath in files])
+    expected = index.readPoints(files[0], "tas", points)
+
+    for cache in (lib.ClimateStatsCache, lib.FullClimateStatsCache):
+        monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(lib, "getSetting", lambda option, default: 4 if option == "extraction_threads" else default)
+
+    # Without an offset index, all reads would be serialised by the NETCDF_LOCK
+    assert lib.ClimateStatsExtractor().extraction_threads == 1
+
+    monkeypatch.setattr(lib, "getOffsetIndex", lambda path: index)
+    extractor = lib.ClimateStatsExtractor()
+    assert extractor.extraction_threads == 4
+
+    # Each read waits for another one to start, so the reads only complete if they are concurrent
+    barrier = threading.Barrier(2, timeout=10)
+    readPoints = index.readPoints
+
+    def readConcurrently(fpath, var_id, points):
+        barrier.wait()
+        return readPoints(fpath, var_id, points)
+
+    monkeypatch.setattr(index, "readPoints", readConcurrently)
+
+    # Another thread holds the NETCDF_LOCK until the reads complete (or for 10 seconds)
+    (held, done) = (threading.Event(), threading.Event())
+
+    def holdLock():
+        with dataset_pool.NETCDF_LOCK:
+            held.set()
+            done.wait(10)
+
+    holder = threading.Thread(target=holdLock)
+    holder.start()
+    held.wait()
+
+    try:
+        results = extractor._map(lambda fpath: extractor._extractPointsFromFile("mon", fpath, "tas", points), files)
+        assert holder.is_alive()
+    finally:
+        done.set()
+        holder.join()
+
+    for (values, read_error) in results:
+        assert not read_error
+        assert values.filled(0).tolist() == expected.filled(0).tolist()
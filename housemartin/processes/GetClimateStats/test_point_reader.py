@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import netCDF4
+import xarray as xr
+import pytest
+
+from dataset_pool import DatasetPool, openNetCDF4Dataset
+from point_reader import NetCDF4PointReader, FileLayout, readLayout, decodeValues
+
+
+LATS = np.arange(80., -90, -20)
+LONS = np.arange(-170., 180, 20)
+
+
+def _writePackedFile(fpath, value=0):
+    """
+    Writes a file of packed ``short`` values, with a scale factor and offset, fill and missing values,
+    and a (lon, time, lat) layout whose axes are only identified by their units.
+    """
+    ds = netCDF4.Dataset(fpath, "w")
+
+    for (dim, values, units) in (("x", LONS, "degrees_east"), ("t", np.arange(12.), "months"),
+                                 ("y", LATS, "degrees_north")):
+        ds.createDimension(dim, len(values))
+        var = ds.createVariable(dim, "f8", (dim,))
+        var[:] = values
+        var.units = units
+
+    var = ds.createVariable("pr", "i2", ("x", "t", "y"), fill_value=np.int16(-32767))
+    var.missing_value = np.int16(-32766)
+    var.scale_factor = 0.5
+    var.add_offset = 100.
+    var.set_auto_maskandscale(False)
+
+    data = np.full((len(LONS), 12, len(LATS)), value, dtype="i2")
+    data[:, :, 0] = np.arange(12)
+    data[:, 0, 0] = -32767
+    data[:, 1, 0] = -32766
+    var[:] = data
+
+    ds.close()
+
+
+def _makeReader(**kwargs):
+    return NetCDF4PointReader(DatasetPool(opener=openNetCDF4Dataset), **kwargs)
+
+
+def test_read_layout(tmp_path):
+    fpath = str(tmp_path / "pr.nc")
+    _writePackedFile(fpath)
+
+    with netCDF4.Dataset(fpath) as ds:
+        layout = readLayout(ds, "pr", 123)
+
+    assert isinstance(layout, FileLayout)
+    assert (layout.mtime, layout.lat_axis, layout.lon_axis, layout.n_dims) == (123, 2, 0, 3)
+    assert layout.fill_values.tolist() == [-32767, -32766]
+    assert (layout.scale_factor, layout.add_offset) == (0.5, 100.)
+    assert layout.lons.period == 360. and layout.lats.period is None
+
+    with netCDF4.Dataset(fpath) as ds:
+        with pytest.raises(Exception, match="Cannot find longitude axis"):
+            readLayout(ds, "y", 0)
+
+
+def test_decode_values(tmp_path):
+    fpath = str(tmp_path / "pr.nc")
+    _writePackedFile(fpath)
+
+    with netCDF4.Dataset(fpath) as ds:
+        layout = readLayout(ds, "pr", 0)
+
+    values = decodeValues(layout, np.array([[-32767, -32766, 0, 4]], dtype="i2"))
+    assert values.mask.tolist() == [[True, True, False, False]]
+    assert values.compressed().tolist() == [100., 102.]
+
+    # Non-finite values are masked, without scaling or fill values
+    unpacked = layout._replace(fill_values=np.array([]), scale_factor=None, add_offset=None)
+    values = decodeValues(unpacked, np.array([np.nan, np.inf, -np.inf, 1.5]))
+    assert values.mask.tolist() == [True, True, True, False] and values.compressed().tolist() == [1.5]
+
+
+def test_reader_matches_xarray_decoding(tmp_path):
+    fpath = str(tmp_path / "pr.nc")
+    _writePackedFile(fpath)
+    reader = _makeReader()
+
+    points = [(80., -170.), (79., 191.), (-80., 170.), (3., -361.)]
+    values = reader.readPoints(fpath, "pr", points)
+    assert values.shape == (4, 12)
+
+    with xr.open_dataset(fpath) as ds:
+        da = ds["pr"].transpose("y", "x", "t")
+        expected = [da.sel(y=lat, x=lon, method="nearest").values for (lat, lon) in
+                    [(80., -170.), (80., -170.), (-80., 170.), (0., -10.)]]
+
+    expected = np.ma.masked_invalid(expected)
+    assert values.mask.tolist() == expected.mask.tolist()
+    assert values.mask[0].tolist() == [True, True] + [False] * 10
+    assert values.filled(0).tolist() == expected.filled(0).tolist()
+
+
+def test_reader_reloads_modified_files_and_bounds_layouts(tmp_path):
+    paths = [str(tmp_path / ("pr_%d.nc" % i)) for i in range(3)]
+    for fpath in paths:
+        _writePackedFile(fpath)
+
+    reader = _makeReader(max_layouts=2)
+
+    for fpath in paths:
+        assert reader.readPoints(fpath, "pr", [(0., 10.)]).tolist() == [[100.] * 12]
+
+    assert list(reader._layouts.keys()) == [(paths[1], "pr"), (paths[2], "pr")]
+
+    # A replaced file is opened again, with its new layout
+    _writePackedFile(paths[2] + ".tmp", value=10)
+    os.replace(paths[2] + ".tmp", paths[2])
+    stat = os.stat(paths[2])
+    os.utime(paths[2], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert reader.readPoints(paths[2], "pr", [(0., 10.)]).tolist() == [[105.] * 12]
+    assert reader._layouts[(paths[2], "pr")].mtime == stat.st_mtime_ns + 10 ** 9
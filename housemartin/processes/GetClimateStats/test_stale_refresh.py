@@ -0,0 +1,43 @@
+import threading
+
+from stale_refresh import StaleRefresher
+
+
+def test_refreshes_run_once_per_key():
+    refresher = StaleRefresher(threads=2, max_pending=10)
+    release = threading.Event()
+    calls = []
+
+    def refresh(name):
+        release.wait(5)
+        calls.append(name)
+
+    assert refresher.submit(("summary", 1), refresh, "a")
+    assert not refresher.submit(("summary", 1), refresh, "a")
+    assert refresher.submit(("summary", 2), refresh, "b")
+
+    release.set()
+    assert refresher.wait(5)
+    assert sorted(calls) == ["a", "b"]
+    assert (refresher.completed, refresher.failed, refresher.dropped) == (2, 0, 0)
+
+    # Keys can be refreshed again once their refresh is complete
+    assert refresher.submit(("summary", 1), refresh, "a")
+    assert refresher.wait(5)
+
+
+def test_full_queue_drops_refreshes():
+    refresher = StaleRefresher(threads=1, max_pending=1)
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise Exception("Cannot read stats file")
+
+    assert refresher.submit("a", fail)
+    assert not refresher.submit("b", fail)
+    assert refresher.dropped == 1
+
+    release.set()
+    assert refresher.wait(5)
+    assert (refresher.completed, refresher.failed) == (0, 1)
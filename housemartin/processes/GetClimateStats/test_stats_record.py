@@ -0,0 +1,148 @@
+import time
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+import stats_record
+from stats_record import StatsRecord, formatResults, formatCSVLines, getModelItems
+from vocabs import vocabs
+
+
+SCENARIOS = [("2035", "rcp45"), ("2055", "rcp85")]
+GRID_BOXES = {"EUR-44": (51.25, -0.25), "MNA-44": (31.25, 0.25)}
+
+
+def _fillRecord(record, seed=0):
+    "Sets random values, with some missing, for all models of the record."
+    random = np.random.RandomState(seed)
+
+    for scenario in record.scenarios:
+        for inst_model in record.models:
+            values = np.ma.masked_greater(random.uniform(0, 10, (len(record.items), 13)).astype("f4"), 9)
+            record.setValues(scenario, inst_model, record.items, values)
+
+    return record
+
+
+def test_round_trip(tmp_path):
+    record = _fillRecord(StatsRecord("Regional", "full", SCENARIOS, GRID_BOXES, fingerprint="0123abcd"))
+    assert record.values.shape == (2, len(record.items), 13, 5)
+    assert np.isnan(record.values).any()
+
+    for compression in ("none", "zlib"):
+        payload = record.toBytes(compression)
+        decoded = StatsRecord.fromBytes(payload)
+
+        assert (decoded.domain_type, decoded.layout, decoded.scenarios) == ("Regional", "full", SCENARIOS)
+        assert decoded.grid_boxes == GRID_BOXES
+        assert decoded.fingerprint == "0123abcd"
+        np.testing.assert_array_equal(decoded.values, record.values)
+        assert not decoded.values.flags.writeable
+
+    assert len(record.toBytes("zlib")) < len(record.toBytes("none"))
+
+
+def test_other_payloads_are_not_decoded(monkeypatch):
+    record = StatsRecord("Global", "summary", SCENARIOS[:1], {"Global": (51.5, 0.5)})
+    payload = record.toBytes()
+
+    assert StatsRecord.fromBytes(pickle.dumps([{"VariableName": "tas:jan:avg", "Values": [1.0]}])) is None
+    assert StatsRecord.fromBytes(payload[:4] + b"\x02" + payload[5:]) is None
+    assert StatsRecord.fromBytes(payload[:-4]) is None
+
+    # Records laid out for other vocabs are misses
+    monkeypatch.setattr(vocabs, "vital_statistics", vocabs.vital_statistics + ["tas:95p"])
+    assert StatsRecord.fromBytes(payload) is None
+
+
+def test_full_record_serves_summary_results():
+    full = _fillRecord(StatsRecord("Global", "full", SCENARIOS, {"Global": (51.5, 0.5)}))
+    summary = StatsRecord("Global", "summary", SCENARIOS[1:], {"Global": (51.5, 0.5)})
+
+    for inst_model in summary.models:
+        summary.setValues(SCENARIOS[1], inst_model, summary.items,
+                          full.getValues(SCENARIOS[1], inst_model, summary.items))
+
+    results = formatResults(summary, SCENARIOS[1])
+    assert results == formatResults(full, SCENARIOS[1])
+
+    assert len(results) == len(vocabs.vital_statistics) * 13
+    assert results[0]["VariableName"] == "tas:jan:avg"
+    assert len(results[0]["Values"]) == len(vocabs.getModelList("Global", "tas"))
+    assert None in [value for result in results for value in result["Values"]]
+
+
+def test_csv_lines():
+    record = StatsRecord("Regional", "full", SCENARIOS, {"EUR-44": (51.25, -0.25)})
+    inst_model = "ICHEC-EC-EARTH/EUR-44"
+    items = getModelItems("Regional", inst_model)
+
+    values = np.ma.masked_all((len(items), 13))
+    values[0] = np.arange(13) / 3.
+    record.setValues(SCENARIOS[1], inst_model, items, values)
+
+    # Only the models whose domain covers the location have lines
+    lines = formatCSVLines(record)
+    assert len(lines) == len(SCENARIOS) * len(items)
+
+    line = lines[len(items)]
+    assert line.startswith("2055,rcp85,ICHEC-EC-EARTH/EUR-44,Regional,Temperature: daily mean,avg,degC,"
+                           "51.25,-0.25,0.00,0.33,0.67,")
+    assert line.endswith(",4.00\n")
+    assert lines[0].endswith(",NaN,NaN\n")
+    assert stats_record.getDomain("Regional", inst_model) == "EUR-44"
+
+
+def test_cells():
+    values = np.ma.masked_greater(np.arange(13, dtype="f4"), 10)
+    payload = stats_record.cellToBytes(values, fingerprint="0123abcd")
+
+    (decoded, fingerprint) = stats_record.cellFromBytes(payload)
+    np.testing.assert_array_equal(decoded.mask, values.mask)
+    np.testing.assert_array_equal(decoded.compressed(), values.compressed())
+    assert fingerprint == "0123abcd"
+    assert stats_record.cellFromBytes(stats_record.cellToBytes(values))[1] == ""
+
+    # Records, and cells of other versions, are not cells
+    record = StatsRecord("Global", "summary", SCENARIOS[:1], {"Global": (51.5, 0.5)})
+    assert stats_record.cellFromBytes(record.toBytes()) is None
+    assert stats_record.cellFromBytes(payload[:4] + b"\x02" + payload[5:]) is None
+
+
+def test_bundles():
+    cells = OrderedDict()
+    cells["tas/avg/MOHC+HadGEM2-ES"] = stats_record.cellToBytes(np.arange(13.), fingerprint="0123abcd")
+    cells["pr/99p/NCAR+CCSM4"] = stats_record.cellToBytes(np.ma.masked_all(13), expires=time.time() + 60)
+    payload = stats_record.bundleToBytes(cells)
+
+    decoded = stats_record.bundleFromBytes(payload)
+    assert list(decoded.keys()) == list(cells.keys())
+    assert [bytes(cell) for cell in decoded.values()] == list(cells.values())
+    assert stats_record.cellFromBytes(decoded["tas/avg/MOHC+HadGEM2-ES"])[0].tolist() == list(range(13))
+    assert stats_record.bundleFromBytes(stats_record.bundleToBytes({})) == {}
+
+    # Cells, truncated bundles and bundles of other versions are not bundles
+    assert stats_record.bundleFromBytes(cells["pr/99p/NCAR+CCSM4"]) is None
+    assert stats_record.bundleFromBytes(payload[:-1]) is None
+    assert stats_record.bundleFromBytes(payload[:4] + b"\x02" + payload[5:]) is None
+
+
+def test_negative_entries_expire():
+    values = np.ma.masked_all(13)
+    payload = stats_record.cellToBytes(values, fingerprint="0123abcd", expires=time.time() + 60)
+
+    (decoded, fingerprint) = stats_record.cellFromBytes(payload)
+    assert decoded.mask.all() and fingerprint == "0123abcd"
+    assert stats_record.cellFromBytes(stats_record.cellToBytes(values, expires=time.time() - 1)) is None
+
+    record = StatsRecord("Global", "summary", SCENARIOS[:1], {"Global": (51.5, 0.5)}, expires=time.time() + 60)
+    assert StatsRecord.fromBytes(record.toBytes()).expires == record.expires
+
+    record.expires = time.time() - 1
+    assert StatsRecord.fromBytes(record.toBytes()) is None
+
+    # The fingerprint and expiry time of a payload can be given without changing the record
+    decoded = StatsRecord.fromBytes(record.toBytes(fingerprint="0123abcd", expires=time.time() + 60))
+    assert decoded.fingerprint == "0123abcd" and decoded.expires > time.time()
+    assert record.fingerprint == "" and record.expires < time.time()
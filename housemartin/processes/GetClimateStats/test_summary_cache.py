@@ -0,0 +1,163 @@
+import contextlib
+
+import numpy as np
+
+import lib
+import cache_warmup
+from cache_warmup import planWarmup
+from stale_refresh import getStaleRefresher
+from stats_record import StatsRecord
+from extraction_plan import ExtractionPlan, getCells
+from conftest import makeLocation
+
+
+SCENARIO = ("2035", "rcp45")
+GB = (45., 5.)
+CELL = ("MOHC/HadGEM2-ES", "tas", "avg")
+
+
+def _trackExtraction(extractor):
+    "Records the missing cells of each extraction plan run by ``extractor``. Returns the list of them."
+    extracted = []
+    runExtractionPlan = extractor._runExtractionPlan
+
+    def track(plan):
+        extracted.append(plan.getMissingCells())
+        return runExtractionPlan(plan)
+
+    extractor._runExtractionPlan = track
+    return extracted
+
+
+def _getSummaryValues(extractor, location, cell=CELL):
+    records = extractor.getSummaryRecords("Global", SCENARIO[1], SCENARIO[0], [location])
+    (record,) = records.values()
+    return (record, record.getValues(SCENARIO, cell[0], [cell[1:]])[0])
+
+
+def test_cells_of_a_grid_box_are_stored_in_one_entry(stats_archive):
+    fpaths = stats_archive.write("Global", CELL[0], SCENARIO[1], SCENARIO[0], "tas", "avg")
+    extractor = stats_archive.getExtractor()
+    extracted = _trackExtraction(extractor)
+
+    (record, values) = _getSummaryValues(extractor, makeLocation(GB))
+    assert values.tolist() == stats_archive.getValues(fpaths, GB)
+    assert len(extracted) == 1 and len(extracted[0]) == len(getCells("Global", {"Global": GB}))
+
+    # Absent files are stored as negative cells, in the same entry as the others
+    keys = [key for (key, payload) in extractor.cache_stats.backend.items()]
+    assert keys == [("Global", "rcp45", "2035", "45.0000", "5.0000")]
+
+    # A second request is served from the cache
+    assert _getSummaryValues(stats_archive.getExtractor(), makeLocation(GB))[1].tolist() == values.tolist()
+
+
+def test_partial_hit_only_extracts_missing_cells(stats_archive):
+    stats_archive.write("Global", CELL[0], SCENARIO[1], SCENARIO[0], "tas", "avg")
+    fpaths = stats_archive.write("Global", "NCAR/CCSM4", SCENARIO[1], SCENARIO[0], "pr", "avg")
+
+    extractor = stats_archive.getExtractor()
+    request = extractor._getCellRequest("Global", SCENARIO[1], SCENARIO[0], "Global", GB, CELL)
+
+    with extractor.cache_stats.lockMany([request]):
+        extractor.cache_stats.putMany([dict(request, data=np.ma.masked_array(np.full(13, 7.)))])
+
+    extracted = _trackExtraction(extractor)
+    (record, values) = _getSummaryValues(extractor, makeLocation(GB))
+
+    # The cached cell is used, and all the others are extracted
+    assert values.tolist() == [7.] * 13
+    missing = extracted[0]
+    assert ("Global", GB, CELL) not in missing
+    assert len(missing) == len(getCells("Global", {"Global": GB})) - 1
+
+    pr_values = record.getValues(SCENARIO, "NCAR/CCSM4", [("pr", "avg")])[0]
+    assert pr_values.tolist() == stats_archive.getValues(fpaths, GB)
+
+    # The extracted cells are merged in to the entry, keeping the cached one
+    extractor = stats_archive.getExtractor()
+    extracted = _trackExtraction(extractor)
+    assert _getSummaryValues(extractor, makeLocation(GB))[1].tolist() == [7.] * 13
+    assert extracted == []
+
+
+def test_full_records_serve_grid_boxes_with_missing_cells(stats_archive):
+    extractor = stats_archive.getExtractor()
+    location = makeLocation(GB)
+
+    record = StatsRecord("Global", "full", lib.FULL_SUMMARY_SCENARIOS, {"Global": GB})
+    record.setValues(SCENARIO, CELL[0], [CELL[1:]], np.full((1, 13), 3.))
+    extractor.cache_full.put(data=record, **extractor._getFullRequest("Global", location))
+
+    extracted = _trackExtraction(extractor)
+    (served, values) = _getSummaryValues(extractor, location)
+
+    assert served.layout == "full" and values.tolist() == [3.] * 13
+    assert extracted == []
+
+    # Other scenarios are not in the full summary, so are extracted
+    extractor.getSummaryRecords("Global", "rcp26", "2035", [location])
+    assert len(extracted) == 1
+
+
+def test_cells_cached_while_waiting_for_the_lock_are_not_extracted(stats_archive):
+    fpaths = stats_archive.write("Global", CELL[0], SCENARIO[1], SCENARIO[0], "tas", "avg")
+    location = makeLocation(GB)
+
+    extractor = stats_archive.getExtractor()
+    extracted = _trackExtraction(extractor)
+    lockMany = extractor.cache_stats.lockMany
+
+    @contextlib.contextmanager
+    def lockAfterOtherExtraction(requests):
+        # Another extractor holds the lock, and caches the cells, before this one gets it
+        with lockMany(requests):
+            other = stats_archive.getExtractor()
+            other._extractAndCache(ExtractionPlan("Global", SCENARIO[1], SCENARIO[0], [location]))
+
+        with lockMany(requests):
+            yield
+
+    extractor.cache_stats.lockMany = lockAfterOtherExtraction
+
+    assert _getSummaryValues(extractor, location)[1].tolist() == stats_archive.getValues(fpaths, GB)
+    assert extracted == []
+
+
+def test_warm_units_populate_the_caches(stats_archive, monkeypatch):
+    fpaths = stats_archive.write("Global", CELL[0], SCENARIO[1], SCENARIO[0], "tas", "avg")
+    monkeypatch.setattr(lib, "_summary_extractor", None)
+
+    location = makeLocation(GB)
+    units = planWarmup([location], scenarios=[SCENARIO])
+    assert [unit.kind for unit in units] == ["summary", "full"]
+
+    for unit in units:
+        (read_errors, seconds) = cache_warmup._warmUnit(unit)
+        assert read_errors == 0
+
+    extractor = stats_archive.getExtractor()
+    extracted = _trackExtraction(extractor)
+    assert _getSummaryValues(extractor, location)[1].tolist() == stats_archive.getValues(fpaths, GB)
+    assert extracted == []
+
+    record = extractor.cache_full.get(**extractor._getFullRequest("Global", location))
+    assert record.getValues(SCENARIO, CELL[0], [CELL[1:]])[0].tolist() == stats_archive.getValues(fpaths, GB)
+
+
+def test_stale_entries_are_refreshed_by_a_dedicated_extractor(stats_archive, monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(lib.ClimateStatsExtractor, "_refreshCells", lambda self, *args: refreshes.append((self, args)))
+
+    extractor = stats_archive.getExtractor(serve_stale=True)
+    location = makeLocation(GB)
+
+    for key in ("first", "second"):
+        extractor._queueRefresh(("summary", key), "_refreshCells", "Global", SCENARIO[1], SCENARIO[0], [location])
+        assert getStaleRefresher().wait(5)
+
+    # Both refreshes ran on the extractor of the refresh thread, which does not serve stale entries
+    ((first, args), (second, second_args)) = refreshes
+    assert first is second and first is not extractor
+    assert not first.serve_stale
+    assert args == ("Global", SCENARIO[1], SCENARIO[0], [location])
@@ -138,6 +138,10 @@ zos     17      BCC/bcc-csm1-1-m                CCCma/CanESM2   CMCC/CMCC-CMS
         else:
             return self.regional_inst_models  
 
+    def getAllVariables(self, domain_type):
+        "Returns a list of all variables that could be available for domain type."
+        return list(self.models_by_variable[domain_type].keys())
+
     def getVariableList(self, domain_type, inst_model):
         """
         Returns a list of var_ids for a given domain_type and variable.